@@ -47,11 +47,15 @@ void record_distances() {
   ultrasonic_distance[3] = sonar_pin(trig3Pin, echo3Pin);//b
   ultrasonic_distance[4] = sonar_pin(trig4Pin, echo4Pin);//drop
 
+#if defined(BINARY_PROTOCOL)
+  send_distances();
+#else
   Serial.println("***************");
   for (int i = 0; i < 5; i++) {
     Serial.print(i);
     Serial.println(ultrasonic_distance[i]);
   }
+#endif
 }
 
 double sonar_pin(int trig, int echo) {
@@ -15,6 +15,11 @@
 
 //#define ENABLE_ULTRASONIC
 
+//Uncomment to use the compact binary command protocol (a4_binary_protocol.ino) instead of
+//the text commands, the python scripts then need --protocol binary
+
+//#define BINARY_PROTOCOL
+
 
 // set up Arrays
 int LED_array [3][16];      //LED data array
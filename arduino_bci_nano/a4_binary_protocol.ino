@@ -0,0 +1,160 @@
+//Author: James Chen
+//University of Calgary
+//a4_binary_protocol.ino
+
+//Contains the decoder of the compact binary command protocol (see serial_protocol.py).
+//Used instead of the text commands when BINARY_PROTOCOL is defined.
+
+//FRAME: [0xA5 sync][header: opcode << 6 | payload length][payload][CRC-8 of header and payload]
+//  opcode 0, DRIVE:     direction code, 0 stop, 1 nn, 2 ww, 3 ss, 4 ee, 5 nw, 6 ne, 7 sw, 8 se
+//  opcode 1, STIMULUS:  3 bytes per LED: pin, frequency (Hz), phase / 2 (degrees)
+//  opcode 2, TELEMETRY: sent to the computer, kind 0 echo of a received frame, kind 1 distances (mm)
+
+#if defined(BINARY_PROTOCOL)
+
+#define FRAME_SYNC 0xA5
+#define MAX_PAYLOAD 63
+
+#define OP_DRIVE 0
+#define OP_STIMULUS 1
+#define OP_TELEMETRY 2
+
+#define TELEMETRY_ECHO 0
+#define TELEMETRY_DISTANCE 1
+
+//parsers, 0 for the cable and 1 for the bluetooth connection
+#define CABLE_PARSER 0
+#define BLUETOOTH_PARSER 1
+
+#define WAIT_SYNC 0
+#define WAIT_HEADER 1
+#define WAIT_PAYLOAD 2
+#define WAIT_CRC 3
+
+uint8_t parser_state[2] = {WAIT_SYNC, WAIT_SYNC};
+uint8_t parser_header[2];
+uint8_t parser_received[2];
+uint8_t parser_crc[2];
+uint8_t parser_payload[2][MAX_PAYLOAD];
+
+const char *DRIVE_DIRECTIONS[] = {"00", "nn", "ww", "ss", "ee", "nw", "ne", "sw", "se"};
+
+uint8_t crc8_update(uint8_t crc, uint8_t data) {
+  //Promises: CRC-8 (polynomial 0x07) of the preceding bytes and data
+  crc ^= data;
+  for (int i = 0; i < 8; i++) {
+    crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+  }
+  return crc;
+}
+
+void send_frame(uint8_t opcode, uint8_t *payload, uint8_t length) {
+  //Requires: length <= MAX_PAYLOAD
+  //Promises: writes one frame to the cable serial connection
+  uint8_t header = (opcode << 6) | length;
+  uint8_t crc = crc8_update(0, header);
+  Serial.write(FRAME_SYNC);
+  Serial.write(header);
+  for (int i = 0; i < length; i++) {
+    Serial.write(payload[i]);
+    crc = crc8_update(crc, payload[i]);
+  }
+  Serial.write(crc);
+}
+
+void send_distances() {
+  //Promises: sends the ultrasonic distances as a telemetry frame, in mm
+  uint8_t payload[11];
+  payload[0] = TELEMETRY_DISTANCE;
+  for (int i = 0; i < 5; i++) {
+    unsigned int distance = (unsigned int) min(ultrasonic_distance[i] * 10, 65535.0);
+    payload[1 + 2 * i] = distance & 0xFF;
+    payload[2 + 2 * i] = distance >> 8;
+  }
+  send_frame(OP_TELEMETRY, payload, 11);
+}
+
+void set_stimulus_binary(uint8_t *payload, uint8_t length) {
+  //Requires: 3 bytes per LED, see STIMULUS above
+  //Promises: Updates LED_array with new pins, frequencies, phase angles, same as set_stimulus
+  number_LED = min(length / 3, 16);
+  delay_phase = true;
+  for (int i = 0; i < number_LED; i++) {
+    LED_array[0][i] = payload[3 * i];
+    LED_array[1][i] = payload[3 * i + 1];
+    LED_array[2][i] = payload[3 * i + 2] * 2;
+  }
+
+  //begins the LED switching updates and initializes all pins to output
+  for (int i = 0; i < number_LED; i++) {
+    last_switch[i] = micros() / 1000.0;
+    pinMode(LED_array[0][i], OUTPUT);
+    digitalWrite(LED_array[0][i], HIGH);
+  }
+  begin_leds = true;
+}
+
+void handle_frame(uint8_t parser) {
+  //Requires: a complete frame with a valid CRC in the parser
+  //Promises: echoes the frame to the computer and runs the command
+  uint8_t opcode = parser_header[parser] >> 6;
+  uint8_t length = parser_header[parser] & MAX_PAYLOAD;
+  uint8_t *payload = parser_payload[parser];
+
+  //echo: kind, header and as much of the payload as fits
+  uint8_t echo[MAX_PAYLOAD];
+  uint8_t echo_length = min(length + 2, MAX_PAYLOAD);
+  echo[0] = TELEMETRY_ECHO;
+  echo[1] = parser_header[parser];
+  for (int i = 2; i < echo_length; i++) {
+    echo[i] = payload[i - 2];
+  }
+  send_frame(OP_TELEMETRY, echo, echo_length);
+
+  if (opcode == OP_DRIVE && length == 1 && payload[0] < 9) {
+    //the text protocol sends d/00 before every direction, stop first here
+    drive_motor("d/00");
+    drive_motor(String("d/") + DRIVE_DIRECTIONS[payload[0]]);
+  }
+  else if (opcode == OP_STIMULUS && length % 3 == 0) {
+    set_stimulus_binary(payload, length);
+  }
+}
+
+void poll_binary_protocol(Stream &port, uint8_t parser) {
+  //Requires: parser is CABLE_PARSER or BLUETOOTH_PARSER
+  //Promises: reads the bytes available without waiting, runs every complete frame.
+  //          Frames with a wrong CRC are dropped and the parser waits for the next sync byte
+  while (port.available() > 0) {
+    uint8_t data = port.read();
+    switch (parser_state[parser]) {
+      case WAIT_SYNC:
+        if (data == FRAME_SYNC) {
+          parser_state[parser] = WAIT_HEADER;
+        }
+        break;
+      case WAIT_HEADER:
+        parser_header[parser] = data;
+        parser_received[parser] = 0;
+        parser_crc[parser] = crc8_update(0, data);
+        parser_state[parser] = (data & MAX_PAYLOAD) > 0 ? WAIT_PAYLOAD : WAIT_CRC;
+        break;
+      case WAIT_PAYLOAD:
+        parser_payload[parser][parser_received[parser]] = data;
+        parser_received[parser]++;
+        parser_crc[parser] = crc8_update(parser_crc[parser], data);
+        if (parser_received[parser] == (parser_header[parser] & MAX_PAYLOAD)) {
+          parser_state[parser] = WAIT_CRC;
+        }
+        break;
+      case WAIT_CRC:
+        if (data == parser_crc[parser]) {
+          handle_frame(parser);
+        }
+        parser_state[parser] = WAIT_SYNC;
+        break;
+    }
+  }
+}
+
+#endif
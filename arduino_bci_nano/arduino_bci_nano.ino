@@ -15,6 +15,11 @@
 
 //#define ENABLE_ULTRASONIC
 
+//Uncomment to use the compact binary command protocol (a4_binary_protocol.ino) instead of
+//the text commands, the python scripts then need --protocol binary
+
+//#define BINARY_PROTOCOL
+
 //Comment/Uncomment to switch between motor configurations type, Two_AXIS defined when
 //Car has one drive motor, one steering, else will assume 1 motor per side.
 
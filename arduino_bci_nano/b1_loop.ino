@@ -26,6 +26,11 @@ void loop() {
 #endif
 
 
+#if defined(BINARY_PROTOCOL)
+  //binary frames are decoded without blocking, see a4_binary_protocol.ino
+  poll_binary_protocol(Serial, CABLE_PARSER);
+  poll_binary_protocol(bluetooth_connection, BLUETOOTH_PARSER);
+#else
   String data = "";
 
   if (Serial.available() > 0) { //read if serial avalible (cable)
@@ -52,6 +57,7 @@ void loop() {
     //FORMAT: 'd/nn' -- drive input data: go north; nn, nw, ne, se,ss,sw,ee,ww
     drive_motor(data);
   }
+#endif
 
 
   if (begin_leds) {
@@ -0,0 +1,389 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Simulated Arduino on a pseudo terminal, for testing the serial path without
+hardware.
+
+ArduinoSimulator opens a pty and emulates the firmware (b1_loop.ino) on it:
+    - 'd/xx' drive commands are applied with the drive_motor semantics of
+      arduino_bci_mega (pins are only set, 'd/00' clears them, and every
+      direction checks the ultrasonic distances first)
+    - 's/pp,ff,ppp;...' stimulus commands are parsed like set_stimulus
+    - every command is echoed as 'data is: ...', as Serial.println does
+    - with protocol='binary' the frames of serial_protocol are decoded and
+      echoed as telemetry instead, like a4_binary_protocol.ino
+    - a line without newline is taken as is after 1 s, the readStringUntil timeout
+
+The wire time of the serial connection is modelled in both directions (10 bits
+per byte at the given baud rate): a command is only handled once its last byte
+would have arrived, and an echo only becomes readable once it would have been
+sent. Every command is logged with its timestamps.
+
+The scripts read the port from the BCI_SERIAL_PORT environment variable, so they
+can be pointed at the simulator:
+
+    python3 arduino_sim.py --log sim_log.jsonl
+    BCI_SERIAL_PORT=/dev/pts/3 python3 control_methods.py
+"""
+
+import argparse
+import json
+import os
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+import numpy as np
+
+from serial_protocol import (ECHO_PREFIX, OP_DRIVE, OP_STIMULUS, OP_TELEMETRY, TELEMETRY_ECHO, FrameDecoder,
+                             describe_frame, encode_frame, get_protocol)
+
+# Timeout of Stream.readStringUntil on the Arduino
+READ_TIMEOUT = 1.0
+
+HIGH = 255
+LOW = 0
+
+# drive_motor of a1_motor_control.ino: direction (keyed by the sum of its two characters, as the
+# firmware does) -> (ultrasonic checks as (sensor, '>' or '<'), pins set)
+DRIVE_TABLE = {
+    ord('n') + ord('n'): ([(0, '>'), (4, '<')], dict(forwards_left=HIGH, forwards_right=HIGH)),
+    ord('w') + ord('w'): ([(3, '>')], dict(backwards_left=HIGH, forwards_right=HIGH)),
+    ord('s') + ord('s'): ([(1, '>')], dict(backwards_left=HIGH, backwards_right=HIGH)),
+    ord('e') + ord('e'): ([(2, '>')], dict(forwards_left=HIGH, backwards_right=HIGH)),
+    ord('n') + ord('w'): ([(0, '>'), (4, '<'), (2, '>')], dict(forwards_left=128, forwards_right=HIGH)),
+    ord('n') + ord('e'): ([(0, '>'), (4, '<'), (3, '>')], dict(forwards_left=HIGH, forwards_right=128)),
+    ord('s') + ord('e'): ([(1, '>')], dict(backwards_left=HIGH, backwards_right=128)),
+    ord('s') + ord('w'): ([(1, '>')], dict(backwards_left=128, backwards_right=HIGH)),
+}
+MOTOR_PINS = ('forwards_left', 'backwards_left', 'forwards_right', 'backwards_right')
+
+
+class ArduinoSimulator:
+    """
+    Emulated firmware behind a pseudo terminal.
+
+    Attributes:
+    --------------------
+    port: str
+        Path of the pty to open with serial.Serial, set by start()
+    motor_pins: dict
+        Output of every motor pin (0, 128 PWM or 255)
+    leds: list
+        (pin, frequency, phase) of every stimulus LED
+    ultrasonic_distance: list
+        Distances in cm seen by drive_motor, the firmware's defaults unless changed
+    log: list
+        One dict per command, see __handle_command
+
+    Methods:
+    --------------------
+    start() / stop()
+        Opens the pty and starts / stops the device threads
+    wait_for(count, kind=None, timeout=5.0)
+        Waits until count commands (of a kind) were handled
+    summary()
+        Command counts, throughput and latency statistics
+    save_log(path)
+        Writes the command log as JSON lines
+    """
+
+    def __init__(self, baud=9600, protocol='text', log_path=None):
+        """
+        :param baud: Baud rate of the modelled connection, None for no wire time
+        :param protocol: 'text' or 'binary', like the firmware built without or with BINARY_PROTOCOL
+        :param log_path: Optional JSON lines file the command log is written to on stop()
+        """
+        self.baud = baud
+        self.protocol = get_protocol(protocol)
+        self.log_path = log_path
+        self.byte_time = 10 / baud if baud else 0.0
+
+        self.port = None
+        self.motor_pins = {pin: LOW for pin in MOTOR_PINS}
+        self.leds = []
+        self.ultrasonic_distance = [100, 100, 100, 100, 10]
+        self.log = []
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+        self._master_fd = None
+        self._slave_fd = None
+        self._stop_event = threading.Event()
+        self._log_changed = threading.Condition()
+        self._tx_queue = deque()
+        self._tx_ready = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        """
+        Opens the pty and starts the receive and transmit threads.
+        :return: str, path of the port
+        """
+        self._master_fd, self._slave_fd = os.openpty()
+        tty.setraw(self._slave_fd)
+        self.port = os.ttyname(self._slave_fd)
+        self._stop_event.clear()
+        self._threads = [threading.Thread(target=self.__receive, name='arduino sim rx', daemon=True),
+                         threading.Thread(target=self.__transmit, name='arduino sim tx', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self.port
+
+    def stop(self):
+        """
+        Stops the threads, closes the pty and writes the log if log_path is set.
+        :return: None
+        """
+        self._stop_event.set()
+        with self._tx_ready:
+            self._tx_ready.notify()
+        for thread in self._threads:
+            thread.join(2 * READ_TIMEOUT)
+        for fd in (self._master_fd, self._slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self._master_fd = self._slave_fd = None
+        if self.log_path is not None:
+            self.save_log(self.log_path)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def __receive(self):
+        """
+        Reads the bytes written by the computer and hands complete commands to
+        the firmware emulation once they would have arrived over the wire.
+        """
+        line_free = 0.0
+        buffer = bytearray()
+        first_byte = None
+        decoder = FrameDecoder() if self.protocol.name == 'binary' else None
+
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([self._master_fd], [], [], 0.05)
+            now = time.perf_counter()
+            if not readable:
+                # readStringUntil gives up on a line without newline after its timeout
+                if decoder is None and buffer and now - line_free >= READ_TIMEOUT:
+                    self.__handle_text(bytes(buffer), first_byte, line_free)
+                    buffer.clear()
+                    first_byte = None
+                continue
+            try:
+                data = os.read(self._master_fd, 4096)
+            except OSError:
+                return
+            self.bytes_received += len(data)
+
+            # Each byte arrives one byte time after the previous one (or after now)
+            start = max(now, line_free)
+            line_free = start + len(data) * self.byte_time
+
+            if decoder is not None:
+                # Frames are handled once the chunk they end in has arrived
+                frames = decoder.feed_frames(data)
+                if frames:
+                    self.__wait_until(line_free)
+                for opcode, payload in frames:
+                    self.__handle_frame(opcode, payload, line_free - (len(payload) + 3) * self.byte_time,
+                                        line_free)
+                continue
+
+            for indx, byte in enumerate(data):
+                arrived = start + (indx + 1) * self.byte_time
+                if first_byte is None:
+                    first_byte = arrived - self.byte_time
+                if byte != ord('\n'):
+                    buffer.append(byte)
+                    continue
+                self.__wait_until(arrived)
+                self.__handle_text(bytes(buffer), first_byte, arrived)
+                buffer.clear()
+                first_byte = None
+
+    def __wait_until(self, timestamp):
+        delay = timestamp - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def __handle_text(self, raw, first_byte, arrived):
+        """
+        Emulates one pass of loop() with a line read by readStringUntil
+        """
+        data = raw.decode('utf-8', errors='replace')
+        self.__send((ECHO_PREFIX + data + '\r\n').encode('utf-8'))
+        if data[:1] == 's':
+            self.__set_stimulus(data)
+            kind = 'stimulus'
+        elif data[:1] == 'd':
+            self.__drive_motor(data)
+            kind = 'drive'
+        else:
+            kind = 'unknown'
+        self.__handle_command(kind, data, len(raw) + 1, first_byte, arrived)
+
+    def __handle_frame(self, opcode, payload, first_byte, arrived):
+        """
+        Emulates handle_frame of a4_binary_protocol.ino
+        """
+        self.__send(encode_frame(OP_TELEMETRY, bytes((TELEMETRY_ECHO, opcode << 6 | len(payload))) + payload))
+        data = describe_frame(opcode, payload)
+        kind = 'unknown'
+        if opcode == OP_DRIVE and data.startswith('d/'):
+            self.__drive_motor('d/00')
+            self.__drive_motor(data)
+            kind = 'drive'
+        elif opcode == OP_STIMULUS and data.startswith('s/'):
+            self.__set_stimulus(data)
+            kind = 'stimulus'
+        self.__handle_command(kind, data, len(payload) + 3, first_byte, arrived)
+
+    def __drive_motor(self, data):
+        """
+        drive_motor of a1_motor_control.ino
+        """
+        if len(data) < 4:
+            return
+        direction = ord(data[2]) + ord(data[3])
+        if direction == ord('0') + ord('0'):
+            for pin in MOTOR_PINS:
+                self.motor_pins[pin] = LOW
+            return
+        if direction not in DRIVE_TABLE:
+            return
+        checks, pins = DRIVE_TABLE[direction]
+        for sensor, compare in checks:
+            distance = self.ultrasonic_distance[sensor]
+            if (compare == '>' and not distance > 30) or (compare == '<' and not distance < 30):
+                return
+        self.motor_pins.update(pins)
+
+    def __set_stimulus(self, data):
+        """
+        set_stimulus of a2_ssvep_frequency_control.ino, malformed entries are skipped
+        """
+        leds = []
+        for entry in data[2:].split(';')[:-1]:
+            try:
+                pin, freq, phase = (int(value) for value in entry.split(','))
+            except ValueError:
+                continue
+            leds.append((pin, freq, phase))
+        self.leds = leds
+
+    def __handle_command(self, kind, data, n_bytes, first_byte, arrived):
+        """
+        Adds a command to the log. Entries hold the kind ('drive', 'stimulus' or
+        'unknown'), the data as text, its size on the wire, the perf_counter times
+        its first and last byte arrived and it was handled, the wall clock time
+        and the motor pins afterwards.
+        """
+        entry = dict(kind=kind, data=data, bytes=n_bytes, first_byte=first_byte,
+                     arrived=arrived, handled=time.perf_counter(), wall=time.time(),
+                     motor_pins=dict(self.motor_pins))
+        with self._log_changed:
+            self.log.append(entry)
+            self._log_changed.notify_all()
+
+    def __send(self, data):
+        """
+        Queues device output, it becomes readable once it would have been sent
+        """
+        with self._tx_ready:
+            self._tx_queue.append(data)
+            self._tx_ready.notify()
+
+    def __transmit(self):
+        line_free = 0.0
+        while True:
+            with self._tx_ready:
+                while not self._tx_queue and not self._stop_event.is_set():
+                    self._tx_ready.wait()
+                if self._stop_event.is_set():
+                    return
+                data = self._tx_queue.popleft()
+            line_free = max(time.perf_counter(), line_free) + len(data) * self.byte_time
+            self.__wait_until(line_free)
+            try:
+                os.write(self._master_fd, data)
+            except OSError:
+                return
+            self.bytes_sent += len(data)
+
+    def wait_for(self, count, kind=None, timeout=5.0):
+        """
+        :param count: Number of commands to wait for
+        :param kind: Only count commands of this kind ('drive', 'stimulus'), None for all
+        :param timeout: Seconds to wait
+        :return: bool, True if the commands were handled in time
+        """
+        deadline = time.perf_counter() + timeout
+        with self._log_changed:
+            while sum(kind is None or entry['kind'] == kind for entry in self.log) < count:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                self._log_changed.wait(remaining)
+        return True
+
+    def summary(self):
+        """
+        :return: dict with the command count per kind, bytes received and sent, the
+                 throughput in commands and bytes per second (first to last command)
+                 and the wire time (first to last byte) of the commands in ms
+        """
+        with self._log_changed:
+            log = list(self.log)
+        counts = {}
+        for entry in log:
+            counts[entry['kind']] = counts.get(entry['kind'], 0) + 1
+        summary = dict(commands=counts, bytes_received=self.bytes_received, bytes_sent=self.bytes_sent)
+        if len(log) > 1:
+            duration = log[-1]['arrived'] - log[0]['first_byte']
+            summary['commands_per_s'] = (len(log) - 1) / max(log[-1]['arrived'] - log[0]['arrived'], 1e-9)
+            summary['bytes_per_s'] = sum(entry['bytes'] for entry in log) / max(duration, 1e-9)
+        if log:
+            wire_ms = np.array([entry['arrived'] - entry['first_byte'] for entry in log]) * 1000
+            summary['wire_ms'] = dict(mean=float(np.mean(wire_ms)), p95=float(np.percentile(wire_ms, 95)),
+                                      max=float(np.max(wire_ms)))
+        return summary
+
+    def save_log(self, path):
+        """
+        :param path: JSON lines file, one command per line
+        :return: None
+        """
+        with self._log_changed:
+            log = list(self.log)
+        with open(path, 'w') as f:
+            for entry in log:
+                f.write(json.dumps(entry) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated Arduino on a pseudo terminal')
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--protocol', choices=['text', 'binary'], default='text')
+    parser.add_argument('--log', default=None, help='JSON lines file for the command log')
+    args = parser.parse_args()
+
+    simulator = ArduinoSimulator(args.baud, args.protocol, args.log)
+    port = simulator.start()
+    print('...Simulated Arduino listening on ' + port + '...')
+    print('...Run the scripts with BCI_SERIAL_PORT=' + port + ', Ctrl+C to stop...')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    simulator.stop()
+    print(json.dumps(simulator.summary(), indent=2))
@@ -0,0 +1,69 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Helpers shared by the pipeline benchmarks (benchmark_pipelines.py and evaluate_grid.py).
+"""
+
+import time
+
+import numpy as np
+
+from eeg_input import peak_rss_mb
+
+
+def preprocess_recordings(reader, subjects=None):
+    """
+    Preprocess every recording once up front, the worker processes then only
+    memory map them from the epoch cache.
+
+    :param reader: ReadEEG with the epoch cache the workers use
+    :param subjects: Subject numbers, None for all of reader.subj_list
+    :return: list of (subject, trial)
+    """
+    if subjects is None:
+        subjects = range(len(reader.subj_list))
+
+    recordings = []
+    for subj in subjects:
+        for trial in range(reader.get_trial_count(subj)):
+            reader.get_epochs(subj, trial)
+            recordings.append((subj, trial))
+    print('...Preprocessed ' + str(len(recordings)) + ' recordings, peak RSS ' + f'{peak_rss_mb():.1f}' + ' MB...')
+    return recordings
+
+
+def time_predictions(clf, X_data):
+    """
+    Online decisions are made one epoch at a time, so each epoch is predicted
+    and timed on its own. Predictions never use the covariance cache.
+
+    :param clf: Trained classifier or pipeline
+    :param X_data: (n_epochs, n_channels, n_times) array
+    :return: tuple (predictions, latencies), latencies in seconds
+    """
+    preds = []
+    latencies = np.empty(len(X_data))
+    for epoch in range(len(X_data)):
+        tstart = time.perf_counter()
+        preds.append(clf.predict(X_data[epoch:epoch + 1])[0])
+        latencies[epoch] = time.perf_counter() - tstart
+    return np.array(preds), latencies
+
+
+def json_safe(rows):
+    """
+    :param rows: list of dicts with numeric values
+    :return: list of dicts with nan replaced by None, NaN is not valid JSON
+    """
+    return [{key: None if isinstance(value, float) and np.isnan(value) else value for key, value in row.items()}
+            for row in rows]
+
+
+def json_safe_matrix(matrix):
+    """
+    :param matrix: Numeric array
+    :return: Nested lists with nan replaced by None
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    return np.where(np.isnan(matrix), None, matrix).tolist()
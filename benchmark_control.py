@@ -0,0 +1,180 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Idle CPU and press-to-send latency of the headless controller and the pygame window.
+
+Each controller runs in its own process (so CPU time and peak memory are its
+own) against the same serial port, by default an ArduinoSimulator pty:
+
+    headless    HeadlessControl, terminal backend; the key bytes are written
+                to a pty standing in for the terminal
+    window      RemoteControl (pygame window, pynput listener); the keys are
+                pressed with pynput, so it needs a display and the window focused
+
+For each one the CPU use while no key is pressed and the 'key_to_wire'
+latency (key event received until the command is written to the port) of
+repeated presses of the up key are reported, together with the peak RSS.
+
+Example (on the Raspberry Pi, with the window controller on the desktop):
+    python3 benchmark_control.py --idle 30 --presses 50
+    python3 benchmark_control.py --controllers headless --port /dev/ttyACM0
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+CONTROLLERS = ('headless', 'window')
+
+# Printed by the child process in front of its JSON result
+RESULT_PREFIX = 'benchmark result: '
+
+
+def _result(idle_cpu, idle_s, timer):
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return dict(idle_cpu_percent=100 * idle_cpu / idle_s,
+                peak_rss_mb=peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024,
+                key_to_wire=timer.summary().get('key_to_wire', dict(count=0)))
+
+
+def _idle(idle_s):
+    """
+    :return: float, CPU seconds of this process while sleeping idle_s
+    """
+    cpu_start = time.process_time()
+    time.sleep(idle_s)
+    return time.process_time() - cpu_start
+
+
+def run_headless(port, idle_s, presses, protocol='text'):
+    """
+    Runs HeadlessControl, the key presses are written to a pty.
+    :return: dict with idle_cpu_percent, peak_rss_mb and key_to_wire
+    """
+    from headless_control import RELEASE_DELAY, HeadlessControl, TerminalKeys
+    from serial_daemon import open_port
+
+    ser = open_port(port, 9600, timeout=1)
+    controller = HeadlessControl(ser, protocol=protocol)
+    master_fd, slave_fd = os.openpty()
+    measured = {}
+
+    def press_keys():
+        measured['idle_cpu'] = _idle(idle_s)
+        for _ in range(presses):
+            os.write(master_fd, b'w')
+            # Released once the (missing) auto repeat times out
+            time.sleep(RELEASE_DELAY + 0.1)
+        os.write(master_fd, b'q')
+
+    presser = threading.Thread(target=press_keys, daemon=True)
+    with TerminalKeys(slave_fd) as keys:
+        presser.start()
+        controller.run(keys)
+    presser.join()
+    os.close(master_fd)
+    os.close(slave_fd)
+    ser.close()
+    return _result(measured['idle_cpu'], idle_s, controller.timer)
+
+
+def run_window(port, idle_s, presses, protocol='text'):
+    """
+    Runs RemoteControl, the key presses are made with pynput.
+    :return: dict with idle_cpu_percent, peak_rss_mb and key_to_wire
+    """
+    import pygame
+    from pynput.keyboard import Controller, Key
+    from control_methods import RemoteControl
+    from serial_daemon import open_port
+
+    ser = open_port(port, 9600, timeout=1)
+    wheelchair = RemoteControl(ser, protocol=protocol)
+    keyboard = Controller()
+    measured = {}
+
+    def press_keys():
+        # Time for the window to open
+        time.sleep(1.0)
+        measured['idle_cpu'] = _idle(idle_s)
+        for _ in range(presses):
+            keyboard.press(Key.up)
+            time.sleep(0.2)
+            keyboard.release(Key.up)
+            time.sleep(0.5)
+        pygame.event.post(pygame.event.Event(pygame.QUIT))
+
+    presser = threading.Thread(target=press_keys, daemon=True)
+    presser.start()
+    wheelchair.begin_control()
+    presser.join()
+    ser.close()
+    return _result(measured['idle_cpu'], idle_s, wheelchair.timer)
+
+
+def run_controller(name, port, idle_s, presses, protocol='text'):
+    """
+    Runs one controller in a child process.
+    :return: dict, see run_headless
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, '--port', port,
+               '--idle', str(idle_s), '--presses', str(presses), '--protocol', protocol]
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    for line in output.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(name + ' controller did not report a result')
+
+
+def format_results(results):
+    """
+    :param results: dict of controller name -> run_controller result
+    :return: str, one line per controller
+    """
+    lines = [f'{"controller":>10} {"idle CPU %":>11} {"peak RSS MB":>12} {"commands":>8} '
+             f'{"mean ms":>8} {"p95 ms":>8} {"max ms":>8}']
+    for name, result in results.items():
+        latency = result['key_to_wire']
+        if latency['count']:
+            timing = f'{latency["mean_ms"]:8.3f} {latency["p95_ms"]:8.3f} {latency["max_ms"]:8.3f}'
+        else:
+            timing = f'{"-":>8} {"-":>8} {"-":>8}'
+        lines.append(f'{name:>10} {result["idle_cpu_percent"]:11.2f} {result["peak_rss_mb"]:12.1f} '
+                     f'{latency["count"]:>8} ' + timing)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the headless controller with the pygame window')
+    parser.add_argument('--controllers', nargs='+', choices=CONTROLLERS, default=list(CONTROLLERS))
+    parser.add_argument('--idle', type=float, default=10.0, help='Seconds without key presses')
+    parser.add_argument('--presses', type=int, default=20, help='Presses of the up key')
+    parser.add_argument('--port', default=None, help='Serial port, default a simulated Arduino')
+    parser.add_argument('--protocol', choices=['text', 'binary'], default='text')
+    parser.add_argument('--child', choices=CONTROLLERS, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run = run_headless if args.child == 'headless' else run_window
+        print(RESULT_PREFIX + json.dumps(run(args.port, args.idle, args.presses, args.protocol)))
+        sys.exit()
+
+    sim = None
+    if args.port is None:
+        from arduino_sim import ArduinoSimulator
+        sim = ArduinoSimulator(protocol=args.protocol)
+        args.port = sim.start()
+
+    results = {}
+    for name in args.controllers:
+        print('...Benchmarking the ' + name + ' controller...')
+        results[name] = run_controller(name, args.port, args.idle, args.presses, args.protocol)
+    if sim is not None:
+        sim.stop()
+    print(format_results(results))
@@ -0,0 +1,285 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Benchmark of the pre-defined Riemannian Geometry pipelines.
+
+Every pipeline x covariance estimator x subject/trial combination is evaluated
+with a stratified cross-validation on a process pool. For each combination the
+accuracy, fit time, per-epoch predict latency and peak memory are recorded and
+written to a CSV and a JSON table, together with a summary report used to pick
+the pipeline that meets the latency budget on the Raspberry Pi. The peak memory
+of one fold's fit and predictions is traced in a separate pass, so the timings
+do not include the tracing overhead.
+
+One pool job runs every pipeline and fold of a recording and estimator, so the
+covariances of its epochs are estimated once and shared through the covariance
+cache. fit_time_s is measured with every covariance estimated, as on the Pi;
+cached_fit_time_s is the same fit with the covariances served from the cache.
+
+Example:
+    python3 benchmark_pipelines.py --data-dir ~/dataset-ssvep-exoskeleton --latency-budget 50
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.model_selection import StratifiedKFold
+
+from eeg_input import ReadEEG, build_rg_pipeline
+from benchmark_common import json_safe, preprocess_recordings, time_predictions
+from covariance_cache import CachedCovariances, cache_bypassed, precompute_covariances
+
+# Per worker process: ReadEEG instance set up by _init_worker
+_worker_reader = None
+
+# Columns of the results table, in order
+RESULT_FIELDS = ['subject', 'trial', 'pipeline', 'estimator', 'n_epochs', 'accuracy',
+                 'fit_time_s', 'cached_fit_time_s', 'predict_latency_ms_p50', 'predict_latency_ms_p95',
+                 'peak_memory_mb', 'error']
+
+
+def _init_worker(data_dir, epoch_cache_dir, low_memory):
+    """
+    Pool initializer, opens the dataset once per worker process.
+    """
+    global _worker_reader
+    _worker_reader = ReadEEG(data_dir, epoch_cache_dir=epoch_cache_dir, model_store_dir=None,
+                             low_memory=low_memory)
+
+
+def _evaluate_pipeline(X_data, labels, folds, pipeline, estimator, sfreq):
+    """
+    Cross-validate one pipeline on the epochs of one recording.
+
+    :param X_data: (n_epochs, n_channels, n_times) array
+    :param labels: (n_epochs,) array
+    :param folds: list of (train_idx, test_idx)
+    :param pipeline: Pre-defined pipeline number, see build_rg_pipeline
+    :param estimator: Covariance estimator
+    :param sfreq: Sampling frequency of the epochs
+    :return: dict with the measured RESULT_FIELDS entries
+    """
+    uses_cache = isinstance(build_rg_pipeline(pipeline, estimator, sfreq=sfreq).steps[0][1], CachedCovariances)
+
+    correct = 0
+    fit_times = []
+    cached_fit_times = []
+    latencies = []
+    for train_idx, test_idx in folds:
+        # Timed as on the Pi, every covariance is estimated
+        clf = build_rg_pipeline(pipeline, estimator, sfreq=sfreq)
+        with cache_bypassed():
+            tstart = time.perf_counter()
+            clf.fit(X_data[train_idx], labels[train_idx])
+            fit_times.append(time.perf_counter() - tstart)
+
+        if uses_cache:
+            cached_clf = build_rg_pipeline(pipeline, estimator, sfreq=sfreq)
+            tstart = time.perf_counter()
+            cached_clf.fit(X_data[train_idx], labels[train_idx])
+            cached_fit_times.append(time.perf_counter() - tstart)
+        else:
+            cached_fit_times.append(fit_times[-1])
+
+        preds, fold_latencies = time_predictions(clf, X_data[test_idx])
+        latencies.extend(fold_latencies)
+        correct += np.sum(preds == labels[test_idx])
+
+    # tracemalloc slows down every allocation, so memory is measured in a separate untimed pass.
+    # The covariances of these epochs are cached, they are estimated again as on the Pi
+    train_idx, test_idx = folds[0]
+    with cache_bypassed():
+        tracemalloc.start()
+        clf = build_rg_pipeline(pipeline, estimator, sfreq=sfreq)
+        clf.fit(X_data[train_idx], labels[train_idx])
+        for indx in test_idx:
+            clf.predict(X_data[indx:indx + 1])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies_ms = np.array(latencies) * 1000
+    return dict(accuracy=float(correct / len(labels)), fit_time_s=float(np.mean(fit_times)),
+                cached_fit_time_s=float(np.mean(cached_fit_times)),
+                predict_latency_ms_p50=float(np.percentile(latencies_ms, 50)),
+                predict_latency_ms_p95=float(np.percentile(latencies_ms, 95)),
+                peak_memory_mb=peak / 1024 ** 2)
+
+
+def run_benchmark_job(subj, trial, pipelines, estimator, n_folds=4, random_state=42):
+    """
+    Evaluate every pipeline with one estimator on one recording. Runs in a worker
+    process set up by _init_worker, the epochs are read (memory mapped) from the
+    epoch cache and their covariances are estimated once for all pipelines and folds.
+
+    :param subj: Subject number, index into ReadEEG.subj_list
+    :param trial: Trial number of the subject
+    :param pipelines: Pre-defined pipeline numbers, see build_rg_pipeline
+    :param estimator: Covariance estimator
+    :param n_folds: Number of stratified cross-validation folds
+    :param random_state: Seed of the fold split
+    :return: list of dicts, one per pipeline, with one value per RESULT_FIELDS entry
+    """
+    results = [dict(subject=subj, trial=trial, pipeline=pipeline, estimator=estimator,
+                    n_epochs=0, accuracy=np.nan, fit_time_s=np.nan, cached_fit_time_s=np.nan,
+                    predict_latency_ms_p50=np.nan, predict_latency_ms_p95=np.nan, peak_memory_mb=np.nan,
+                    error='') for pipeline in pipelines]
+    try:
+        epochs = _worker_reader.get_epochs(subj, trial)
+        X_data = epochs.get_data()
+        labels = epochs.events[:, -1]
+        cv_strat = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=random_state)
+        folds = list(cv_strat.split(X_data, labels))
+        precompute_covariances(X_data, estimator)
+    except Exception as err:
+        for result in results:
+            result['error'] = type(err).__name__ + ': ' + str(err)
+        return results
+
+    for result in results:
+        result['n_epochs'] = len(labels)
+        try:
+            result.update(_evaluate_pipeline(X_data, labels, folds, result['pipeline'], estimator,
+                                             epochs.info['sfreq']))
+        except Exception as err:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            result['error'] = type(err).__name__ + ': ' + str(err)
+
+    return results
+
+
+def summarize(results, latency_budget_ms=None):
+    """
+    Summarize the benchmark per pipeline and estimator.
+
+    :param results: list of result dicts from run_benchmark_job
+    :param latency_budget_ms: Optional 95th percentile latency budget in milliseconds
+    :return: list of dicts, sorted by mean accuracy (best first)
+    """
+    summary = []
+    keyfunc = lambda row: (row['pipeline'], row['estimator'])
+    for (pipeline, estimator), rows in itertools.groupby(sorted(results, key=keyfunc), key=keyfunc):
+        rows = list(rows)
+        valid = [row for row in rows if not row['error']]
+        entry = dict(pipeline=pipeline, estimator=estimator, recordings=len(valid), failed=len(rows) - len(valid))
+        if valid:
+            entry.update(mean_accuracy=float(np.mean([row['accuracy'] for row in valid])),
+                         mean_fit_time_s=float(np.mean([row['fit_time_s'] for row in valid])),
+                         mean_cached_fit_time_s=float(np.mean([row['cached_fit_time_s'] for row in valid])),
+                         p50_latency_ms=float(np.median([row['predict_latency_ms_p50'] for row in valid])),
+                         worst_p95_latency_ms=float(np.max([row['predict_latency_ms_p95'] for row in valid])),
+                         peak_memory_mb=float(np.max([row['peak_memory_mb'] for row in valid])))
+            if latency_budget_ms is not None:
+                entry['within_budget'] = bool(entry['worst_p95_latency_ms'] <= latency_budget_ms)
+        summary.append(entry)
+
+    return sorted(summary, key=lambda entry: -entry.get('mean_accuracy', -1))
+
+
+def format_report(summary, latency_budget_ms=None):
+    """
+    :param summary: Output of summarize
+    :param latency_budget_ms: Latency budget used for the summary, if any
+    :return: str, human readable report
+    """
+    lines = ['Pipeline benchmark summary (sorted by mean accuracy)']
+    if latency_budget_ms is not None:
+        lines.append('Latency budget: ' + str(latency_budget_ms) + ' ms (95th percentile per epoch)')
+    lines.append(f'{"pipeline":>8} {"estimator":>9} {"acc":>6} {"fit s":>7} {"cfit s":>7} {"p50 ms":>7} '
+                 f'{"p95 ms":>7} {"mem MB":>7} {"n":>3} {"budget":>6}')
+    for entry in summary:
+        if entry['recordings'] == 0:
+            lines.append(f'{entry["pipeline"]:>8} {entry["estimator"]:>9}   all {entry["failed"]} jobs failed')
+            continue
+        budget = ''
+        if 'within_budget' in entry:
+            budget = 'ok' if entry['within_budget'] else 'over'
+        lines.append(f'{entry["pipeline"]:>8} {entry["estimator"]:>9} {entry["mean_accuracy"]:6.3f} '
+                     f'{entry["mean_fit_time_s"]:7.3f} {entry["mean_cached_fit_time_s"]:7.3f} '
+                     f'{entry["p50_latency_ms"]:7.2f} '
+                     f'{entry["worst_p95_latency_ms"]:7.2f} {entry["peak_memory_mb"]:7.1f} '
+                     f'{entry["recordings"]:>3} {budget:>6}')
+
+    best = [entry for entry in summary if entry.get('within_budget', entry['recordings'] > 0)]
+    if best:
+        lines.append('Best: pipeline ' + str(best[0]['pipeline']) + ' with ' + best[0]['estimator'])
+    return '\n'.join(lines)
+
+
+def run_benchmark(data_dir, pipelines=(0, 1, 2, 3), estimators=('lwf', 'oas', 'scm'), subjects=None,
+                  n_folds=4, max_workers=None, out_dir='benchmark_results', latency_budget_ms=None,
+                  epoch_cache_dir=os.path.join(os.path.expanduser('~'), '.bci_stimulus', 'epoch_cache'),
+                  low_memory=False):
+    """
+    Run the whole benchmark matrix and write results.csv, results.json and summary.txt.
+
+    :param data_dir: Directory of the SSVEP exoskeleton dataset
+    :param pipelines: Pipeline numbers to evaluate
+    :param estimators: Covariance estimators to evaluate
+    :param subjects: Subject numbers to evaluate, None for all of ReadEEG.subj_list
+    :param n_folds: Number of stratified cross-validation folds
+    :param max_workers: Size of the process pool, None for the number of cores
+    :param out_dir: Directory for the output files
+    :param latency_budget_ms: Optional 95th percentile latency budget in milliseconds
+    :param epoch_cache_dir: Epoch cache shared by all workers
+    :param low_memory: Build the epochs from event windows only instead of loading whole recordings
+    :return: tuple (results, summary)
+    """
+    reader = ReadEEG(data_dir, epoch_cache_dir=epoch_cache_dir, model_store_dir=None, low_memory=low_memory)
+    recordings = preprocess_recordings(reader, subjects)
+
+    # Every pipeline of a recording and estimator runs in one job, sharing the covariances
+    jobs = [(subj, trial, estimator) for subj, trial in recordings for estimator in estimators]
+    print('...Running ' + str(len(jobs)) + ' benchmark jobs of ' + str(len(pipelines)) + ' pipelines...')
+
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(data_dir, epoch_cache_dir, low_memory)) as pool:
+        futures = [pool.submit(run_benchmark_job, subj, trial, pipelines, estimator, n_folds)
+                   for subj, trial, estimator in jobs]
+        for future in futures:
+            results.extend(future.result())
+
+    summary = summarize(results, latency_budget_ms)
+    report = format_report(summary, latency_budget_ms)
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, 'results.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    with open(os.path.join(out_dir, 'results.json'), 'w') as f:
+        json.dump(dict(results=json_safe(results), summary=json_safe(summary)), f, indent=2, default=float,
+                  allow_nan=False)
+    with open(os.path.join(out_dir, 'summary.txt'), 'w') as f:
+        f.write(report + '\n')
+
+    print(report)
+    return results, summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the RG pipelines over all subjects and trials')
+    parser.add_argument('--data-dir', required=True, help='Directory of the SSVEP exoskeleton dataset')
+    parser.add_argument('--pipelines', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('--estimators', nargs='+', default=['lwf', 'oas', 'scm'])
+    parser.add_argument('--subjects', type=int, nargs='+', default=None, help='Subject numbers, default all')
+    parser.add_argument('--folds', type=int, default=4, help='Number of cross-validation folds')
+    parser.add_argument('--workers', type=int, default=None, help='Process pool size, default all cores')
+    parser.add_argument('--out-dir', default='benchmark_results')
+    parser.add_argument('--latency-budget', type=float, default=None,
+                        help='95th percentile per-epoch latency budget in ms')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='Read only the event windows of each recording instead of loading it')
+    args = parser.parse_args()
+
+    run_benchmark(args.data_dir, args.pipelines, args.estimators, args.subjects, args.folds,
+                  args.workers, args.out_dir, args.latency_budget, low_memory=args.low_memory)
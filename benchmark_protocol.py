@@ -0,0 +1,121 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Wire time benchmark of the text and binary serial command protocols.
+
+For every message type the encoded size and the time it occupies the wire at
+the given baud rate are compared (10 bits per byte: start, 8 data bits, stop),
+together with the time the computer needs to encode it and to decode the
+device's echo of it. With --port the messages are also written to a real port
+and the time until write + flush returns is measured.
+
+Example:
+    python3 benchmark_protocol.py --baud 9600 --port /dev/ttyACM0
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from serial_protocol import PROTOCOLS, OP_TELEMETRY, TELEMETRY_ECHO, encode_frame
+
+# Stimulus of the default SSVEP classes (13, 17, 21 Hz) plus an idle LED, and of all 16 LED pins
+STIMULUS_4 = ([23, 25, 27, 29], [13, 17, 21, 9], [0, 90, 180, 270])
+STIMULUS_16 = ([23 + 2 * i for i in range(16)], [8 + i for i in range(16)], [90 * (i % 4) for i in range(16)])
+
+# Message name -> protocol method and its arguments
+MESSAGES = {'drive change': ('drive', ('nn',)),
+            'stimulus, 4 LEDs': ('stimulus', STIMULUS_4),
+            'stimulus, 16 LEDs': ('stimulus', STIMULUS_16)}
+
+
+def device_echo(protocol_name, message):
+    """
+    :param protocol_name: 'text' or 'binary'
+    :param message: Encoded message as written by the computer
+    :return: bytes, what the firmware sends back for it
+    """
+    if protocol_name == 'text':
+        return b''.join(b'data is: ' + line + b'\r\n' for line in message.split(b'\n') if line)
+    # Echo telemetry: kind, header and payload of the received frame
+    return encode_frame(OP_TELEMETRY, bytes((TELEMETRY_ECHO,)) + message[1:-1])
+
+
+def time_call(function, repeat):
+    """
+    :return: float, median time of one call in microseconds
+    """
+    times = np.empty(repeat)
+    for indx in range(repeat):
+        tstart = time.perf_counter()
+        function()
+        times[indx] = time.perf_counter() - tstart
+    return float(np.median(times) * 1e6)
+
+
+def run_benchmark(baud=9600, repeat=2000, port=None):
+    """
+    :param baud: Baud rate of the serial connection
+    :param repeat: Repetitions of every timed encode/decode/write
+    :param port: Optional serial port to measure the real write time on
+    :return: list of dicts, one per protocol and message
+    """
+    ser = None
+    if port is not None:
+        import serial
+        ser = serial.Serial(port, baud, timeout=1)
+
+    results = []
+    for name, protocol in PROTOCOLS.items():
+        for message_name, (method, method_args) in MESSAGES.items():
+            encode = getattr(protocol, method)
+            message = encode(*method_args)
+            echo = device_echo(name, message)
+            result = dict(protocol=name, message=message_name, bytes=len(message),
+                          wire_ms=len(message) * 10 / baud * 1000,
+                          encode_us=time_call(lambda: encode(*method_args), repeat),
+                          decode_us=time_call(lambda: protocol.reader().feed(echo), repeat))
+            if ser is not None:
+                def write():
+                    ser.write(message)
+                    ser.flush()
+                result['write_ms'] = time_call(write, min(repeat, 20)) / 1000
+            results.append(result)
+
+    if ser is not None:
+        ser.close()
+    return results
+
+
+def format_results(results):
+    """
+    :param results: Output of run_benchmark
+    :return: str, table with the saving of the binary protocol per message
+    """
+    has_write = 'write_ms' in results[0]
+    lines = [f'{"protocol":>8} {"message":>18} {"bytes":>6} {"wire ms":>8} {"encode us":>10} {"decode us":>10}' +
+             (f' {"write ms":>9}' if has_write else '')]
+    for result in results:
+        lines.append(f'{result["protocol"]:>8} {result["message"]:>18} {result["bytes"]:>6} '
+                     f'{result["wire_ms"]:8.2f} {result["encode_us"]:10.2f} {result["decode_us"]:10.2f}' +
+                     (f' {result["write_ms"]:9.2f}' if has_write else ''))
+
+    text = {result['message']: result for result in results if result['protocol'] == 'text'}
+    for result in results:
+        if result['protocol'] == 'binary':
+            lines.append('...' + result['message'] + ': binary saves ' +
+                         f'{text[result["message"]]["wire_ms"] - result["wire_ms"]:.2f}' + ' ms of wire time (' +
+                         f'{1 - result["bytes"] / text[result["message"]]["bytes"]:.0%}' + ')...')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the text and binary serial protocols')
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--repeat', type=int, default=2000, help='Repetitions of every timed call')
+    parser.add_argument('--port', default=None, help='Serial port to measure real write times on')
+    args = parser.parse_args()
+
+    print(format_results(run_benchmark(args.baud, args.repeat, args.port)))
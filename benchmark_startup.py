@@ -0,0 +1,89 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Startup time benchmark for the control scripts.
+
+Every module is imported in a fresh interpreter (so nothing is cached in
+sys.modules) a number of times, and the median import time is reported together
+with the heavy scientific packages it pulled in. The keyboard path
+(control_methods) must not load the EEG stack; use --budget to fail when it
+takes longer than the given time, e.g. on the Raspberry Pi.
+
+Example:
+    python3 benchmark_startup.py --repeat 5 --budget 1.5
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+# Packages only needed by the EEG path
+HEAVY_MODULES = ['mne', 'sklearn', 'pyriemann', 'matplotlib', 'pylsl', 'scipy']
+
+# Run in the child interpreter, prints the import time and the heavy modules loaded
+_CHILD_CODE = """
+import json, sys, time
+tstart = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - tstart
+print(json.dumps(dict(time=elapsed, heavy=[name for name in {heavy!r} if name in sys.modules])))
+"""
+
+
+def time_import(module, repeat=5):
+    """
+    Import a module in fresh interpreters.
+
+    :param module: Module name, run from this directory
+    :param repeat: Number of interpreters to start
+    :return: dict with module, median_s, min_s, max_s, heavy (list of heavy packages loaded) and error
+    """
+    times = []
+    heavy = []
+    code = _CHILD_CODE.format(module=module, heavy=HEAVY_MODULES)
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'exit code ' + str(proc.returncode)
+            return dict(module=module, error=error)
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        times.append(result['time'])
+        heavy = result['heavy']
+
+    return dict(module=module, median_s=float(np.median(times)), min_s=float(np.min(times)),
+                max_s=float(np.max(times)), heavy=heavy, error='')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the import time of the control scripts')
+    parser.add_argument('--modules', nargs='+', default=['control_methods', 'set_frequencies', 'eeg_input'])
+    parser.add_argument('--repeat', type=int, default=5, help='Number of fresh interpreters per module')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Maximum median import time of control_methods in seconds')
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        result = time_import(module, args.repeat)
+        if result['error']:
+            print(f'{module:>16}: failed ({result["error"]})')
+            failed |= module == 'control_methods'
+            continue
+        print(f'{module:>16}: median {result["median_s"]:.3f} s (min {result["min_s"]:.3f}, '
+              f'max {result["max_s"]:.3f}), heavy modules: {", ".join(result["heavy"]) or "none"}')
+
+        if module == 'control_methods':
+            if result['heavy']:
+                print('...WARNING: the keyboard path loads ' + ', '.join(result['heavy']) + '...')
+                failed = True
+            if args.budget is not None and result['median_s'] > args.budget:
+                print('...WARNING: control_methods is over the ' + str(args.budget) + ' s budget...')
+                failed = True
+
+    sys.exit(1 if failed else 0)
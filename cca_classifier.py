@@ -0,0 +1,168 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Training-free SSVEP classifier based on canonical correlation analysis (CCA).
+
+Each epoch is compared with sine/cosine references (plus harmonics) of every
+stimulus frequency. The class whose references have the largest canonical
+correlation with the epoch is predicted, or the rest class if no correlation
+reaches the rest threshold. No calibration recording is needed.
+
+The canonical correlations between an epoch X and references Y are the singular
+values of Qx^T Qy, where Qx and Qy are orthonormal bases of the centred signals.
+The reference bases (QR decompositions) only depend on the epoch length, so they
+are computed once and reused. For the epochs, Qx^T Qy = L^-1 X Qy with L the
+Cholesky factor of X X^T, which avoids a QR decomposition of every
+(n_times, n_channels) epoch. A small ridge keeps X X^T positive definite when a
+channel is flat or duplicated (e.g. a disconnected electrode), and an epoch
+with every channel flat gets zero correlations, i.e. the rest class. A whole
+batch of epochs is scored with a few batched NumPy calls.
+"""
+
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+# Class label -> stimulus frequency in Hz, matches event_id in ReadEEG (stim13=2, stim17=3, stim21=4)
+DEFAULT_STIM_FREQS = {2: 13, 3: 17, 4: 21}
+
+# Ridge added to X X^T, relative to its mean diagonal
+WHITENING_RIDGE = 1e-6
+
+
+class CCAClassifier(BaseEstimator, ClassifierMixin):
+    """
+    SSVEP classifier using canonical correlation with sine/cosine references.
+
+    Attributes:
+    --------------------
+    classes_: np.ndarray
+        Rest label followed by the stimulus labels
+
+    Methods:
+    --------------------
+    fit(X=None, y=None)
+        No training needed, only sets classes_
+    decision_function(X)
+        Largest canonical correlation with each stimulus frequency
+    predict(X)
+        Class with the largest correlation, or rest below the threshold
+    predict_proba(X)
+        Softmax of the correlations, with the rest threshold as the rest score
+    """
+
+    def __init__(self, sfreq=None, stim_freqs=None, n_harmonics=2,
+                 rest_label=1, rest_threshold=0.3, temperature=0.05):
+        """
+        :param sfreq: Sampling frequency of the epochs in Hz
+        :param stim_freqs: dict of class label -> stimulus frequency in Hz, None for
+                           DEFAULT_STIM_FREQS
+        :param n_harmonics: Number of harmonics in the references (1 is the fundamental only)
+        :param rest_label: Label predicted when no correlation reaches rest_threshold
+        :param rest_threshold: Minimum canonical correlation for a stimulus decision
+        :param temperature: Softmax temperature used by predict_proba
+        """
+        self.sfreq = sfreq
+        self.stim_freqs = stim_freqs
+        self.n_harmonics = n_harmonics
+        self.rest_label = rest_label
+        self.rest_threshold = rest_threshold
+        self.temperature = temperature
+
+    def fit(self, X=None, y=None):
+        """
+        Nothing is learned from the data, X and y are ignored.
+        :return: self
+        """
+        self.stim_freqs_ = dict(DEFAULT_STIM_FREQS if self.stim_freqs is None else self.stim_freqs)
+        self.stim_labels_ = np.array(sorted(self.stim_freqs_))
+        self.classes_ = np.concatenate(([self.rest_label], self.stim_labels_))
+        self._reference_bases = {}
+        return self
+
+    def __reference_bases(self, n_times):
+        """
+        Orthonormal bases of the centred references for an epoch length,
+        computed once per length and sampling frequency (sfreq may be set after fitting).
+
+        :param n_times: Number of samples per epoch
+        :return: (n_freqs, n_times, 2 * n_harmonics) array
+        """
+        bases = self._reference_bases.get((n_times, self.sfreq))
+        if bases is None:
+            if self.sfreq is None:
+                raise ValueError('CCAClassifier needs the sampling frequency (sfreq) of the epochs')
+            times = np.arange(n_times) / self.sfreq
+            references = []
+            for label in self.stim_labels_:
+                harmonics = []
+                for harmonic in range(1, self.n_harmonics + 1):
+                    freq = harmonic * self.stim_freqs_[label]
+                    if freq >= self.sfreq / 2:
+                        break
+                    harmonics += [np.sin(2 * np.pi * freq * times), np.cos(2 * np.pi * freq * times)]
+                # Pad with zeros so every frequency has the same number of columns
+                while len(harmonics) < 2 * self.n_harmonics:
+                    harmonics.append(np.zeros(n_times))
+                references.append(np.stack(harmonics, axis=1))
+            references = np.stack(references)
+            references -= references.mean(axis=1, keepdims=True)
+            bases = np.linalg.qr(references)[0]
+            self._reference_bases[(n_times, self.sfreq)] = bases
+        return bases
+
+    def decision_function(self, X):
+        """
+        Largest canonical correlation of every epoch with the references of every
+        stimulus frequency.
+
+        :param X: (n_epochs, n_channels, n_times) array
+        :return: (n_epochs, n_freqs) array, columns ordered as stim_labels_
+        """
+        if not hasattr(self, 'classes_'):
+            self.fit()
+        X = np.asarray(X, dtype=float)
+        reference_bases = self.__reference_bases(X.shape[-1])
+
+        epochs = X - X.mean(axis=-1, keepdims=True)
+        gram = epochs @ np.swapaxes(epochs, 1, 2)
+        n_channels = gram.shape[-1]
+        ridge = WHITENING_RIDGE * np.trace(gram, axis1=1, axis2=2) / n_channels
+        # Every channel flat: nothing to correlate, whiten with the identity instead
+        flat = ~(ridge > 0)
+        gram[flat] = np.eye(n_channels)
+        ridge[flat] = 0
+        chol = np.linalg.cholesky(gram + ridge[:, np.newaxis, np.newaxis] * np.eye(n_channels))
+
+        # (n_epochs, n_freqs, n_channels, 2 * n_harmonics) projections onto the references
+        projections = np.matmul(epochs[:, np.newaxis], reference_bases[np.newaxis])
+        # Canonical correlations are the singular values of L^-1 X Qy (= Qx^T Qy)
+        products = np.linalg.solve(chol[:, np.newaxis], projections)
+        correlations = np.linalg.svd(products, compute_uv=False)[..., 0]
+        correlations[flat] = 0
+        return correlations
+
+    def predict(self, X):
+        """
+        :param X: (n_epochs, n_channels, n_times) array
+        :return: (n_epochs,) array of class labels
+        """
+        correlations = self.decision_function(X)
+        best = np.argmax(correlations, axis=1)
+        predicted = self.stim_labels_[best]
+        predicted[correlations[np.arange(len(best)), best] < self.rest_threshold] = self.rest_label
+        return predicted
+
+    def predict_proba(self, X):
+        """
+        Softmax over the rest threshold (rest class) and the correlations of each
+        stimulus frequency, ordered as classes_.
+
+        :param X: (n_epochs, n_channels, n_times) array
+        :return: (n_epochs, n_classes) array
+        """
+        correlations = self.decision_function(X)
+        scores = np.concatenate((np.full((correlations.shape[0], 1), self.rest_threshold), correlations), axis=1)
+        scores = (scores - scores.max(axis=1, keepdims=True)) / self.temperature
+        proba = np.exp(scores)
+        return proba / proba.sum(axis=1, keepdims=True)
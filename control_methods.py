@@ -7,22 +7,60 @@
 # Imports for keyboard monitoring and display
 from pynput.keyboard import Key, Listener
 import pygame
+import argparse
+import queue
+import threading
 import time
 import tkinter as tk
 from tkinter import ttk
 
-# Communication Imports
-import serial
+# Communication Imports, the port may be shared through serial_daemon.py (BCI_SERIAL_PORT=unix:<socket>)
+from serial_daemon import open_port
+
+# Per-stage timing histograms
+from stage_timer import StageTimer
+
+# Serial writes happen on a writer thread, not in the pygame loop
+from serial_writer import SerialCommandWriter
+from serial_protocol import PROTOCOLS, serial_port
+
+# Button bitmask and its state -> (command, arrow) table
+from drive_state import STATE_TABLE, DriveState, key_bit
 
 # Exit condition events
 from pygame.locals import (
     K_ESCAPE,
     KEYDOWN,
     QUIT,
+    VIDEOEXPOSE,
 )
 
-# import EEG Data Class
-from eeg_input import ReadEEG
+# The EEG Data Class (eeg_input) pulls in mne, sklearn, pyriemann, matplotlib
+# and pylsl, which takes seconds on the Raspberry Pi. It is only imported once
+# the EEG path is chosen, see load_eeg_input.
+_eeg_preload_thread = None
+
+
+def preload_eeg_input():
+    """
+    Starts importing eeg_input on a background thread, e.g. while the Tk selector
+    is open. Calling it again does nothing.
+    :return: threading.Thread doing the import
+    """
+    global _eeg_preload_thread
+    if _eeg_preload_thread is None:
+        _eeg_preload_thread = threading.Thread(target=load_eeg_input, name='eeg_input preload', daemon=True)
+        _eeg_preload_thread.start()
+    return _eeg_preload_thread
+
+
+def load_eeg_input():
+    """
+    Imports eeg_input, waits for a running preload to finish instead of importing twice
+    :return: eeg_input module
+    """
+    import eeg_input
+    return eeg_input
 
 
 class CommunicationSelection(ttk.Frame):
@@ -86,7 +124,13 @@ class RemoteControl:
     Attributes:
     --------------------
     SCREEN_HEIGHT: int \n
-    SCREEN_WIDTH: int
+    SCREEN_WIDTH: int \n
+    render_mode: str
+        'cached' draws only the arrows that changed, 'full' redraws the whole window every frame
+    render_stats: dict
+        Frames, display updates and CPU use of the last begin_control
+    dispatch_mode: str
+        'event' sends commands from the key listener thread, 'poll' from the pygame loop once per frame
 
     Methods:
     --------------------
@@ -94,7 +138,40 @@ class RemoteControl:
         Starts pygame screen and sends corresponding information via serial stream
     """
 
-    def __init__(self):
+    # Drive direction -> arrow position
+    ARROWS = {'nn': (187, 75),
+              'ss': (187, 325),
+              'ww': (24, 200),
+              'ee': (350, 200),
+              'se': (350, 325),
+              'sw': (24, 325),
+              'ne': (350, 75),
+              'nw': (24, 75)}
+
+    BACKGROUND = (255, 255, 255)
+
+    RENDER_MODES = ('cached', 'full')
+
+    DISPATCH_MODES = ('event', 'poll')
+
+    def __init__(self, ser, timing=True, protocol='text', render_mode='cached', dispatch_mode='event'):
+        """
+        :param ser: Serial object connected to a specific serial port
+        :param timing: Time the serial writes and the key to wire latency, the statistics are
+                       printed when control ends
+        :param protocol: 'text' or 'binary' command protocol, must match the firmware
+        :param render_mode: 'cached' or 'full', see render_mode
+        :param dispatch_mode: 'event' or 'poll', see dispatch_mode
+        """
+        if render_mode not in self.RENDER_MODES:
+            raise ValueError('Unknown render mode ' + repr(render_mode) + ', choose one of ' +
+                             ', '.join(self.RENDER_MODES))
+        if dispatch_mode not in self.DISPATCH_MODES:
+            raise ValueError('Unknown dispatch mode ' + repr(dispatch_mode) + ', choose one of ' +
+                             ', '.join(self.DISPATCH_MODES))
+        self.render_mode = render_mode
+        self.dispatch_mode = dispatch_mode
+        self.render_stats = None
         pygame.init()
         pygame.display.set_caption('Wheelchair Control')
 
@@ -102,144 +179,153 @@ class RemoteControl:
         self.SCREEN_WIDTH = 500
         self.SCREEN_HEIGHT = 500
 
-        # Create array for button state:[<forwards>, <backwards>, <left>, <right>]
-        self._buttons_pressed = [False, False, False, False]
+        # Bitmask of the pressed buttons, see drive_state
+        self._drive_state = DriveState()
+        # Time of the last key event that changed the buttons
+        self._key_time = None
+        # Arrows to draw, from the key listener to the pygame loop (event dispatch)
+        self._render_queue = queue.Queue()
 
         self._last_direction = "00"
 
+        self.timer = StageTimer(enabled=timing)
+
+        # Direction changes are handed to the writer thread, a newer one replaces an unsent one
+        self._writer = SerialCommandWriter(ser, timer=self.timer, protocol=protocol)
+
         # Begin pygame screen
         self._screen = pygame.display.set_mode((self.SCREEN_WIDTH, self.SCREEN_HEIGHT))
 
     def __on_press(self, key):
         """
-        If button if pressed on keyboard, function will update button_pressed list
+        If button if pressed on keyboard, function will update the button state
 
         :param key: Key Object from pynput.keyboard library
         :return: None
         """
-
-        if key == Key.up:
-            self._buttons_pressed[0] = True
-        try:
-            if key.char == 'w':
-                self._buttons_pressed[0] = True
-        except AttributeError:
-            pass
-
-        if key == Key.down:
-            self._buttons_pressed[1] = True
-        try:
-            if key.char == 's':
-                self._buttons_pressed[1] = True
-        except AttributeError:
-            pass
-
-        if key == Key.left:
-            self._buttons_pressed[2] = True
-        try:
-            if key.char == 'a':
-                self._buttons_pressed[2] = True
-        except AttributeError:
-            pass
-
-        if key == Key.right:
-            self._buttons_pressed[3] = True
-        try:
-            if key.char == 'd':
-                self._buttons_pressed[3] = True
-        except AttributeError:
-            pass
+        self.__on_key(key, True)
 
     def __on_release(self, key):
         """
-        When button is released on keyboard, function will update button_pressed list
+        When button is released on keyboard, function will update the button state
+
+        :param key: Key Object from pynput.keyboard library
+        :return: None
+        """
+        self.__on_key(key, False)
+
+    def __on_key(self, key, pressed):
+        """
+        Updates the button bitmask. In event dispatch mode the command is sent
+        right away from the listener thread and the arrow to draw is queued for
+        the pygame loop.
 
         :param key: Key Object from pynput.keyboard library
+        :param pressed: True for a press, False for a release
         :return: None
         """
+        bit = key_bit(key.name if isinstance(key, Key) else getattr(key, 'char', None))
+        if bit is None:
+            return
+        key_time = time.perf_counter()
+        changed, state = self._drive_state.update(bit, pressed)
+        if not changed:
+            # Auto repeat of a held key
+            return
+        self._key_time = key_time
+
+        if self.dispatch_mode == 'event':
+            command, arrow = STATE_TABLE[state]
+            if command is not None:
+                self.__send_data(command, key_time)
+            self._render_queue.put(arrow)
+
+    def __load_arrows(self, convert):
+        """
+        Loads the arrow images
+
+        :param convert: Compose the images onto the background once and convert them to the
+                        display format, opaque surfaces in the display format blit fastest
+        :return: dict of direction -> [unpressed image, pressed image]
+        """
+        arrows = {}
+        for direction in self.ARROWS:
+            # Image files are named after the compass point, e.g. 'n' for 'nn'
+            name = direction[0] if direction[0] == direction[1] else direction
+            images = []
+            for state in ('unpressed', 'pressed'):
+                image = pygame.image.load("images/arrows/" + name + "_" + state + ".png")
+                if convert:
+                    opaque = pygame.Surface(image.get_size()).convert()
+                    opaque.fill(self.BACKGROUND)
+                    opaque.blit(image.convert_alpha(), (0, 0))
+                    image = opaque
+                images.append(image)
+            arrows[direction] = images
+        return arrows
+
+    def __render_text(self):
+        """
+        Renders the title and instructions
+        :return: list of (surface, rect)
+        """
+        large_font = pygame.font.Font('freesansbold.ttf', 45)
+        title = large_font.render('Wheelchair Control', True, (0, 0, 0))
+        title_rect = title.get_rect()
+        title_rect.center = (250, 50)
+
+        body_font = pygame.font.Font('freesansbold.ttf', 12)
+        instructions = body_font.render("Use WASD or Arrows to control device manually", True, (0, 0, 0))
+        instructions_rect = instructions.get_rect()
+        instructions_rect.center = (250, 475)
+        return [(title, title_rect), (instructions, instructions_rect)]
+
+    def __draw_screen(self, text, arrows, pressed):
+        """
+        Draws the whole window, the display is not updated
 
-        if key == Key.up:
-            self._buttons_pressed[0] = False
-        try:
-            if key.char == 'w':
-                self._buttons_pressed[0] = False
-        except AttributeError:
-            pass
-
-        if key == Key.down:
-            self._buttons_pressed[1] = False
-        try:
-            if key.char == 's':
-                self._buttons_pressed[1] = False
-        except AttributeError:
-            pass
-
-        if key == Key.left:
-            self._buttons_pressed[2] = False
-        try:
-            if key.char == 'a':
-                self._buttons_pressed[2] = False
-        except AttributeError:
-            pass
-
-        if key == Key.right:
-            self._buttons_pressed[3] = False
-        try:
-            if key.char == 'd':
-                self._buttons_pressed[3] = False
-        except AttributeError:
-            pass
+        :param text: Output of __render_text
+        :param arrows: Output of __load_arrows
+        :param pressed: Direction whose arrow is drawn pressed, or None
+        :return: None
+        """
+        self._screen.fill(self.BACKGROUND)
+        for surface, rect in text:
+            self._screen.blit(surface, rect)
+        for direction, position in self.ARROWS.items():
+            self._screen.blit(arrows[direction][direction == pressed], position)
 
     def begin_control(self):
         """
-        Begins pygame terminal to send data to Arduino via serial stream
+        Begins pygame terminal to send data to Arduino via serial stream.
+        The CPU use of the rendering mode is printed and kept in render_stats.
         :return: Nothing
         """
         running = True
         clock = pygame.time.Clock()
+        cached = self.render_mode == 'cached'
 
         # import button images
-        north_arrow_unpressed = pygame.image.load("images/arrows/n_unpressed.png")
-        north_east_arrow_unpressed = pygame.image.load("images/arrows/ne_unpressed.png")
-        north_west_arrow_unpressed = pygame.image.load("images/arrows/nw_unpressed.png")
-        south_arrow_unpressed = pygame.image.load("images/arrows/s_unpressed.png")
-        south_east_arrow_unpressed = pygame.image.load("images/arrows/se_unpressed.png")
-        south_west_arrow_unpressed = pygame.image.load("images/arrows/sw_unpressed.png")
-        west_arrow_unpressed = pygame.image.load("images/arrows/w_unpressed.png")
-        east_arrow_unpressed = pygame.image.load("images/arrows/e_unpressed.png")
-
-        north_arrow_pressed = pygame.image.load("images/arrows/n_pressed.png")
-        north_east_arrow_pressed = pygame.image.load("images/arrows/ne_pressed.png")
-        north_west_arrow_pressed = pygame.image.load("images/arrows/nw_pressed.png")
-        south_arrow_pressed = pygame.image.load("images/arrows/s_pressed.png")
-        south_east_arrow_pressed = pygame.image.load("images/arrows/se_pressed.png")
-        south_west_arrow_pressed = pygame.image.load("images/arrows/sw_pressed.png")
-        west_arrow_pressed = pygame.image.load("images/arrows/w_pressed.png")
-        east_arrow_pressed = pygame.image.load("images/arrows/e_pressed.png")
+        arrows = self.__load_arrows(convert=cached)
 
         # monitor the keyboard for controls
         listener = Listener(on_press=self.__on_press, on_release=self.__on_release)
         listener.start()
 
+        frames = 0
+        display_updates = 0
+        # Arrow drawn pressed on the screen (cached mode), None before the first frame
+        shown = None
+        pressed = None
+        redraw = True
+        if cached:
+            text = self.__render_text()
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+
         # begins main loop for pygame
         while running:
-            # Background color
-            self._screen.fill((255, 255, 255))
-
-            # Title
-            large_font = pygame.font.Font('freesansbold.ttf', 45)
-            title = large_font.render('Wheelchair Control', True, (0, 0, 0))
-            title_rect = title.get_rect()
-            title_rect.center = (250, 50)
-            self._screen.blit(title, title_rect)
-
-            # Instructions
-            body_font = pygame.font.Font('freesansbold.ttf', 12)
-            instructions = body_font.render("Use WASD or Arrows to control device manually", True, (0, 0, 0))
-            instructions_rect = instructions.get_rect()
-            instructions_rect.center = (250, 475)
-            self._screen.blit(instructions, instructions_rect)
-
             # Exit conditions
             for event in pygame.event.get():
                 if event.type == QUIT:
@@ -250,89 +336,99 @@ class RemoteControl:
                     if event.key == K_ESCAPE:
                         running = False
 
-                if event.type == QUIT:
-                    running = False
-
-            # Draws arrows corresponding to keyboard presses
-            # And sends data to arudino though bluetooth
-            if self._buttons_pressed == [True, False, False, False]:
-                self._screen.blit(north_arrow_pressed, (187, 75))  # display new image
-                self.__send_data('nn')  # send data
-            else:
-                self._screen.blit(north_arrow_unpressed, (187, 75))
-            if self._buttons_pressed == [False, True, False, False]:
-                self._screen.blit(south_arrow_pressed, (187, 325))
-                self.__send_data('ss')
-            else:
-                self._screen.blit(south_arrow_unpressed, (187, 325))
-            if self._buttons_pressed == [False, False, True, False]:
-                self._screen.blit(west_arrow_pressed, (24, 200))
-                self.__send_data('ww')
-            else:
-                self._screen.blit(west_arrow_unpressed, (24, 200))
-            if self._buttons_pressed == [False, False, False, True]:
-                self._screen.blit(east_arrow_pressed, (350, 200))
-                self.__send_data('ee')
+                elif event.type == VIDEOEXPOSE:
+                    # Window contents were lost (e.g. uncovered), draw everything again
+                    redraw = True
+
+            if self.dispatch_mode == 'event':
+                # Commands were already sent by the listener, only the latest arrow is drawn
+                while True:
+                    try:
+                        pressed = self._render_queue.get_nowait()
+                    except queue.Empty:
+                        break
             else:
-                self._screen.blit(east_arrow_unpressed, (350, 200))
-
-            if self._buttons_pressed == [False, True, False, True]:
-                self._screen.blit(south_east_arrow_pressed, (350, 325))
-                self.__send_data('se')
-            else:
-                self._screen.blit(south_east_arrow_unpressed, (350, 325))
-            if self._buttons_pressed == [False, True, True, False]:
-                self._screen.blit(south_west_arrow_pressed, (24, 325))
-                self.__send_data('sw')
-            else:
-                self._screen.blit(south_west_arrow_unpressed, (24, 325))
-            if self._buttons_pressed == [True, False, False, True]:
-                self._screen.blit(north_east_arrow_pressed, (350, 75))
-                self.__send_data('ne')
-            else:
-                self._screen.blit(north_east_arrow_unpressed, (350, 75))
-            if self._buttons_pressed == [True, False, True, False]:
-                self._screen.blit(north_west_arrow_pressed, (24, 75))
-                self.__send_data('nw')
-            else:
-                self._screen.blit(north_west_arrow_unpressed, (24, 75))
-            if self._buttons_pressed == [False, False, False, False]:
-                self.__send_data("00")
-                pass
-
-            # Updates pygame display
-            pygame.display.update()
+                command, pressed = STATE_TABLE[self._drive_state.state]
+                if command is not None:
+                    self.__send_data(command, self._key_time)
+
+            with self.timer.stage('render'):
+                if not cached:
+                    # Fonts, text and every arrow are rendered again each frame
+                    self.__draw_screen(self.__render_text(), arrows, pressed)
+                    pygame.display.update()
+                    display_updates += 1
+                elif redraw:
+                    self.__draw_screen(text, arrows, pressed)
+                    pygame.display.flip()
+                    display_updates += 1
+                    redraw = False
+                elif pressed != shown:
+                    # Only the arrows that changed state are drawn and updated
+                    dirty = [self._screen.blit(arrows[arrow][arrow == pressed], self.ARROWS[arrow])
+                             for arrow in (shown, pressed) if arrow is not None]
+                    pygame.display.update(dirty)
+                    display_updates += 1
+                shown = pressed
+
+            frames += 1
 
             # set FPS to 60
             clock.tick(60)
 
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        listener.stop()
+
         # program to stop motor!
         # exit if out of loop
         pygame.quit()
 
-    def __send_data(self, direction):
+        self.render_stats = dict(mode=self.render_mode, frames=frames, display_updates=display_updates,
+                                 wall_s=wall_time, cpu_s=cpu_time, cpu_percent=100 * cpu_time / max(wall_time, 1e-9))
+        print('...Rendering mode ' + self.render_mode + ': ' + f'{self.render_stats["cpu_percent"]:.1f}' +
+              '% CPU over ' + f'{wall_time:.1f}' + ' s, ' + str(frames) + ' frames, ' + str(display_updates) +
+              ' display updates...')
+
+        self._writer.close()
+        if self.timer.enabled:
+            print(self.timer.report())
+            print(self._writer.report())
+
+    def __send_data(self, direction, key_time=None):
         """
         Sends received data to serial stream, either bluetooth or cable.
+        The write happens on the writer thread, this never blocks the caller.
 
-        :param ser: Serial object connected to a specific serial port
         :param direction: Direction/data to be sent over serial data stream
+        :param key_time: perf_counter time of the key event, the time until the command is
+                         written is recorded as 'key_to_wire'
         :return: None
         """
         if self._last_direction != direction:
-            message = 'd/' + direction + '\n'
-
-            ser.flush()  # clear serial stream
-
-            # clear the last message
-            clear_msg = "d/00\n"
-            ser.write(clear_msg.encode('utf-8'))
-
-            ser.write(message.encode('utf-8'))  # write new direction
+            on_written = None
+            if key_time is not None:
+                def on_written():
+                    self.timer.record('key_to_wire', time.perf_counter() - key_time)
+            self._writer.send_direction(direction, on_written)
 
         self._last_direction = direction
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Select a control method and drive the wheelchair')
+    parser.add_argument('--preload-eeg', action='store_true',
+                        help='Import the EEG stack in the background while the selector is open')
+    parser.add_argument('--protocol', choices=sorted(PROTOCOLS), default='text',
+                        help='Serial command protocol, binary needs firmware built with BINARY_PROTOCOL')
+    parser.add_argument('--render', choices=RemoteControl.RENDER_MODES, default='cached',
+                        help='cached only redraws the arrows that changed, full redraws every frame')
+    parser.add_argument('--dispatch', choices=RemoteControl.DISPATCH_MODES, default='event',
+                        help='event sends commands from the key listener, poll once per frame')
+    args = parser.parse_args()
+    if args.preload_eeg:
+        preload_eeg_input()
+
     # communication method selection (bluetooth or cable)
     root = tk.Tk()
     coms = CommunicationSelection(root)
@@ -342,25 +438,28 @@ if __name__ == '__main__':
     # NOTE: Currently both bluetooth and eeg_trial communicate via the
     # bluetooth COM port.
     if coms.method == 'serial':
-        port = '/dev/ttyACM0'
-        ser = serial.Serial(port, 9600, timeout=1)
+        port = serial_port('/dev/ttyACM0')
+        ser = open_port(port, 9600, timeout=1)
         ser.flush()
-        wheelchair = RemoteControl()
+        wheelchair = RemoteControl(ser, protocol=args.protocol, render_mode=args.render,
+                                   dispatch_mode=args.dispatch)
         wheelchair.begin_control()
 
     if coms.method == "bluetooth":
-        port = 'COM8'
-        ser = serial.Serial(port, 9600, timeout=1)
+        port = serial_port('COM8')
+        ser = open_port(port, 9600, timeout=1)
         ser.flush()
-        wheelchair = RemoteControl()
+        wheelchair = RemoteControl(ser, protocol=args.protocol, render_mode=args.render,
+                                   dispatch_mode=args.dispatch)
         wheelchair.begin_control()
 
     if coms.method == 'eeg_trial':
-        port = 'COM8'
-        ser = serial.Serial(port, 9600, timeout=1)
+        port = serial_port('COM8')
+        ser = open_port(port, 9600, timeout=1)
         ser.flush()
 
-        test = ReadEEG()
+        print('...Loading EEG processing modules...')
+        test = load_eeg_input().ReadEEG(serial_protocol=args.protocol)
         test.simulate_SSVEP_pipeline(ser, train_subj=5, test_subj=5,
                                      simulate_online=True,
                                      trn_trial=0, tst_trial=1,
@@ -0,0 +1,230 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Memoized covariance estimation shared by the Riemannian Geometry pipelines.
+
+Pipelines 0, 1 and 3 all start by estimating one covariance matrix per epoch.
+During cross-validation and benchmarking the same epochs go through that stage
+for every fold and pipeline. CachedCovariances is a drop-in replacement for
+pyriemann.estimation.Covariances that serves the matrices from a process wide
+LRU cache keyed by (epoch fingerprint, estimator).
+
+precompute_covariances estimates the matrices of an epoch set once, before its
+folds and pipelines are fitted:
+    - ReadEEG's stratified validation fits its folds in threads of one process
+    - benchmark_pipelines.py runs every pipeline and fold of a recording and
+      estimator in one worker process
+The cache is not shared between processes.
+
+Only fitting (fit_transform, called by Pipeline.fit) uses the cache. transform
+(predict) always estimates, online windows are never seen again so they are not
+fingerprinted. Fit times that must match the Raspberry Pi are measured inside
+cache_bypassed.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+from pyriemann.utils.covariance import covariances
+
+
+class CovarianceCache:
+    """
+    Size bounded LRU cache of per-epoch covariance matrices.
+
+    Attributes:
+    --------------------
+    max_bytes: int
+        Upper bound on the memory held by cached matrices, 0 disables the cache \n
+    enabled: bool
+        False bypasses the cache without clearing it, see cache_bypassed \n
+    hits: int \n
+    misses: int
+
+    Methods:
+    --------------------
+    get_or_compute(X, estimator)
+        Covariance matrices of every epoch in X, estimating only the missing ones
+    clear()
+        Removes all cached matrices
+    stats()
+        Hit/miss counters and memory use
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        """
+        :param max_bytes: Upper bound on the memory held by cached matrices in bytes
+        """
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(epoch):
+        """
+        :param epoch: (n_channels, n_times) array
+        :return: bytes identifying the content, shape and dtype of the epoch
+        """
+        epoch = np.ascontiguousarray(epoch)
+        digest = hashlib.blake2b(epoch, digest_size=16)
+        digest.update(str((epoch.shape, epoch.dtype.str)).encode('utf-8'))
+        return digest.digest()
+
+    def get_or_compute(self, X, estimator):
+        """
+        Covariance matrices of a set of epochs, only the epochs not in the cache
+        are estimated.
+
+        :param X: (n_epochs, n_channels, n_times) array
+        :param estimator: Covariance estimator, see pyriemann.utils.covariance
+        :return: (n_epochs, n_channels, n_channels) array
+        """
+        if self.max_bytes <= 0 or not self.enabled:
+            return covariances(X, estimator=estimator)
+
+        keys = [(self.fingerprint(epoch), estimator) for epoch in X]
+        covmats = np.empty((X.shape[0], X.shape[1], X.shape[1]))
+
+        missing = []
+        with self._lock:
+            for indx, key in enumerate(keys):
+                cached = self._entries.get(key)
+                if cached is None:
+                    missing.append(indx)
+                else:
+                    self._entries.move_to_end(key)
+                    covmats[indx] = cached
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            computed = covariances(np.asarray(X[missing]), estimator=estimator)
+            covmats[missing] = computed
+            with self._lock:
+                for indx, covmat in zip(missing, computed):
+                    # Copy so the cache does not keep the whole batch alive
+                    self.__insert(keys[indx], covmat.copy())
+
+        return covmats
+
+    def __insert(self, key, covmat):
+        """
+        Adds a matrix and evicts the least recently used ones above max_bytes.
+        Must be called with the lock held.
+        """
+        if key in self._entries:
+            return
+        self._entries[key] = covmat
+        self._n_bytes += covmat.nbytes
+        while self._n_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._n_bytes -= evicted.nbytes
+
+    def clear(self):
+        """
+        Removes all cached matrices and resets the counters
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self._n_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: dict with hits, misses, number of cached matrices and bytes used
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._entries),
+                        bytes=self._n_bytes, max_bytes=self.max_bytes)
+
+
+# Cache shared by every CachedCovariances in this process
+default_cache = CovarianceCache()
+
+
+def set_cache_size(max_bytes):
+    """
+    Change the memory bound of the shared covariance cache. Entries above the
+    new bound are evicted on the next insert; 0 disables caching.
+
+    :param max_bytes: Upper bound in bytes
+    :return: None
+    """
+    default_cache.max_bytes = max_bytes
+    if max_bytes <= 0:
+        default_cache.clear()
+
+
+def precompute_covariances(X, estimator):
+    """
+    Estimate the covariance matrices of an epoch set once, so every fold and
+    pipeline fitted on it afterwards is served from the shared cache.
+
+    :param X: (n_epochs, n_channels, n_times) array
+    :param estimator: Covariance estimator, see pyriemann.utils.covariance
+    :return: None
+    """
+    default_cache.get_or_compute(X, estimator)
+
+
+@contextmanager
+def cache_bypassed():
+    """
+    Every covariance inside the block is estimated, e.g. to time a fit as it runs
+    on the Raspberry Pi. The cached matrices are kept.
+    """
+    enabled = default_cache.enabled
+    default_cache.enabled = False
+    try:
+        yield
+    finally:
+        default_cache.enabled = enabled
+
+
+class CachedCovariances(BaseEstimator, TransformerMixin):
+    """
+    Drop-in replacement for pyriemann.estimation.Covariances that serves the
+    training matrices from the shared covariance cache. transform does not use it.
+    """
+
+    def __init__(self, estimator='scm'):
+        """
+        :param estimator: Covariance estimator, see pyriemann.utils.covariance
+        """
+        self.estimator = estimator
+
+    def fit(self, X, y=None):
+        """
+        Nothing to fit, the covariance estimation is done per epoch.
+        :return: self
+        """
+        return self
+
+    def fit_transform(self, X, y=None):
+        """
+        Covariance matrices of the training epochs, served from and added to the
+        cache.
+
+        :param X: (n_epochs, n_channels, n_times) array
+        :return: (n_epochs, n_channels, n_channels) array of covariance matrices
+        """
+        return default_cache.get_or_compute(X, self.estimator)
+
+    def transform(self, X):
+        """
+        :param X: (n_epochs, n_channels, n_times) array
+        :return: (n_epochs, n_channels, n_channels) array of covariance matrices,
+                 always estimated
+        """
+        return covariances(X, estimator=self.estimator)
@@ -0,0 +1,179 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Index of the SSVEP exoskeleton dataset used by ReadEEG.
+
+The dataset directory is scanned once and the result is saved as
+<data_dir>/manifest.json:
+    subject -> trials ordered by file name (i.e. recording time) -> raw and
+    event file paths, sampling rate, channel count, duration and the number
+    of events of each class
+
+Paths are stored relative to the dataset directory with '/' separators, so the
+manifest stays valid when the dataset is moved or shared between Windows and
+Linux. On refresh only files that were added, removed or changed (size or
+modification time) are read again.
+"""
+
+import json
+import os
+
+# Bump when the layout of the manifest changes
+MANIFEST_FORMAT = 1
+
+RAW_SUFFIX = '_raw.fif'
+EVENT_SUFFIX = '-eve.fif'
+
+
+class DatasetManifest:
+    """
+    Subject and trial index of a dataset directory.
+
+    Attributes:
+    --------------------
+    data_dir: str \n
+    manifest_path: str \n
+    subjects: list
+        Subject names (directories), sorted
+
+    Methods:
+    --------------------
+    refresh()
+        Updates the index for added, removed or changed files
+    trials(subject)
+        Trial records of a subject, in recording order
+    trial_paths(subject, trial)
+        Absolute raw and event file paths of a trial
+    """
+
+    def __init__(self, data_dir, manifest_path=None):
+        """
+        :param data_dir: Directory of the dataset, one sub directory per subject
+        :param manifest_path: Where the manifest is saved, default <data_dir>/manifest.json
+        """
+        self.data_dir = data_dir
+        self.manifest_path = manifest_path if manifest_path is not None else os.path.join(data_dir, 'manifest.json')
+        self._subjects = {}
+
+        if os.path.isfile(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as f:
+                    manifest = json.load(f)
+                if manifest.get('format') == MANIFEST_FORMAT:
+                    self._subjects = manifest['subjects']
+            except (OSError, ValueError, KeyError):
+                # Unreadable manifest, rebuilt by refresh()
+                self._subjects = {}
+
+    @property
+    def subjects(self):
+        """
+        :return: list of subject names, sorted
+        """
+        return sorted(self._subjects)
+
+    def __abspath(self, relpath):
+        """
+        :param relpath: Path relative to data_dir with '/' separators
+        :return: Path for this operating system
+        """
+        return os.path.abspath(os.path.join(self.data_dir, *relpath.split('/')))
+
+    def __read_trial(self, subject, raw_name, event_name, raw_stat, event_stat):
+        """
+        Reads the header of a recording and its event file
+
+        :return: dict, the trial record
+        """
+        # Only imported when a recording has to be (re)read
+        import mne
+        import numpy as np
+
+        raw_relpath = subject + '/' + raw_name
+        event_relpath = subject + '/' + event_name
+        raw = mne.io.read_raw_fif(self.__abspath(raw_relpath), preload=False, verbose='ERROR')
+        events = mne.read_events(self.__abspath(event_relpath), verbose='ERROR')
+        codes, counts = np.unique(events[:, 2], return_counts=True)
+
+        return dict(raw=raw_relpath, events=event_relpath,
+                    raw_size=raw_stat.st_size, raw_mtime_ns=raw_stat.st_mtime_ns,
+                    events_size=event_stat.st_size, events_mtime_ns=event_stat.st_mtime_ns,
+                    sfreq=float(raw.info['sfreq']), n_channels=len(raw.ch_names),
+                    n_times=int(raw.n_times), duration=float(raw.n_times / raw.info['sfreq']),
+                    event_counts={str(code): int(count) for code, count in zip(codes, counts)})
+
+    def refresh(self):
+        """
+        Scans the dataset directory and updates the index. Recordings whose raw
+        and event files are unchanged (same size and modification time) are not
+        read again. The manifest is saved if anything changed.
+
+        :return: bool, True if the index changed
+        """
+        subjects = {}
+        changed = False
+        for subject in sorted(os.listdir(self.data_dir)):
+            subject_dir = os.path.join(self.data_dir, subject)
+            if subject.startswith('.') or not os.path.isdir(subject_dir):
+                continue
+
+            known = {trial['raw']: trial for trial in self._subjects.get(subject, [])}
+            names = set(os.listdir(subject_dir))
+            trials = []
+            # Recordings are named record-[date-time], so sorting by name orders them in time
+            for raw_name in sorted(name for name in names if name.endswith(RAW_SUFFIX)):
+                event_name = raw_name[:-len(RAW_SUFFIX)] + EVENT_SUFFIX
+                if event_name not in names:
+                    print('...No event file for ' + subject + '/' + raw_name + ', skipping it...')
+                    continue
+
+                raw_stat = os.stat(os.path.join(subject_dir, raw_name))
+                event_stat = os.stat(os.path.join(subject_dir, event_name))
+                trial = known.get(subject + '/' + raw_name)
+                if (trial is None or trial['raw_size'] != raw_stat.st_size or
+                        trial['raw_mtime_ns'] != raw_stat.st_mtime_ns or
+                        trial['events_size'] != event_stat.st_size or
+                        trial['events_mtime_ns'] != event_stat.st_mtime_ns):
+                    trial = self.__read_trial(subject, raw_name, event_name, raw_stat, event_stat)
+                    changed = True
+                trials.append(trial)
+
+            if len(trials) != len(known):
+                changed = True
+            subjects[subject] = trials
+
+        changed |= set(subjects) != set(self._subjects)
+        self._subjects = subjects
+        if changed:
+            self.save()
+        return changed
+
+    def save(self):
+        """
+        Writes the manifest, a read only dataset directory only prints a warning
+        :return: None
+        """
+        tmp_path = self.manifest_path + '.tmp%d' % os.getpid()
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(format=MANIFEST_FORMAT, subjects=self._subjects), f, indent=1)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as err:
+            print('...Could not save the dataset manifest (' + str(err) + ')...')
+
+    def trials(self, subject):
+        """
+        :param subject: Subject name
+        :return: list of trial records (dicts), in recording order
+        """
+        return self._subjects[subject]
+
+    def trial_paths(self, subject, trial):
+        """
+        :param subject: Subject name
+        :param trial: Trial number of the subject
+        :return: tuple (raw_data_path, event_data_path) of absolute paths
+        """
+        record = self._subjects[subject][trial]
+        return self.__abspath(record['raw']), self.__abspath(record['events'])
@@ -0,0 +1,340 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Probability gated smoothing of classifier decisions before they become drive commands.
+
+Sending every raw prediction means one misclassified window reverses the
+chair and costs two serial writes (there and back). DecisionSmoother only
+passes a class on when:
+
+    1. the decision is confident: its largest class probability reaches
+       `threshold`, otherwise it abstains (it does not vote)
+    2. it wins the sliding majority vote: at least `min_votes` of the last
+       `window` decisions voted for it
+    3. it has won for `dwell` decisions in a row
+    4. it is not `rest_class` (optional), e.g. so that resting does not drive
+
+Every other decision is NO_OP: nothing is sent and the last command stays.
+A whole recording is smoothed with a few vectorized NumPy calls (smooth), and
+live decisions one at a time with running vote counts (update); both give
+the same decisions.
+
+Smoothing trades latency for fewer commands: a new command is only sent
+some decisions after the raw predictions changed. tradeoff() evaluates a grid
+of thresholds and windows on recorded probabilities and reports the command
+count, the lag and (with the true labels) the accuracy of the command held
+after each decision.
+"""
+
+import time
+
+import numpy as np
+
+# Decision that sends nothing, the last command is kept
+NO_OP = -1
+
+# Outcome counters of the decisions. low_confidence counts the abstained votes,
+# the other outcomes add up to decisions
+OUTCOMES = ('passed', 'no_majority', 'dwell', 'rest')
+
+
+def class_probabilities(clf, X):
+    """
+    Class probabilities of a trained classifier. Classifiers without predict_proba
+    that transform epochs into class distances (e.g. MDM) get a softmax of the
+    negative distances.
+
+    :param clf: Trained classifier or pipeline
+    :param X: (n_epochs, n_channels, n_times) array
+    :return: (n_epochs, n_classes) array, columns ordered as clf.classes_
+    """
+    if hasattr(clf, 'predict_proba'):
+        return clf.predict_proba(X)
+    distances = np.asarray(clf.transform(X), dtype=float)
+    scores = np.exp(distances.min(axis=1, keepdims=True) - distances)
+    return scores / scores.sum(axis=1, keepdims=True)
+
+
+def command_changes(decisions):
+    """
+    :param decisions: Sequence of class labels, NO_OP sends nothing
+    :return: Indices where a new command is sent (the label differs from the last one sent)
+    """
+    decisions = np.asarray(decisions)
+    sent = np.flatnonzero(decisions != NO_OP)
+    if sent.size == 0:
+        return sent
+    changed = np.concatenate(([True], decisions[sent[1:]] != decisions[sent[:-1]]))
+    return sent[changed]
+
+
+def held_commands(decisions):
+    """
+    :param decisions: Sequence of class labels, NO_OP sends nothing
+    :return: Label of the last command sent at each decision, NO_OP before the first one
+    """
+    decisions = np.asarray(decisions)
+    indices = np.arange(len(decisions))
+    last_sent = np.maximum.accumulate(np.where(decisions != NO_OP, indices, -1))
+    return np.where(last_sent >= 0, decisions[np.maximum(last_sent, 0)], NO_OP)
+
+
+def command_lag(raw, decisions):
+    """
+    Decisions between the raw predictions switching to a class and the smoothed
+    decisions sending it.
+
+    :param raw: Raw predicted labels
+    :param decisions: Smoothed decisions of the same windows
+    :return: (n_commands,) array, lag of every smoothed command in decisions
+    """
+    raw = np.asarray(raw)
+    decisions = np.asarray(decisions)
+    raw_changes = command_changes(raw)
+    changes = command_changes(decisions)
+    lag = np.zeros(len(changes), dtype=int)
+    for label in np.unique(decisions[changes]):
+        sent = changes[decisions[changes] == label]
+        switched = raw_changes[raw[raw_changes] == label]
+        # Latest raw switch to the label at or before each smoothed command
+        latest = np.searchsorted(switched, sent, side='right') - 1
+        lag[decisions[changes] == label] = np.where(latest >= 0, sent - switched[np.maximum(latest, 0)], 0)
+    return lag
+
+
+class DecisionSmoother:
+    """
+    Confidence threshold, sliding majority vote and dwell time on classifier
+    decisions, see the module docstring.
+
+    Attributes:
+    --------------------
+    classes: np.ndarray
+        Class labels, ordered as the probability columns
+    counters: dict
+        decisions, raw_commands, commands, low_confidence and the OUTCOMES
+    raw / decisions: list
+        Raw prediction and smoothed decision of every update since reset
+
+    Methods:
+    --------------------
+    reset(classes)
+        Clears the history, must be called before the first update
+    update(proba)
+        Smoothed decision of one window
+    smooth(proba)
+        Smoothed decisions of a whole recording, vectorized
+    stats(hop=None) / report(hop=None)
+        Suppressed commands and command lag
+    """
+
+    def __init__(self, threshold=0.5, window=3, min_votes=None, dwell=1, rest_class=None):
+        """
+        :param threshold: Minimum class probability for a decision to vote
+        :param window: Number of decisions in the majority vote
+        :param min_votes: Votes needed to win, default a majority of window
+        :param dwell: Decisions in a row a class must win before it is sent
+        :param rest_class: Optional label that sends nothing (no-op) when it wins
+        """
+        if window < 1 or dwell < 1:
+            raise ValueError('window and dwell must be at least 1')
+        self.threshold = threshold
+        self.window = window
+        self.min_votes = window // 2 + 1 if min_votes is None else min_votes
+        self.dwell = dwell
+        self.rest_class = rest_class
+        self.classes = None
+        self.counters = None
+        self.raw = []
+        self.decisions = []
+
+    def reset(self, classes):
+        """
+        :param classes: Class labels ordered as the probability columns, e.g. clf.classes_
+        :return: None
+        """
+        self.classes = np.asarray(classes)
+        # Ring of the last votes (class indices, -1 abstained) and their counts per class
+        self._votes = np.full(self.window, -1)
+        self._counts = np.zeros(len(self.classes), dtype=int)
+        self._next = 0
+        self._candidate = None
+        self._run = 0
+        self._last_command = None
+        self.counters = dict(decisions=0, raw_commands=0, commands=0, low_confidence=0,
+                             **dict.fromkeys(OUTCOMES, 0))
+        self.raw = []
+        self.decisions = []
+
+    def __outcome(self, candidate, run):
+        if candidate == NO_OP:
+            return 'no_majority'
+        if run < self.dwell:
+            return 'dwell'
+        if self.rest_class is not None and candidate == self.rest_class:
+            return 'rest'
+        return 'passed'
+
+    def update(self, proba):
+        """
+        :param proba: (n_classes,) class probabilities of one window
+        :return: Label of the command to send, NO_OP to send nothing
+        """
+        best = int(np.argmax(proba))
+        vote = best if proba[best] >= self.threshold else -1
+
+        # Replace the oldest vote
+        oldest = self._votes[self._next]
+        if oldest >= 0:
+            self._counts[oldest] -= 1
+        self._votes[self._next] = vote
+        if vote >= 0:
+            self._counts[vote] += 1
+        self._next = (self._next + 1) % self.window
+
+        winner = int(np.argmax(self._counts))
+        candidate = self.classes[winner] if self._counts[winner] >= self.min_votes else NO_OP
+        self._run = self._run + 1 if candidate == self._candidate else 1
+        self._candidate = candidate
+
+        outcome = self.__outcome(candidate, self._run)
+        decision = candidate if outcome == 'passed' else NO_OP
+
+        raw = self.classes[best]
+        counters = self.counters
+        counters['decisions'] += 1
+        counters['low_confidence'] += int(vote < 0)
+        counters[outcome] += 1
+        counters['raw_commands'] += int(not self.raw or raw != self.raw[-1])
+        if decision != NO_OP and decision != self._last_command:
+            counters['commands'] += 1
+            self._last_command = decision
+        self.raw.append(raw)
+        self.decisions.append(decision)
+        return decision
+
+    def smooth(self, proba):
+        """
+        Smoothed decisions of consecutive windows, same as calling update on every
+        row after reset(self.classes). The counters and history are replaced.
+
+        :param proba: (n_windows, n_classes) class probabilities
+        :return: (n_windows,) array of labels, NO_OP where nothing is sent
+        """
+        proba = np.asarray(proba)
+        self.reset(self.classes)
+        n_windows = proba.shape[0]
+        indices = np.arange(n_windows)
+
+        best = np.argmax(proba, axis=1)
+        confident = proba[indices, best] >= self.threshold
+        votes = np.zeros(proba.shape, dtype=int)
+        votes[indices[confident], best[confident]] = 1
+
+        # Votes of the last `window` decisions, fewer at the start
+        counts = np.cumsum(votes, axis=0)
+        counts[self.window:] -= counts[:-self.window].copy()
+        winner = np.argmax(counts, axis=1)
+        candidates = np.where(counts[indices, winner] >= self.min_votes, self.classes[winner], NO_OP)
+
+        # Decisions in a row with the same candidate
+        starts = np.concatenate(([True], candidates[1:] != candidates[:-1]))
+        run = indices - np.maximum.accumulate(np.where(starts, indices, 0)) + 1
+
+        passed = (candidates != NO_OP) & (run >= self.dwell)
+        rest = passed & (candidates == self.rest_class) if self.rest_class is not None else np.zeros_like(passed)
+        decisions = np.where(passed & ~rest, candidates, NO_OP)
+
+        raw = self.classes[best]
+        self.counters.update(decisions=n_windows, raw_commands=len(command_changes(raw)),
+                             commands=len(command_changes(decisions)), low_confidence=int(np.sum(~confident)),
+                             passed=int(np.sum(passed & ~rest)), no_majority=int(np.sum(candidates == NO_OP)),
+                             dwell=int(np.sum((candidates != NO_OP) & (run < self.dwell))), rest=int(np.sum(rest)))
+        self.raw = list(raw)
+        self.decisions = list(decisions)
+        return decisions
+
+    def stats(self, hop=None):
+        """
+        :param hop: Optional time in seconds between decisions, to give the lag in seconds
+        :return: dict with the counters, suppressed commands, reduction and command lag
+        """
+        stats = dict(self.counters)
+        stats['suppressed'] = stats['raw_commands'] - stats['commands']
+        stats['reduction'] = stats['suppressed'] / stats['raw_commands'] if stats['raw_commands'] else 0.0
+        lag = command_lag(self.raw, self.decisions)
+        stats['mean_lag'] = float(np.mean(lag)) if lag.size else 0.0
+        stats['max_lag'] = int(np.max(lag)) if lag.size else 0
+        if hop is not None:
+            stats['mean_lag_s'] = stats['mean_lag'] * hop
+        return stats
+
+    def report(self, hop=None):
+        """
+        :param hop: Optional time in seconds between decisions
+        :return: str, one line summary of stats
+        """
+        stats = self.stats(hop)
+        lag = f'{stats["mean_lag"]:.2f}' + ' decisions' + \
+              (' (' + f'{stats["mean_lag_s"]:.2f}' + ' s)' if hop is not None else '')
+        return ('Decision smoother: ' + str(stats['decisions']) + ' decisions, ' + str(stats['commands']) +
+                ' commands instead of ' + str(stats['raw_commands']) + ' (' + str(stats['suppressed']) +
+                ' suppressed, ' + f'{stats["reduction"]:.0%}' + '), ' + str(stats['low_confidence']) +
+                ' low confidence, ' + str(stats['no_majority']) + ' without majority, ' + str(stats['dwell']) +
+                ' dwelling, ' + str(stats['rest']) + ' rest, mean command lag ' + lag)
+
+
+def tradeoff(proba, classes, thresholds=(0.0, 0.4, 0.6, 0.8), windows=(1, 3, 5), dwell=1, rest_class=None,
+             labels=None, hop=None):
+    """
+    Command count against lag for a grid of smoother settings on recorded probabilities.
+    Threshold 0 with window 1 sends every raw prediction.
+
+    :param proba: (n_windows, n_classes) class probabilities of consecutive windows
+    :param classes: Class labels ordered as the probability columns
+    :param thresholds: Confidence thresholds to evaluate
+    :param windows: Majority vote windows to evaluate
+    :param dwell: Dwell of every setting
+    :param rest_class: Rest class of every setting
+    :param labels: Optional true labels, to add the accuracy of the held command
+    :param hop: Optional time in seconds between decisions
+    :return: list of dicts, one per threshold and window
+    """
+    rows = []
+    for threshold in thresholds:
+        for window in windows:
+            smoother = DecisionSmoother(threshold, window, dwell=dwell, rest_class=rest_class)
+            smoother.reset(classes)
+            tstart = time.perf_counter()
+            decisions = smoother.smooth(proba)
+            smooth_time = time.perf_counter() - tstart
+            row = dict(threshold=threshold, window=window, **smoother.stats(hop))
+            row['smooth_us'] = smooth_time / max(len(decisions), 1) * 1e6
+            if labels is not None:
+                row['raw_accuracy'] = float(np.mean(np.asarray(smoother.raw) == labels))
+                row['accuracy'] = float(np.mean(held_commands(decisions) == labels))
+            rows.append(row)
+    return rows
+
+
+def format_tradeoff(rows):
+    """
+    :param rows: Output of tradeoff
+    :return: str, table of the settings
+    """
+    has_accuracy = 'accuracy' in rows[0]
+    has_seconds = 'mean_lag_s' in rows[0]
+    lines = [f'{"threshold":>9} {"window":>6} {"commands":>8} {"raw":>5} {"reduction":>9} {"lag":>6}' +
+             (f' {"lag s":>6}' if has_seconds else '') + f' {"max lag":>7} {"us/dec":>7}' +
+             (f' {"accuracy":>8}' if has_accuracy else '')]
+    for row in rows:
+        lines.append(f'{row["threshold"]:9.2f} {row["window"]:>6} {row["commands"]:>8} {row["raw_commands"]:>5} '
+                     f'{row["reduction"]:9.0%} {row["mean_lag"]:6.2f}' +
+                     (f' {row["mean_lag_s"]:6.2f}' if has_seconds else '') +
+                     f' {row["max_lag"]:>7} {row["smooth_us"]:7.2f}' +
+                     (f' {row["accuracy"]:8.1%}' if has_accuracy else ''))
+    if has_accuracy:
+        lines.append('...Accuracy of the command held after each decision, raw predictions: ' +
+                     f'{rows[0]["raw_accuracy"]:.1%}' + '...')
+    return '\n'.join(lines)
@@ -0,0 +1,176 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Directory of on-disk entries with least recently used eviction, shared by the
+epoch cache (epoch_cache.EpochCache) and the model store (model_store.ModelStore).
+
+Every entry is a sub-directory named after its key, holding the entry's files
+and a meta.json. Entries are written to a temporary directory that is renamed
+into place, and meta.json is written last, so an entry without it (an
+interrupted write) is never read. Reading an entry touches its meta.json, whose
+modification time is the last use for the eviction policy.
+"""
+
+import json
+import os
+import shutil
+
+META_FILE = 'meta.json'
+
+
+class DiskLRUStore:
+    """
+    Size and/or count bounded directory of entries.
+
+    Attributes:
+    --------------------
+    directory: str \n
+    max_bytes: int
+        Upper bound on the total size of the entries, None for no bound \n
+    max_entries: int
+        Upper bound on the number of entries, None for no bound
+
+    Methods:
+    --------------------
+    read_entry(key, read_files, errors)
+        Reads an entry, removes it if it is broken or refused
+    write_entry(key, write_files, meta)
+        Writes an entry atomically, then evicts the least recently used ones
+    invalidate(key=None)
+        Removes one entry, or every entry if no key is given
+    size()
+        Total size of the entries in bytes
+    """
+
+    def __init__(self, directory, max_bytes=None, max_entries=None, label='entry'):
+        """
+        :param directory: Directory to hold the entries, created if missing
+        :param max_bytes: Upper bound on the total size in bytes, None for no bound
+        :param max_entries: Upper bound on the number of entries, None for no bound
+        :param label: Name of the entries in the eviction messages
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.label = label
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def entry_dir(self, key):
+        return os.path.join(self.directory, key)
+
+    def read_entry(self, key, read_files, errors=(OSError, ValueError)):
+        """
+        Reads an entry and marks it as recently used.
+
+        :param key: Entry name
+        :param read_files: function(entry_dir, meta) returning the loaded entry, or None to
+                           refuse it (e.g. stale), refused entries are removed
+        :param errors: Exceptions of read_files that mean the entry is broken
+        :return: Result of read_files, or None if the entry is missing, broken or refused
+        """
+        entry = self.entry_dir(key)
+        meta_path = os.path.join(entry, META_FILE)
+        if not os.path.isfile(meta_path):
+            return None
+
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            loaded = read_files(entry, meta)
+        except (OSError, ValueError) + tuple(errors):
+            # Broken entry, e.g. interrupted write or deleted files
+            loaded = None
+        if loaded is None:
+            self.invalidate(key)
+            return None
+
+        # Mark as recently used for the eviction policy
+        os.utime(meta_path)
+        return loaded
+
+    def write_entry(self, key, write_files, meta):
+        """
+        Writes an entry, replacing an existing one, then removes the least recently
+        used entries above the bounds.
+
+        :param key: Entry name
+        :param write_files: function(entry_dir) writing the entry's files
+        :param meta: JSON serializable dict saved as meta.json
+        :return: None
+        """
+        entry = self.entry_dir(key)
+        tmp_entry = entry + '.tmp%d' % os.getpid()
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+
+        write_files(tmp_entry)
+        # meta.json is written last, an entry without it is never read
+        with open(os.path.join(tmp_entry, META_FILE), 'w') as f:
+            json.dump(meta, f, default=repr)
+
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp_entry, entry)
+
+        self.__evict(keep=key)
+
+    def invalidate(self, key=None):
+        """
+        Remove a single entry or, if key is None, every entry.
+
+        :param key: Entry name or None
+        :return: None
+        """
+        if key is not None:
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            return
+
+        for name in os.listdir(self.directory):
+            shutil.rmtree(self.entry_dir(name), ignore_errors=True)
+
+    def size(self):
+        """
+        :return: Total size of the entries in bytes
+        """
+        return sum(size for _, _, size in self.__entries())
+
+    def __entries(self):
+        """
+        :return: list of (last_used, key, size_in_bytes) for all complete entries
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if '.tmp' in name:
+                # Entry still being written by write_entry()
+                continue
+            entry = self.entry_dir(name)
+            meta_path = os.path.join(entry, META_FILE)
+            if not os.path.isfile(meta_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(meta_path), name, size))
+        return entries
+
+    def __evict(self, keep=None):
+        """
+        Remove least recently used entries until the store fits in max_bytes and
+        max_entries. The entry given by keep is never removed.
+
+        :param keep: Key to keep, normally the entry that was just written
+        :return: None
+        """
+        entries = sorted(self.__entries())
+        total = sum(size for _, _, size in entries)
+        count = len(entries)
+        for _, name, size in entries:
+            over_bytes = self.max_bytes is not None and total > self.max_bytes
+            over_count = self.max_entries is not None and count > self.max_entries
+            if not (over_bytes or over_count):
+                break
+            if name == keep:
+                continue
+            print('...Evicting ' + self.label + ' ' + name + '...')
+            self.invalidate(name)
+            total -= size
+            count -= 1
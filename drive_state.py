@@ -0,0 +1,77 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Drive button state shared by the keyboard control methods.
+
+The four drive buttons are kept as a bitmask, and STATE_TABLE maps each of the
+16 possible states to the command sent to the Arduino and the arrow to draw:
+
+    forwards + left  -> 'nw'        nothing pressed -> '00' (stop)
+    three or more buttons, or opposite buttons, have no command and keep the
+    last one, as before
+
+Keys are mapped to buttons by name ('w'/'up', 's'/'down', 'a'/'left',
+'d'/'right'), so any keyboard backend (pynput, a terminal, evdev) can use the
+same table. Only the standard library is used.
+"""
+
+import threading
+
+# Button bits
+FORWARDS = 1
+BACKWARDS = 2
+LEFT = 4
+RIGHT = 8
+
+# Key name (character, or name of a special key) -> button bit
+KEY_BITS = {'w': FORWARDS, 'up': FORWARDS,
+            's': BACKWARDS, 'down': BACKWARDS,
+            'a': LEFT, 'left': LEFT,
+            'd': RIGHT, 'right': RIGHT}
+
+# Command of each button combination
+_COMMANDS = {0: '00',
+             FORWARDS: 'nn', BACKWARDS: 'ss', LEFT: 'ww', RIGHT: 'ee',
+             FORWARDS | LEFT: 'nw', FORWARDS | RIGHT: 'ne',
+             BACKWARDS | LEFT: 'sw', BACKWARDS | RIGHT: 'se'}
+
+# state -> (command or None, arrow drawn pressed or None)
+STATE_TABLE = tuple((_COMMANDS.get(state), _COMMANDS.get(state) if state else None) for state in range(16))
+
+
+def key_bit(name):
+    """
+    :param name: Key name, e.g. 'w' or 'up', case insensitive
+    :return: int, button bit of the key, None for keys that do not drive
+    """
+    if name is None:
+        return None
+    return KEY_BITS.get(name.lower())
+
+
+class DriveState:
+    """
+    Bitmask of the pressed drive buttons, updated from a key listener thread.
+
+    Attributes:
+    --------------------
+    state: int
+        Current bitmask, index into STATE_TABLE
+    """
+
+    def __init__(self):
+        self.state = 0
+        self._lock = threading.Lock()
+
+    def update(self, bit, pressed):
+        """
+        :param bit: Button bit, see key_bit
+        :param pressed: True for a key press, False for a release
+        :return: tuple (changed, state), changed is False for key repeats
+        """
+        with self._lock:
+            state = self.state | bit if pressed else self.state & ~bit
+            changed = state != self.state
+            self.state = state
+            return changed, state
@@ -18,8 +18,9 @@ into individual functions from python, so that end-users can easily call them.
 import numpy as np
 import matplotlib.pyplot as plt
 import os
-import glob
+import sys
 import time
+from joblib import Parallel, delayed
 
 # Communication
 import serial
@@ -36,70 +37,286 @@ from sklearn.model_selection import KFold, cross_val_score, StratifiedKFold, Str
 # SKLearn Preprocessing and Pipelines
 
 from sklearn.pipeline import make_pipeline
+from sklearn.base import clone
 # SKLearn Classification schemes
 
 from sklearn.linear_model import LogisticRegression, SGDClassifier, LinearRegression
 
 # Pyriemann Estimation and Analysis
-from pyriemann.estimation import Covariances, ERPCovariances, XdawnCovariances
+from pyriemann.estimation import ERPCovariances, XdawnCovariances
 from pyriemann.spatialfilters import CSP
 from pyriemann.tangentspace import TangentSpace
 from pyriemann.classification import MDM
 from pyriemann.classification import KNearestNeighbor as riem_KNN
 from pyriemann.utils.viz import plot_confusion_matrix
 
+# Memoized covariance estimation shared across pipelines and folds
+from covariance_cache import CachedCovariances, precompute_covariances
+# Epoch container for cached and low memory epochs
+from epoch_cache import CachedEpochs
+# Training-free CCA classifier
+from cca_classifier import CCAClassifier
+
 # Lab Streaming Layer Imports
-from pylsl import StreamInfo, StreamOutlet, StreamInlet, resolve_streams, resolve_byprop
+from pylsl import resolve_streams, resolve_byprop, local_clock
+
+# Subject/trial index of the dataset
+from dataset_manifest import DatasetManifest
+# Preprocessed epoch cache
+from epoch_cache import EpochCache
+# Persisted trained pipelines
+from model_store import ModelStore
+# Causal filters for the online path
+from stream_filter import StreamingFilterBank
+# Ring buffer inlet and numeric prediction outlet for the online path
+from lsl_streams import RingBufferInlet, PredictionOutlet
+# Per-stage timing histograms
+from stage_timer import StageTimer
+# End-to-end latency of the online decisions
+from latency_tracker import DecisionLatencyTracker
+# Non-blocking serial writes
+from serial_writer import SerialCommandWriter
+from serial_protocol import get_protocol
+# Confidence gated smoothing of the decisions before they are sent
+from decision_smoother import NO_OP, class_probabilities, tradeoff, format_tradeoff
+
+
+def build_rg_pipeline(RG_Pipeline_Num=0, estimator='lwf', sfreq=None):
+    """
+    Build one of the pre-defined Riemannian Geometery pipelines (unfitted), or
+    the training-free CCA classifier.
+
+    Parameters
+    ----------
+    RG_Pipeline_Num : int, optional
+        Which pre-defined Riemannian Geometery pipeline to build.
+        Can be 0,1,2,3,4:
+            Pipeline 0:
+                Covariance w/ estimator -> Riemannian KNN
+            Pipeline 1:
+                Covariance w/ estimator -> CSP -> TangentSpace -> LogisticRegression
+                LogReg uses a 'balanced' option for class weights, l2 penalty.
+            Pipeline 2:
+                XDawnCovariance w/ estimator -> TangentSpace -> LogisticRegression
+                LogReg uses elasticnet penalty, solver soga and a multinominal multi_class flag.
+            Pipeline 3:
+                Covariance w/ estimator -> MDM.
+                Minimum distance to mean (MDM) is the main classification scheme.
+            Pipeline 4:
+                CCA against sine/cosine references of the stimulus frequencies,
+                see cca_classifier.CCAClassifier. Needs no training.
+        The default is 0.
+    estimator : str, optional
+        Covariance matrix estimator to use. For regularization consider 'lwf'
+        or 'oas'. For complete lists, see pyriemann.utils.covariance.
+        Not used by pipeline 4. The default is 'lwf'.
+    sfreq : float, optional
+        Sampling frequency of the epochs, only used (and required) by pipeline 4.
+        The default is None.
+
+    Returns
+    -------
+    clf : sklearn Pipeline
+        The unfitted pipeline. Pipelines 0, 1 and 3 estimate covariances through
+        covariance_cache.CachedCovariances, so epochs seen before (e.g. in another
+        fold or pipeline) are not estimated again.
+
+    """
+    if RG_Pipeline_Num == 1:
+        clf = make_pipeline(CachedCovariances(estimator=estimator),
+                            CSP(log=False), TangentSpace(),
+                            LogisticRegression(class_weight='balanced',
+                                               max_iter=500))
+    elif RG_Pipeline_Num == 2:
+        clf = make_pipeline(XdawnCovariances(estimator=estimator,
+                                             xdawn_estimator=estimator),
+                            TangentSpace(),
+                            LogisticRegression(penalty='elasticnet', class_weight=None, solver='saga',
+                                               multi_class='multinomial', l1_ratio=0.5,
+                                               max_iter=500))
+    elif RG_Pipeline_Num == 3:
+        clf = make_pipeline(CachedCovariances(estimator=estimator), MDM())  # This is the best so far
+    elif RG_Pipeline_Num == 4:
+        clf = make_pipeline(CCAClassifier(sfreq=sfreq))
+    else:
+        print("...Running a default pipeline for RG using Covariance, and KNN...")
+        clf = make_pipeline(CachedCovariances(estimator=estimator), riem_KNN())
+
+    return clf
+
+
+def _evaluate_fold(clf, X_data, labels, train_idx, test_idx):
+    """
+    Fit and test a pipeline on one cross-validation fold. The folds run in threads
+    so they share the covariance cache, the fit time excludes covariances that
+    were precomputed.
+
+    Returns
+    -------
+    preds : np.ndarray
+        Predicted classes of the test epochs.
+    fit_time : float
+        Time in seconds to fit the pipeline.
+    predict_time : float
+        Time in seconds to predict the test epochs.
+
+    """
+    tstart = time.perf_counter()
+    clf.fit(X_data[train_idx], labels[train_idx])
+    fit_time = time.perf_counter() - tstart
+
+    tstart = time.perf_counter()
+    preds = clf.predict(X_data[test_idx])
+    predict_time = time.perf_counter() - tstart
+
+    return preds, fit_time, predict_time
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB, see resource.getrusage.
+    Returns nan where the resource module is not available (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
 
 
 class ReadEEG:
+    # Drive direction sent for each predicted class
+    DIRECTION_CONVERT = {1: 'nn', 2: 'ww', 3: 'ss', 4: 'ee'}
+
     def __init__(self,
-                 data_dir=r'C:\Users\James\Documents\Python\summer_research\bci_stimulus\dataset-ssvep-exoskeleton'):
-        # Get list of all subjects in the master data directory
-        self.dir_list = os.listdir(data_dir)
-        # Remove the files which aren't subject names
-        self.subj_list = [name for name in self.dir_list if not os.path.isfile(data_dir + '\\' + name) is True]
+                 data_dir=r'C:\Users\James\Documents\Python\summer_research\bci_stimulus\dataset-ssvep-exoskeleton',
+                 epoch_cache_dir=os.path.join(os.path.expanduser('~'), '.bci_stimulus', 'epoch_cache'),
+                 epoch_cache_size=1024 ** 3,
+                 model_store_dir=os.path.join(os.path.expanduser('~'), '.bci_stimulus', 'model_store'),
+                 low_memory=False, segment_pad=5.0, timing=True, timing_path=None, serial_protocol='text'):
+        self.data_dir = data_dir
+        # 'text' or 'binary' serial command protocol, must match the firmware
+        self.serial_protocol = get_protocol(serial_protocol)
+        # Time every processing stage, see export_timing. timing_path is the JSON
+        # file written at the end of simulate_SSVEP_pipeline
+        self.timer = StageTimer(enabled=timing)
+        self.timing_path = timing_path
+        # End-to-end latency of the last online run, see classify_online_stream
+        self.latency_tracker = None
+        # Build epochs from on-demand reads of the event windows instead of loading whole recordings
+        self.low_memory = low_memory
+        # Seconds read (and filtered) on each side of an event window in low memory mode
+        self.segment_pad = segment_pad
+        # Index of all subjects and their trials, only changed recordings are read again
+        self.manifest = DatasetManifest(data_dir)
+        self.manifest.refresh()
+        # Subject names (sub-directories of the master data directory), sorted
+        self.subj_list = self.manifest.subjects
 
         self._last_direction = "00"
+        # Writer thread of the serial port, see __send_data
+        self._serial_writer = None
+
+        # Preprocessed epochs are cached on disk, set epoch_cache_dir to None to disable
+        if epoch_cache_dir is not None:
+            self._epoch_cache = EpochCache(epoch_cache_dir, max_bytes=epoch_cache_size)
+        else:
+            self._epoch_cache = None
+
+        # Trained pipelines are saved on disk, set model_store_dir to None to always retrain
+        if model_store_dir is not None:
+            self._model_store = ModelStore(model_store_dir)
+        else:
+            self._model_store = None
 
-    def __send_data(self, ser, direction):
+    def clear_epoch_cache(self):
         """
-        Sends received data to serial stream, either bluetooth or cable. 
-        :param ser: Serial object connected to a specific serial port
-        :param direction: Direction/data to be sent over serial data stream
+        Remove every entry from the preprocessed epoch cache, e.g. after changing
+        the preprocessing code itself.
         :return: None
-        """""
-        if self._last_direction != direction:
-            message = 'd/' + direction + '\n'
+        """
+        if self._epoch_cache is not None:
+            self._epoch_cache.invalidate()
 
-            ser.flush()  # clear serial stream
+    def export_timing(self, path=None):
+        """
+        Print the statistics of every timed stage and optionally save them as JSON.
+        :param path: File to write the JSON to, None to only print
+        :return: str, JSON of the stage statistics
+        """
+        if not self.timer.enabled:
+            return self.timer.to_json()
+        print('...Stage timing...')
+        print(self.timer.report())
+        return self.timer.to_json(path)
 
-            # clear the last message
-            clear_msg = "d/00\n"
-            ser.write(clear_msg.encode('utf-8'))
+    def clear_model_store(self):
+        """
+        Remove every saved pipeline from the model store, e.g. after changing
+        the pipeline code itself.
+        :return: None
+        """
+        if self._model_store is not None:
+            self._model_store.invalidate()
 
-            ser.write(message.encode('utf-8'))  # write new direction
+    def __send_data(self, ser, direction, on_written=None):
+        """
+        Sends received data to serial stream, either bluetooth or cable. The
+        write happens on the writer thread of the port, this never blocks the
+        classification loop.
+        :param ser: Serial object connected to a specific serial port
+        :param direction: Direction/data to be sent over serial data stream
+        :param on_written: Optional function called once the direction was written
+        :return: bool, True if the direction changed and was queued
+        """""
+        queued = self._last_direction != direction
+        if queued:
+            self.__get_serial_writer(ser).send_direction(direction, on_written)
 
         self._last_direction = direction
+        return queued
+
+    def __get_serial_writer(self, ser):
+        """
+        :param ser: Serial object connected to a specific serial port
+        :return: SerialCommandWriter of the port, started on first use
+        """
+        if self._serial_writer is None or self._serial_writer.ser is not ser:
+            self.close_serial_writer()
+            self._serial_writer = SerialCommandWriter(ser, timer=self.timer, protocol=self.serial_protocol)
+        return self._serial_writer
 
-    def __get_subj_trial_data(self, subj_path_name,
-                              data_dir=r'C:\Users\James\Documents\Python\summer_research\bci_stimulus\dataset-ssvep-exoskeleton'):
+    def close_serial_writer(self):
+        """
+        Write the pending commands and stop the serial writer thread, its
+        statistics are printed when timing is enabled.
+        :return: dict, statistics of the writer (see SerialCommandWriter.stats) or None
+        """
+        if self._serial_writer is None:
+            return None
+        self._serial_writer.close()
+        if self.timer.enabled:
+            print('...' + self._serial_writer.report() + '...')
+        stats = self._serial_writer.stats()
+        self._serial_writer = None
+        return stats
+
+    def __get_subj_trial_data(self, subj_path_name):
         """
         Get the trial information from a given subject.
         This has been set-up for the public dataset of SSVEP exoskeleton data,
         present at https://github.com/sylvchev/dataset-ssvep-exoskeleton
 
-        Only .fif files will be analyzed from this at the moment.
+        Only .fif files will be analyzed from this at the moment. The paths come
+        from the dataset manifest, trials are in recording order.
 
         Parameters
         ----------
         subj_path_name : str, required
             This is the subject-specific name. Only returns the '/*_raw.fif' and
-            '/*-eve.fif' values.
-        data_dir : str, required.
-            This is the full path to the data to analyze.
-            The default NEEDS TO BE CHANGED FOR YOUR COMPUTER PATH.
-            Current default is - 'D:\\Users\\Eli\\Documents\\Python Scripts\\Example_Data\\dataset-ssvep-exoskeleton-master'.
+            matching '/*-eve.fif' values.
 
         Returns
         -------
@@ -109,16 +326,74 @@ class ReadEEG:
             List of the full path to the event file (-eve.fif).
 
         """
-        # Concat the data_directory with the subject_name
-        data_path = data_dir + '\\' + subj_path_name
-        # Now pull up all of the raw data held in '_raw.fif' info paths
-        raw_data_path = glob.glob(data_path + '/*_raw.fif')
-        # Repeat for all of the event data held in '-eve.fif'
-        event_data_path = glob.glob(data_path + '/*-eve.fif')
+        trial_paths = [self.manifest.trial_paths(subj_path_name, trial)
+                       for trial in range(len(self.manifest.trials(subj_path_name)))]
+        raw_data_path = [raw_path for raw_path, _ in trial_paths]
+        event_data_path = [event_path for _, event_path in trial_paths]
         # Return vals
         return raw_data_path, event_data_path
 
-    def __get_raw_data(self, raw_data_path, montage_type='easycap-M1'):
+    def get_trial_paths(self, subj, trial):
+        """
+        Get the raw and event file paths of one recording.
+
+        Parameters
+        ----------
+        subj : int
+            Subject number, index into `subj_list`.
+        trial : int
+            Trial number of the subject's recordings.
+
+        Returns
+        -------
+        raw_data_path : str
+            Full path to the raw data file, (_raw.fif).
+        event_data_path : str
+            Full path to the event file (-eve.fif).
+
+        """
+        return self.manifest.trial_paths(self.subj_list[subj], trial)
+
+    def get_trial_count(self, subj):
+        """
+        Number of recordings (trials) of a subject.
+
+        Parameters
+        ----------
+        subj : int
+            Subject number, index into `subj_list`.
+
+        Returns
+        -------
+        int
+
+        """
+        return len(self.manifest.trials(self.subj_list[subj]))
+
+    def get_epochs(self, subj, trial, **epoch_params):
+        """
+        Get the preprocessed epochs of one recording, using the epoch cache.
+
+        Parameters
+        ----------
+        subj : int
+            Subject number, index into `subj_list`.
+        trial : int
+            Trial number of the subject's recordings.
+        **epoch_params
+            Preprocessing settings passed to `build_epochs`
+            (tmin, tmax, event_id, notch_filt, bp_low, bp_high, ...).
+
+        Returns
+        -------
+        epochs : Epoch object or CachedEpochs
+            Provides `get_data()` and `events`.
+
+        """
+        raw_data_path, event_data_path = self.get_trial_paths(subj, trial)
+        return self.__get_epochs(raw_data_path, event_data_path, **epoch_params)
+
+    def __get_raw_data(self, raw_data_path, montage_type='easycap-M1', preload=True):
         """
         Extract the raw data from the given data path. Currently supports only
         .fif, .edf and .gdf extension types.
@@ -129,6 +404,10 @@ class ReadEEG:
             Full path to the raw data. List is expected as input type.
         montage_type : str, optional
             Electrode montage to use with the data. The default is 'easycap-M1'.
+        preload : bool, optional
+            Load the whole recording into memory. If False, samples are read from
+            the file on demand (e.g. raw.get_data(start=..., stop=...)).
+            The default is True.
 
         Returns
         -------
@@ -141,13 +420,16 @@ class ReadEEG:
         if raw_data_path[-3:] == 'fif':
 
             print('...Importing raw .fif file...')
-            raw = mne.io.read_raw_fif(raw_data_path, preload=True)
+            with self.timer.stage('load_raw'):
+                raw = mne.io.read_raw_fif(raw_data_path, preload=preload)
         elif raw_data_path[-3:] == 'edf':
             print('...Importing raw .edf file...')
-            raw = mne.io.read_raw_edf(raw_data_path, preload=True)
+            with self.timer.stage('load_raw'):
+                raw = mne.io.read_raw_edf(raw_data_path, preload=preload)
         elif raw_data_path[-3:] == 'gdf':
             print('...Importing raw .gdf file...')
-            raw = mne.io.read_raw_gdf(raw_data_path, preload=True)
+            with self.timer.stage('load_raw'):
+                raw = mne.io.read_raw_gdf(raw_data_path, preload=preload)
         else:
             print('WARNING!')
             print('Extension type not recognized for this function!')
@@ -179,7 +461,8 @@ class ReadEEG:
 
         """
         # Just run the one command line from NME to get event data.
-        events = mne.read_events(event_data_path)
+        with self.timer.stage('load_events'):
+            events = mne.read_events(event_data_path)
         return events
 
     def __get_mne_ready_data(self, raw_data_path, event_data_path, montage_type='easycap-M1'):
@@ -297,15 +580,17 @@ class ReadEEG:
         # Just run a default notch filter at 60 Hz
 
         if notch_filt is True:
-            raw.notch_filter(np.arange(60, 120, 60), picks=picks, filter_length='auto',
-                             phase='zero')
+            with self.timer.stage('notch'):
+                raw.notch_filter(np.arange(60, 120, 60), picks=picks, filter_length='auto',
+                                 phase='zero')
 
             # Print debug statements
         print("...Finished with notch filtering...")
         print(" ")
         print('...Starting band pass filtering...')
         # Filter the time series based on a bandpass filter, with the given filt_method
-        raw.filter(bp_low, bp_high, method=filt_method, picks=picks)
+        with self.timer.stage('bandpass'):
+            raw.filter(bp_low, bp_high, method=filt_method, picks=picks)
 
         print("...Finished with filtering...")
 
@@ -333,12 +618,165 @@ class ReadEEG:
         print('...Building epochs...')
 
         # Epoching and Artifact Rejection
-        epochs = mne.Epochs(raw, events, event_id, tmin, tmax, proj=False, baseline=None, picks=picks, preload=True,
-                            detrend=0)
+        with self.timer.stage('epoching'):
+            epochs = mne.Epochs(raw, events, event_id, tmin, tmax, proj=False, baseline=None, picks=picks,
+                                preload=True, detrend=0)
 
         # Return vals
         return epochs
 
+    def __build_epochs_low_memory(self, raw_data_path, event_data_path, montage_type='easycap-M1',
+                                  tmin=3, tmax=8, event_id=dict(resting=1, stim13=2, stim17=3, stim21=4),
+                                  picks_val='Default', notch_filt=True, bp_low=6, bp_high=25,
+                                  filt_method='iir', detrend_val=0):
+        """
+        Low memory version of `build_epochs`. The recording is not loaded, only the
+        samples of each [tmin, tmax] event window plus `segment_pad` seconds on
+        each side are read from the file (overlapping windows are read together,
+        up to 60 s at a time). Every segment is filtered on its own
+        with the same filters as `build_epochs` (the padding absorbs the filter
+        edge effects), then cut to the epoch.
+
+        Parameters
+        ----------
+        raw_data_path : str
+            Full path to the raw data.
+        event_data_path : str
+            Full path to the event data file.
+        montage_type : str, optional
+            Electrode montage to use with the data. The default is 'easycap-M1'.
+        tmin, tmax, event_id, picks_val, notch_filt, bp_low, bp_high, filt_method, detrend_val
+            Same as for `build_epochs`. Only the 'Default' (EEG) picks are supported.
+
+        Returns
+        -------
+        epochs : CachedEpochs
+            Provides `get_data()`, `events`, `event_id`, `tmin` and `info`.
+
+        See Also
+        --------
+        build_epochs
+
+        """
+        if picks_val.casefold() != 'Default'.casefold():
+            print('WARNING!!!! Low memory epoching only supports the `Default` picks!')
+            return
+
+        raw = self.__get_raw_data(raw_data_path, montage_type, preload=False)
+        events = self.__get_event_data(event_data_path)
+        picks = mne.pick_types(raw.info, meg=False, eeg=True, stim=False, eog=False)
+        sfreq = raw.info['sfreq']
+
+        # Same samples as mne.Epochs: tmin to tmax inclusive, relative to the event sample
+        start_offset = int(round(tmin * sfreq))
+        n_times = int(round(tmax * sfreq)) - start_offset + 1
+        pad = int(round(self.segment_pad * sfreq))
+
+        # Keep the events of interest whose window lies inside the recording
+        onsets = events[:, 0] - raw.first_samp + start_offset
+        keep = np.isin(events[:, 2], list(event_id.values())) & (onsets >= 0) & (onsets + n_times <= raw.n_times)
+        events = events[keep]
+        onsets = onsets[keep]
+
+        print('...Reading and filtering ' + str(len(events)) + ' event windows of ' +
+              os.path.basename(raw_data_path) + '...')
+        # Overlapping padded windows are merged into one segment (of at most 60 s) so
+        # shared samples are only read and filtered once
+        max_segment = int(60 * sfreq)
+        segments = []
+        for indx, onset in enumerate(onsets):
+            start = max(onset - pad, 0)
+            stop = min(onset + n_times + pad, raw.n_times)
+            if segments and start <= segments[-1][1] and stop - segments[-1][0] <= max_segment:
+                segments[-1][1] = stop
+                segments[-1][2].append(indx)
+            else:
+                segments.append([start, stop, [indx]])
+
+        data = np.empty((len(events), len(picks), n_times))
+        n_read = 0
+        for start, stop, indices in segments:
+            with self.timer.stage('read_segment'):
+                segment = raw.get_data(picks=picks, start=start, stop=stop)
+            n_read += stop - start
+
+            if notch_filt is True:
+                with self.timer.stage('notch'):
+                    segment = mne.filter.notch_filter(segment, sfreq, np.arange(60, 120, 60),
+                                                      filter_length='auto', phase='zero', verbose=False)
+            with self.timer.stage('bandpass'):
+                segment = mne.filter.filter_data(segment, sfreq, bp_low, bp_high, method=filt_method, verbose=False)
+
+            for indx in indices:
+                epoch = segment[:, onsets[indx] - start:onsets[indx] - start + n_times]
+                # Constant (DC) detrend, as in build_epochs
+                data[indx] = epoch - epoch.mean(axis=-1, keepdims=True)
+
+        print('...Read ' + str(n_read) + ' of ' + str(raw.n_times) + ' samples per channel, peak RSS ' +
+              f'{peak_rss_mb():.1f}' + ' MB...')
+
+        return CachedEpochs(data, events, event_id, sfreq, [raw.ch_names[pick] for pick in picks],
+                            start_offset / sfreq)
+
+    def __get_epochs(self, raw_data_path, event_data_path, montage_type='easycap-M1',
+                     tmin=3, tmax=8, event_id=dict(resting=1, stim13=2, stim17=3, stim21=4),
+                     picks_val='Default', notch_filt=True, bp_low=6, bp_high=25,
+                     filt_method='iir', detrend_val=0):
+        """
+        Get preprocessed epochs for a recording, served from the epoch cache when
+        the same file has already been processed with the same settings.
+
+        Parameters
+        ----------
+        raw_data_path : str
+            Full path to the raw data.
+        event_data_path : str
+            Full path to the event data file.
+        montage_type : str, optional
+            Electrode montage to use with the data. The default is 'easycap-M1'.
+        tmin, tmax, event_id, picks_val, notch_filt, bp_low, bp_high, filt_method, detrend_val
+            Passed on to `build_epochs`, see there for details. All of them are
+            part of the cache key.
+
+        Returns
+        -------
+        epochs : Epoch object or CachedEpochs
+            MNE Epochs on a cache miss, memory mapped CachedEpochs on a hit. Both
+            provide `get_data()` and `events`.
+
+        See Also
+        --------
+        build_epochs
+        epoch_cache.EpochCache
+
+        """
+        epoch_params = dict(tmin=tmin, tmax=tmax, event_id=event_id, picks_val=picks_val,
+                            notch_filt=notch_filt, bp_low=bp_low, bp_high=bp_high,
+                            filt_method=filt_method, detrend_val=detrend_val)
+
+        if self._epoch_cache is not None:
+            # Low memory epochs are filtered per segment, so they are cached separately
+            low_memory_params = dict(segment_pad=self.segment_pad) if self.low_memory else {}
+            key = self._epoch_cache.make_key(raw_data_path, event_data_path,
+                                             montage_type=montage_type, **epoch_params, **low_memory_params)
+            with self.timer.stage('epoch_cache_load'):
+                epochs = self._epoch_cache.load(key)
+            if epochs is not None:
+                print('...Loaded cached epochs for ' + os.path.basename(raw_data_path) + '...')
+                return epochs
+
+        if self.low_memory:
+            epochs = self.__build_epochs_low_memory(raw_data_path, event_data_path, montage_type, **epoch_params)
+        else:
+            raw, events = self.__get_mne_ready_data(raw_data_path, event_data_path, montage_type)
+            epochs = self.__build_epochs(raw, events, **epoch_params)
+
+        if self._epoch_cache is not None and epochs is not None:
+            print('...Saving epochs to the cache...')
+            self._epoch_cache.store(key, epochs)
+
+        return epochs
+
     def __run_ica_rejection(self, epochs, n_components=None, random_state=42,
                             method='fastica', fit_params=None, max_iter=200,
                             make_plots=False):
@@ -416,7 +854,7 @@ class ReadEEG:
                                   random_state=42, RG_Pipeline_Num=0,
                                   estimator='lwf',
                                   class_names=['Rest', '13 Hz', '17 Hz', '21 Hz'],
-                                  accuracy_threshold=0.7):
+                                  accuracy_threshold=0.7, n_jobs=-1, make_plots=False):
         """
         Complete a stratified cross-validation using Riemannian Geometery pipeline.
 
@@ -439,7 +877,7 @@ class ReadEEG:
             The default is 42.
         RG_Pipeline_Num : int, optional
             Which pre-defined Riemannian Geometery pipeline to run for analysis.
-            Can be 0,1,2,3:
+            Can be 0,1,2,3,4:
                 Pipeline 0:
                     Covariance w/ estimator -> Riemannian KNN
                 Pipeline 1:
@@ -451,6 +889,8 @@ class ReadEEG:
                 Pipeline 3:
                     Covariance w/ estimator -> MDM.
                     Minimum distance to mean (MDM) is the main classification scheme.
+                Pipeline 4:
+                    CCA against sine/cosine references, needs no training.
             The default is 0.
         estimator : str, optional
             Covariance matrix estimator to use. For regularization consider 'lwf'
@@ -464,6 +904,13 @@ class ReadEEG:
             above the threshold (e.g. 70% or greater) will be reported as good fit
             folds.
             The default is 0.7.
+        n_jobs : int, optional
+            Number of folds evaluated in parallel threads, each with its own clone of
+            the pipeline. -1 uses all cores. See joblib.Parallel for more details.
+            The default is -1.
+        make_plots : bool, optional
+            Plot a confusion matrix for every fold once all folds are finished.
+            The default is False.
 
         Returns
         -------
@@ -477,6 +924,8 @@ class ReadEEG:
                 Indices for `bad` test folds < given accuracy_threshold value - 'Bad Test Ind'
                 List of predicted classes from the RG Pipeline - 'Prediction List'
                 List of true classes from the RG Pipeline - 'True Class List'
+                Time in seconds to fit each fold - 'Fit Time'
+                Time in seconds to predict each fold - 'Predict Time'
 
         See Also
         --------
@@ -498,30 +947,12 @@ class ReadEEG:
                                    random_state=random_state)  # Requires us to input in the ylabels as well...need to figure out how to get this.
 
         # Run one of the pre-defined pipelines
-        if RG_Pipeline_Num == 1:
-            clf = make_pipeline(Covariances(estimator=estimator),
-                                CSP(log=False), TangentSpace(),
-                                LogisticRegression(class_weight='balanced',
-                                                   max_iter=500))
-        elif RG_Pipeline_Num == 2:
-            clf = make_pipeline(XdawnCovariances(estimator=estimator,
-                                                 xdawn_estimator=estimator),
-                                TangentSpace(),
-                                LogisticRegression(penalty='elasticnet', class_weight=None, solver='saga',
-                                                   multi_class='multinomial', l1_ratio=0.5,
-                                                   max_iter=500))
-        elif RG_Pipeline_Num == 3:
-            clf = make_pipeline(Covariances(estimator=estimator), MDM())  # This is the best so far
-        else:
-            print("...Running a default pipeline for RG using Covariance, and KNN...")
-            clf = make_pipeline(Covariances(estimator=estimator), riem_KNN())
+        clf = build_rg_pipeline(RG_Pipeline_Num, estimator, sfreq=epochs.info['sfreq'])
 
         # Get the labels for the data
         labels = epochs.events[:, -1]
         # Identify the data itself
         X_data = epochs.get_data()
-        # Get the class names for the confusion matrix
-        class_names = class_names
 
         # Make empty lists for each item in the stratified CV
         acc_list = []
@@ -531,21 +962,29 @@ class ReadEEG:
         good_test_indx = []
         bad_train_indx = []
         bad_test_indx = []
-
-        # For loop testing each iteration of the stratified cross-validation
-        for train_idx, test_idx in cv_strat.split(X_data, labels):
-            # Get the x_train and x_test data for this fold
-            x_train, x_test = X_data[train_idx], X_data[test_idx]
-            # Get the y_train and y_test data for this fold
-            y_train, y_test = labels[train_idx], labels[test_idx]
-            # Fit the classifier
-            clf.fit(x_train, y_train)
-            # Find the predicted value on the test data in this fold
-            preds = clf.predict(x_test)
+        fit_time_list = []
+        predict_time_list = []
+
+        # Estimate the covariances once, every fold is then served from the cache
+        if isinstance(clf.steps[0][1], CachedCovariances):
+            precompute_covariances(X_data, estimator)
+
+        # Fit and test every fold in parallel threads, each with its own copy of the pipeline
+        folds = list(cv_strat.split(X_data, labels))
+        fold_results = Parallel(n_jobs=n_jobs, prefer='threads')(
+            delayed(_evaluate_fold)(clone(clf), X_data, labels, train_idx, test_idx) for train_idx, test_idx in folds)
+
+        # Go through the results of each iteration of the stratified cross-validation
+        for (train_idx, test_idx), (preds, fit_time, predict_time) in zip(folds, fold_results):
+            # Get the y_test data for this fold
+            y_test = labels[test_idx]
             # Save in list
             preds_list.append(preds)
             # Save the true class labels in a list for this fold
             true_class_list.append(y_test)
+            # Save the timings of this fold
+            fit_time_list.append(fit_time)
+            predict_time_list.append(predict_time)
             # Find the accuracy on average from this prediction
             acc_mean = np.average(preds == y_test)
             # Save the accuracy to a list
@@ -561,17 +1000,45 @@ class ReadEEG:
             else:
                 bad_train_indx.append(train_idx)
                 bad_test_indx.append(test_idx)
-            # Make a plot for the confusion matrix
-            fig = plt.figure()
-            plot_confusion_matrix(y_test, preds, class_names)
         # Print out the final results from across all folds on average
         print("The overall accuracy with " + str(n_strat_folds) + "-fold stratified CV was: ", np.average(acc_list))
+        print("Mean fit time per fold: " + f'{np.mean(fit_time_list):.3f}' + " s, mean predict time per fold: " +
+              f'{np.mean(predict_time_list):.3f}' + " s")
+
+        validation = dict({'Fold Acc': acc_list, 'Good Train Ind': good_train_indx,
+                           'Good Test Ind': good_test_indx, 'Bad Train Ind': bad_train_indx,
+                           'Bad Test Ind': bad_test_indx, 'Prediction List': preds_list,
+                           'True Class List': true_class_list, 'Fit Time': fit_time_list,
+                           'Predict Time': predict_time_list})
+
+        # Plotting is done after all folds are finished
+        if make_plots is True:
+            self.__plot_validation_results(validation, class_names)
 
         # Return output vals
-        return dict({'Fold Acc': acc_list, 'Good Train Ind': good_train_indx,
-                     'Good Test Ind': good_test_indx, 'Bad Train Ind': bad_train_indx,
-                     'Bad Test Ind': bad_test_indx, 'Prediction List': preds_list,
-                     'True Class List': true_class_list})
+        return validation
+
+    def __plot_validation_results(self, validation, class_names=['Rest', '13 Hz', '17 Hz', '21 Hz']):
+        """
+        Plot a confusion matrix for every fold of a stratified cross-validation.
+
+        Parameters
+        ----------
+        validation : dict
+            Output of `run_strat_validation_RG`.
+        class_names : List, optional
+            List of names for the confusion matrix plot.
+            The default is ['Rest','13 Hz','17 Hz','21 Hz'].
+
+        Returns
+        -------
+        None.
+
+        """
+        for y_test, preds in zip(validation['True Class List'], validation['Prediction List']):
+            # Make a plot for the confusion matrix
+            fig = plt.figure()
+            plot_confusion_matrix(y_test, preds, class_names)
 
     def __train_predefined_classifier(self, epochs, RG_Pipeline_Num=0, estimator='lwf',
                                       estimate_accuracy=False, random_state=44,
@@ -587,7 +1054,7 @@ class ReadEEG:
             mne.Epochs, or using the `build_epochs` command included in this script.
         RG_Pipeline_Num :int, optional
             Which pre-defined Riemannian Geometery pipeline to run for analysis.
-            Can be 0,1,2,3:
+            Can be 0,1,2,3,4:
                 Pipeline 0:
                     Covariance w/ estimator -> Riemannian KNN
                 Pipeline 1:
@@ -599,6 +1066,8 @@ class ReadEEG:
                 Pipeline 3:
                     Covariance w/ estimator -> MDM.
                     Minimum distance to mean (MDM) is the main classification scheme.
+                Pipeline 4:
+                    CCA against sine/cosine references, needs no training.
             The default is 0.
         estimator :  str, optional
             Covariance matrix estimator to use. For regularization consider 'lwf'
@@ -636,23 +1105,7 @@ class ReadEEG:
         """
 
         # Run one of the pre-defined pipelines
-        if RG_Pipeline_Num == 1:
-            clf = make_pipeline(Covariances(estimator=estimator),
-                                CSP(log=False), TangentSpace(),
-                                LogisticRegression(class_weight='balanced',
-                                                   max_iter=500))
-        elif RG_Pipeline_Num == 2:
-            clf = make_pipeline(XdawnCovariances(estimator=estimator,
-                                                 xdawn_estimator=estimator),
-                                TangentSpace(),
-                                LogisticRegression(penalty='elasticnet', class_weight=None, solver='saga',
-                                                   multi_class='multinomial', l1_ratio=0.5,
-                                                   max_iter=500))
-        elif RG_Pipeline_Num == 3:
-            clf = make_pipeline(Covariances(estimator=estimator), MDM())  # This is the best so far
-        else:
-            print("...Running a default pipeline for RG using Covariance, and KNN...")
-            clf = make_pipeline(Covariances(estimator=estimator), riem_KNN())
+        clf = build_rg_pipeline(RG_Pipeline_Num, estimator, sfreq=epochs.info['sfreq'])
 
         # Get the labels for the data
         labels = epochs.events[:, -1]
@@ -681,110 +1134,94 @@ class ReadEEG:
             plot_confusion_matrix(y_test, pred_vals, class_names)
 
         # Fit the data to the given epoch information
-        clf.fit(X_data, labels)
+        with self.timer.stage('fit'):
+            clf.fit(X_data, labels)
 
         return clf
 
-    def __setup_output_stream(self, stream_name, stream_type):
+    def __get_trained_classifier(self, epochs, RG_Pipeline_Num=0, estimator='lwf'):
         """
-        Initialize a LSL outlet of particular name and type
+        Get a trained pre-defined pipeline, loaded from the model store when the
+        same pipeline has already been trained on the same epochs.
 
         Parameters
         ----------
-        stream_name : str
-            Name of LSL outlet to initialize. Can be anything.
-        stream_type : str
-            Type of LSL outlet to initialze. Typical choices are 'marker', 'data',
-            or 'eeg'.
+        epochs : Epoch Object from MNE or CachedEpochs
+            Training epochs.
+        RG_Pipeline_Num, estimator : optional
+            Passed on to `train_predefined_classifier`, see there for details.
 
         Returns
         -------
-        outlet : LSL Outlet
-            Creates a LSL-ready outlet for streaming data over the network.
-
-        """
-        # Identify the type of data we are sending back.
-        if stream_type.casefold() == 'marker'.casefold():
-            info = StreamInfo(stream_name, stream_type, channel_count=1,
-                              nominal_srate=0, channel_format='string',
-                              source_id='single314uid')
-        elif stream_type.casefold() == 'data'.casefold():
-            info = StreamInfo(stream_name, stream_type, channel_count=1,
-                              nominal_srate=0,
-                              source_id='single314uid')
+        clf : Classifier object (sklearn)
+            Trained pipeline.
 
-        # Make the stream outlet using the infor provided above
-        print('...setting up LSL outlet object...')
-        outlet = StreamOutlet(info)
+        See Also
+        --------
+        train_predefined_classifier
+        model_store.ModelStore
 
-        return outlet
+        """
+        if self._model_store is None:
+            return self.__train_predefined_classifier(epochs, RG_Pipeline_Num=RG_Pipeline_Num,
+                                                      estimator=estimator, estimate_accuracy=False)
+
+        # The training data fingerprint covers the recording and its preprocessing,
+        # the unfitted pipeline covers every pipeline parameter
+        key = self._model_store.make_key(epochs.get_data(), epochs.events[:, -1],
+                                         build_rg_pipeline(RG_Pipeline_Num, estimator, sfreq=epochs.info['sfreq']),
+                                         pipeline=RG_Pipeline_Num, estimator=estimator,
+                                         sfreq=epochs.info['sfreq'], ch_names=epochs.info['ch_names'],
+                                         tmin=epochs.tmin, event_id=epochs.event_id)
+        tstart = time.perf_counter()
+        with self.timer.stage('model_load'):
+            clf = self._model_store.load(key)
+        if clf is not None:
+            print('...Loaded trained pipeline from the model store in ' +
+                  f'{(time.perf_counter() - tstart) * 1000:.1f}' + ' ms...')
+            return clf
+
+        clf = self.__train_predefined_classifier(epochs, RG_Pipeline_Num=RG_Pipeline_Num,
+                                                 estimator=estimator, estimate_accuracy=False)
+        print('...Saving trained pipeline to the model store...')
+        self._model_store.store(key, clf, pipeline=RG_Pipeline_Num, estimator=estimator)
+        return clf
 
-    def __stream_class_output(self, data_to_stream, outlet, init_stream=False,
-                              stream_name='PythonOut', stream_type='Marker'):
+    def __setup_prediction_stream(self, clf, stream_name='PythonOut', stream_type='Prediction', source_id=None):
         """
-        Stream data from python to the network using LSL outlet.
+        Initialize a numeric LSL outlet for the decisions of a trained classifier.
+        Channel 0 holds the predicted class, followed by one probability channel
+        per class if the classifier supports predict_proba.
 
         Parameters
         ----------
-        data_to_stream : np.ndarray|list|str
-            Data that will be streamed to the network.
-        outlet : LSL Outlet
-            LSL outlet object used to stream the data. See setup_output_stream and
-            pylsl.StreamOutlet for more information.
-        init_stream : bool, optional
-            Initialize an outlet stream using the 'setup_output_stream' function.
-            The default is False.
+        clf : Classifier object (sklearn)
+            Trained classifier, its `classes_` give the probability channel order.
         stream_name : str, optional
-            Name of stream for the outlet. ONLY REQUIRED IF INIT_STREAM IS TRUE!
-            The default is 'PythonOut'.
+            Name of LSL outlet to initialize. The default is 'PythonOut'.
         stream_type : str, optional
-            Type of outlet stream to be used. ONLY REQUIRED IF INIT_STREAM IS TRUE!
-            The default is 'Marker'.
+            Type of LSL outlet to initialize. The default is 'Prediction'.
+        source_id : str, optional
+            Unique identifier of the outlet. The default is None, which uses the
+            stream name and type.
 
         Returns
         -------
-        None. The LSL outlet is used to stream this data.
-
-        See Also
-        --------
-        pylsl.StreamOutlet
+        outlet : lsl_streams.PredictionOutlet
+            Outlet with push/push_batch/flush methods.
 
         """
+        print('...setting up LSL prediction outlet...')
+        return PredictionOutlet(stream_name, stream_type, class_labels=clf.classes_,
+                                include_proba=hasattr(clf, 'predict_proba'), source_id=source_id)
 
-        if init_stream == True:
-            outlet = self.__setup_output_stream(stream_name, stream_type)
-
-        # Print statment this is working
-        print('...sending predicted class via LSL outlet...')
-
-        # How to send the data if it is in an Numpy Array or list
-        if isinstance(data_to_stream, np.ndarray) or isinstance(data_to_stream, list):
-            print('...Output data held as a numeric, sending to LSL...')
-            # List comprehension to print each class prediction in the numpy array as a string
-            [outlet.push_sample(str(class_pred)) for class_pred in data_to_stream]
-            # Debug print statement!
-            [print('DEBUG: This was sent to LSL: ' + str(class_pred)) for indx, class_pred in enumerate(data_to_stream)]
-
-        elif isinstance(data_to_stream, str):
-            print('...Output data held as a string, sending to LSL...')
-            [outlet.push_sample(str(class_pred)) for class_pred in data_to_stream]
-            # Debug print statement!
-            [print('DEBUG: This was sent to LSL: ' + str(class_pred)) for indx, class_pred in enumerate(data_to_stream)]
-
-        else:
-            print('...Output data not recognized - trying something else...')
-            # Haven't actually tried anything new here - will work on this when
-            # such a bug happens.
-            [outlet.push_sample(str(class_pred)) for class_pred in data_to_stream]
-            [print('DEBUG: This was sent to LSL: ' + str(class_pred)) for indx, class_pred in enumerate(data_to_stream)]
-
-        # Return output vals
-        return
-
-    def __stream_in_class(self, prop_to_search, name_to_search, active_time=60, timeout_for_resolve=15):
+    def __stream_in_class(self, prop_to_search, name_to_search, active_time=60, timeout_for_resolve=15,
+                          buffer_time=60):
         """
         Create LSL inlet and stream in data from LSL outlet of given property and
-        name.
+        name. Samples are pulled in chunks on a background thread into a
+        preallocated ring buffer (see lsl_streams.RingBufferInlet), so memory use
+        is bounded by buffer_time however long the stream runs.
 
         Parameters
         ----------
@@ -793,20 +1230,25 @@ class ReadEEG:
             'eeg','marker','data'.
         name_to_search : str
             Name of LSL outlet to search
-        active_time : int, optional
-            Time in seconds to actively stream in data from LSL outlet.
+        active_time : int or True, optional
+            Time in seconds to actively stream in data from LSL outlet. If True,
+            stream until the maximum run time of 4 hours.
             The default is 60.
         timeout_for_resolve : int, optional
             Time in seconds to wait on searching for a given LSL outlet stream with
             the given property type and name.
             The default is 15.
+        buffer_time : int, optional
+            Length of the ring buffer in seconds, i.e. the amount of data returned.
+            The default is 60.
 
         Returns
         -------
-        sample_list : List
-            List of data read into the LSL inlet from LSL outlet.
-        timestamp_list : List
-            List of time stamps for each specific sample read in from the LSL outlet.
+        sample_list : np.ndarray
+            Latest samples read into the LSL inlet from LSL outlet, (n_samples, n_channels).
+            At most buffer_time seconds of data.
+        timestamp_list : np.ndarray
+            Time stamps for each specific sample read in from the LSL outlet.
 
         """
         # Find active streams
@@ -822,58 +1264,241 @@ class ReadEEG:
             return
 
         print("...Streams found!...")
-        inlet = StreamInlet(active_streams[0])
-        sample_list = []
-        timestamp_list = []
 
-        if active_time is not bool:
-            # Get the start time
-            tstart = time.time()
+        if active_time is True:
+            # Maximum run condition for the moment to avoid permanently locking the system.
+            active_time = 60 * 60 * 4  # This is 4 hours of sampling
 
-            print("...Starting to pull samples...")
+        reader = RingBufferInlet(active_streams[0], buffer_time=buffer_time)
 
-            while time.time() < tstart + active_time:
-                # Print that the stream was found!
+        print("...Starting to pull samples...")
+        reader.start()
+        time.sleep(active_time)
+        reader.stop()
 
-                # Pull the sample
-                sample, timestamp = inlet.pull_sample()
-                sample_list.append(sample)
-                timestamp_list.append(timestamp)
-                # Return output vals
-                print('Predicted value is: ' + str(sample))
+        # Let them know the active stream is shutting down!
+        print("...Active stream active time is done! Stopping stream...")
+        stats = reader.stats()
+        print("...Received " + str(stats['samples']) + " samples, " + str(stats['dropped']) + " dropped...")
 
-            # Let them know the active stream is shutting down!
-            print("...Active stream active time is done! Stopping stream...")
+        # Copy out of the ring buffer, the views are reused by the next acquisition
+        sample_list, timestamp_list = reader.latest(reader.capacity)
 
-        else:
-            # Find when this loop started
-            tstart = time.time()
-            max_runtime = 60 * 60 * 4  # This is 4 hours of sampling
+        # Return output vals
+        print("...All streams finished! Ending function...")
+        return sample_list.copy(), timestamp_list.copy()
 
-            print("...Starting to pull samples...")
+    def __classify_online_stream(self, serial_stream, clf, window_samples=None, window_time=5, window_hop=0.5,
+                                 stream_type='EEG', active_time=60, timeout_for_resolve=15,
+                                 notch_filt=True, bp_low=6, bp_high=25, stream_name='PythonOut',
+                                 track_echo=False, smoother=None):
+        """
+        Classify live EEG from a LSL inlet with overlapping sliding windows.
 
-            while active_time is True:
+        Chunks pulled from the inlet are filtered causally with a StreamingFilterBank
+        and appended to a window buffer. Every `window_hop` seconds the latest window
+        is classified with the trained pipeline and the decision is sent over the
+        serial stream.
 
-                sample, timestamp = inlet.pull_sample()
-                sample_list.append(sample)
-                timestamp_list.append(timestamp)
-                # Return output vals
-                print('Predicted value is: ' + str(sample))
+        The end-to-end latency of every decision, from the last EEG sample of the
+        window to classification, serial write, LSL push and (optionally) the device
+        echo, is tracked in `self.latency_tracker` (a DecisionLatencyTracker).
 
-                # Maximum run condition for the moment to avoid permanently locking the system.
-                if time.time() > tstart + max_runtime:
-                    break
-                print("...Active stream timed out! Stopping stream...")
+        Parameters
+        ----------
+        serial_stream : Serial Object
+            Used to externally communicate with serial devices.
+        clf : Classifier object (sklearn)
+            Trained pipeline, see `train_predefined_classifier`.
+        window_samples : int, optional
+            Length of each decision window in samples. This must match the number
+            of samples in the epochs the classifier was trained on. If None, the
+            window is `window_time` seconds long at the stream sampling rate.
+            The default is None.
+        window_time : float, optional
+            Length of each decision window in seconds, only used if window_samples
+            is None. The default is 5 (tmax - tmin of `build_epochs`).
+        window_hop : float, optional
+            Time in seconds between two decisions. The default is 0.5.
+        stream_type : str, optional
+            Type of the LSL outlet holding the EEG data. The channels must be the
+            same (and in the same order) as the ones used for training.
+            The default is 'EEG'.
+        active_time : int, optional
+            Time in seconds to classify the stream for. The default is 60.
+        timeout_for_resolve : int, optional
+            Time in seconds to wait on searching for the LSL outlet.
+            The default is 15.
+        notch_filt, bp_low, bp_high : optional
+            Filter settings, should be the same as the ones used for `build_epochs`.
+        stream_name : str, optional
+            Name of the LSL outlet the decisions are sent on. The default is 'PythonOut'.
+        track_echo : bool, optional
+            Read the device's "data is: ..." echo of each command from the serial
+            stream to measure the latency up to the device. The serial stream needs
+            a read timeout. The default is False.
+        smoother : DecisionSmoother, optional
+            Gates the decisions with their class probabilities before they are sent,
+            low confidence and outvoted decisions send nothing. The raw prediction is
+            the most probable class. If None, every prediction is sent.
+            The default is None.
 
-        # Return output vals
-        print("...All streams finished! Ending function...")
-        return sample_list, timestamp_list
+        Returns
+        -------
+        dict({'Predicted', 'Timestamps', 'Latency', 'End To End'})
+            Predicted - Predicted class of each window.
+            Timestamps - LSL timestamp (local clock) of the last sample in each window.
+            Latency - Time in seconds from the last sample of each window to the
+                      decision being sent.
+            End To End - Latency statistics of each stage, see
+                         DecisionLatencyTracker.summary.
+            With a smoother, 'Smoothed' holds the decision sent for each window
+            (NO_OP for none) and 'Smoothing' its statistics, see DecisionSmoother.stats.
+
+        """
+        print("...Searching for active EEG streams...")
+        active_streams = resolve_byprop('type', stream_type, timeout=timeout_for_resolve)
+
+        if not active_streams:
+            print(" ")
+            print("...WARNING!!...")
+            print("...No active streams found!...")
+            print("...Stopping function...")
+            print(" ")
+            return
+
+        # Chunks are acquired on a background thread, timestamps are corrected to the local clock
+        reader = RingBufferInlet(active_streams[0], buffer_time=max(30.0, 4 * window_hop))
+        sfreq = reader.sfreq
+        n_channels = reader.n_channels
+        print("...Streaming from " + reader.name + ": " + str(n_channels) + " channels at " + str(sfreq) + " Hz...")
+
+        if window_samples is None:
+            # Epochs include both the tmin and tmax samples
+            window_samples = int(round(window_time * sfreq)) + 1
+        # The training-free CCA classifier builds its references for the stream rate
+        if isinstance(clf[-1], CCAClassifier) and clf[-1].sfreq is None:
+            clf[-1].set_params(sfreq=sfreq)
+
+        filter_bank = StreamingFilterBank(sfreq, n_channels, notch_filt=notch_filt,
+                                          bp_low=bp_low, bp_high=bp_high)
+        outlet = self.__setup_prediction_stream(clf, stream_name)
+        hop_samples = max(1, int(round(window_hop * sfreq)))
+
+        window = np.zeros((window_samples, n_channels))
+        n_filled = 0
+        since_decision = 0
+        first_chunk = True
+
+        predicted = []
+        window_timestamps = []
+        latencies = []
+
+        if smoother is not None:
+            smoother.reset(clf.classes_)
+
+        self.latency_tracker = DecisionLatencyTracker()
+        if track_echo:
+            self.latency_tracker.listen_for_echo(serial_stream, reader=self.serial_protocol.reader())
+
+        print("...Starting online classification...")
+        reader.start()
+        tstart = time.time()
+        while time.time() < tstart + active_time:
+            if not reader.wait_for_samples(1, timeout=window_hop):
+                continue
+            chunk, timestamps = reader.read_new()
+
+            chunk = np.asarray(chunk, dtype=float)
+            if first_chunk:
+                # Start the filters from the first sample to avoid a DC transient
+                filter_bank.reset(initial=chunk[0])
+                first_chunk = False
+            with self.timer.stage('stream_filter'):
+                chunk = filter_bank.process(chunk)
+
+            # Shift the new samples into the end of the window
+            n_new = min(chunk.shape[0], window_samples)
+            window[:-n_new] = window[n_new:]
+            window[-n_new:] = chunk[-n_new:]
+            n_filled = min(n_filled + chunk.shape[0], window_samples)
+            since_decision += chunk.shape[0]
+
+            if n_filled < window_samples or since_decision < hop_samples:
+                continue
+            since_decision = 0
+
+            # Latencies are measured from the (time corrected) LSL timestamp of the last sample
+            last_sample_time = timestamps[-1]
+            decision = self.latency_tracker.start(last_sample_time)
+
+            # Classify the latest window, the pipeline expects (n_epochs, n_channels, n_times)
+            proba = None
+            with self.timer.stage('predict'):
+                if smoother is None and not outlet.include_proba:
+                    pred = clf.predict(window.T[np.newaxis])[0]
+                else:
+                    # A single pass of the pipeline gives both the probabilities and the prediction
+                    proba = class_probabilities(clf, window.T[np.newaxis])[0]
+                    pred = clf.classes_[np.argmax(proba)]
+            self.latency_tracker.mark(decision, 'classified')
+
+            command = pred
+            if smoother is not None:
+                with self.timer.stage('smooth'):
+                    command = smoother.update(proba)
+
+            if command != NO_OP:
+                direction = self.DIRECTION_CONVERT[command]
+                # serial_written is marked by the writer thread once the bytes are sent
+                if self.__send_data(serial_stream, direction,
+                                    on_written=lambda decision=decision: self.latency_tracker.mark(
+                                        decision, 'serial_written')):
+                    self.latency_tracker.expect_echo(decision, 'd/' + direction)
+
+            outlet.push(pred, proba=proba)
+            predicted.append(pred)
+            window_timestamps.append(last_sample_time)
+
+            # The decisions queued in this iteration are sent with a single push_chunk
+            with self.timer.stage('lsl_push'):
+                outlet.flush()
+            self.latency_tracker.mark(decision, 'lsl_pushed')
+            latencies.append(local_clock() - last_sample_time)
+
+        reader.stop()
+        self.close_serial_writer()
+        self.latency_tracker.stop()
+
+        stats = reader.stats()
+        print("...Online classification finished after " + str(len(predicted)) + " decisions...")
+        print("...Samples received: " + str(stats['samples']) + ", dropped: " + str(stats['dropped']) +
+              ", overflowed: " + str(stats['overflow']) + "...")
+        if latencies:
+            latency_ms = np.array(latencies) * 1000
+            print("...Decision latency (ms): mean " + f'{np.mean(latency_ms):.2f}' +
+                  ", median " + f'{np.median(latency_ms):.2f}' +
+                  ", 95th percentile " + f'{np.percentile(latency_ms, 95):.2f}' +
+                  ", max " + f'{np.max(latency_ms):.2f}' + "...")
+            print("...Filter time per chunk (ms): mean " + f'{filter_bank.latency_stats()["mean_ms"]:.3f}' + "...")
+            print("...End-to-end latency from the last EEG sample...")
+            print(self.latency_tracker.report())
+
+        result = dict({'Predicted': np.array(predicted), 'Timestamps': np.array(window_timestamps),
+                       'Latency': np.array(latencies), 'End To End': self.latency_tracker.summary()})
+        if smoother is not None:
+            print('...' + smoother.report(hop=window_hop) + '...')
+            result['Smoothed'] = np.array(smoother.decisions)
+            result['Smoothing'] = smoother.stats(hop=window_hop)
+        return result
 
     def simulate_SSVEP_pipeline(self, serial_stream, train_subj, test_subj, simulate_online=False,
                                 return_speed=1,
                                 trn_trial=0, tst_trial=0,
                                 run_validation=False, pipeline=1,
-                                stream_name='PythonOut', stream_type='Marker'):
+                                stream_name='PythonOut', stream_type='Marker',
+                                online_lsl=False, window_hop=0.5, online_time=60,
+                                eeg_stream_type='EEG', track_echo=False, smoother=None):
         """
         Run through and simulate a full processing pipeline based on the SSVEP exo-
         skeleton dataset. This assummes you have the given subject data of interest
@@ -909,7 +1534,7 @@ class ReadEEG:
             The default is False.
         pipeline : int, optional
             Which pre-defined Riemannian Geometery pipeline to run for analysis.
-            Can be 0,1,2,3:
+            Can be 0,1,2,3,4:
                 Pipeline 0:
                     Covariance w/ estimator -> Riemannian KNN
                 Pipeline 1:
@@ -921,6 +1546,10 @@ class ReadEEG:
                 Pipeline 3:
                     Covariance w/ estimator -> MDM.
                     Minimum distance to mean (MDM) is the main classification scheme.
+                Pipeline 4:
+                    CCA against sine/cosine references, needs no training.
+            Pipeline 4 skips the training recording (train_subj, trn_trial and
+            run_validation are not used).
             The default is 1.
         stream_name : str, optional
             Name of stream LSL outlet. ONLY REQUIRED IF SIMULATE_ONLINE IS TRUE!
@@ -928,6 +1557,28 @@ class ReadEEG:
         stream_type : str, optional
             Type of stream LSL outlet. ONLY REQUIRED IF SIMULATE_ONLINE IS TRUE!
             The default is 'Marker'.
+        online_lsl : bool, optional
+            Instead of the test recording, classify live EEG from a LSL outlet of
+            type `eeg_stream_type` with sliding windows. The test subject/trial are
+            not used in this mode. The default is False.
+        window_hop : float, optional
+            Time in seconds between decisions. ONLY USED IF ONLINE_LSL IS TRUE!
+            The default is 0.5.
+        online_time : int, optional
+            Time in seconds to classify the LSL stream for. ONLY USED IF ONLINE_LSL IS TRUE!
+            The default is 60.
+        eeg_stream_type : str, optional
+            Type of the LSL outlet with EEG data. ONLY USED IF ONLINE_LSL IS TRUE!
+            The default is 'EEG'.
+        track_echo : bool, optional
+            Measure the latency up to the device's echo of each command, see
+            `classify_online_stream`. ONLY USED IF ONLINE_LSL IS TRUE!
+            The default is False.
+        smoother : DecisionSmoother, optional
+            Smooths the decisions with their class probabilities before they are
+            sent, see `decision_smoother`. The trade-off between command count and
+            command lag of other thresholds and vote windows is printed as well.
+            If None, every prediction is sent. The default is None.
 
         Returns
         -------
@@ -935,6 +1586,10 @@ class ReadEEG:
             Returns a dictionary with 2 kewords.
                 Predicted - Predicted values of the processing pipeline.
                 True_Vals - True values for the actual test data for comparison.
+            With a smoother, 'Smoothed' holds the decision sent for each epoch
+            (NO_OP for none) and 'Smoothing' its statistics.
+            If online_lsl is True, the output of `classify_online_stream` is returned
+            instead ('Predicted', 'Timestamps', 'Latency').
 
         """
 
@@ -952,49 +1607,91 @@ class ReadEEG:
                 elif trn_trial == 1:
                     tst_trial = 0
 
-        ##Get the training data path
-        trn_data_path, trn_event_path = self.__get_subj_trial_data(self.subj_list[train_subj])
-
-        # Get the training data from the first recording
-        train_raw, train_events = self.__get_mne_ready_data(trn_data_path[trn_trial], trn_event_path[trn_trial])
-
-        trn_epochs = self.__build_epochs(train_raw, train_events)
-
-        # If run validation is true, then we will validate the pipeline as before
-        if run_validation == True:
-            trn_validation = self.__run_strat_validation_RG(trn_epochs, n_strat_folds=4, RG_Pipeline_Num=pipeline)
-
-        clf_trained = self.__train_predefined_classifier(trn_epochs, RG_Pipeline_Num=pipeline, estimate_accuracy=False)
+        if pipeline == 4:
+            # CCA needs no calibration recording, the sampling frequency is set
+            # once the test data (or the LSL stream) is known
+            print("...Using the training-free CCA classifier, skipping the training recording...")
+            clf_trained = build_rg_pipeline(4).fit(None)
+            window_samples = None
+        else:
+            ##Get the training data path
+            trn_data_path, trn_event_path = self.__get_subj_trial_data(self.subj_list[train_subj])
+
+            # Get the training epochs from the first recording
+            trn_epochs = self.__get_epochs(trn_data_path[trn_trial], trn_event_path[trn_trial])
+
+            # If run validation is true, then we will validate the pipeline as before
+            if run_validation == True:
+                trn_validation = self.__run_strat_validation_RG(trn_epochs, n_strat_folds=4, RG_Pipeline_Num=pipeline)
+
+            # Trained once per training set and pipeline, later runs load it from the model store
+            clf_trained = self.__get_trained_classifier(trn_epochs, RG_Pipeline_Num=pipeline)
+            window_samples = trn_epochs.get_data().shape[-1]
+
+        # Classify live data from a LSL stream, windows are as long as the training epochs
+        if online_lsl is True:
+            online_result = self.__classify_online_stream(serial_stream, clf_trained,
+                                                          window_samples=window_samples,
+                                                          window_hop=window_hop, stream_type=eeg_stream_type,
+                                                          active_time=online_time, track_echo=track_echo,
+                                                          smoother=smoother)
+            self.export_timing(self.timing_path)
+            return online_result
 
         ##Get the testing data path
         test_data_path, test_event_path = self.__get_subj_trial_data(self.subj_list[test_subj])
 
-        # Get the testing data from the next recording
-        test_raw, test_events = self.__get_mne_ready_data(test_data_path[tst_trial], test_event_path[tst_trial])
-
-        test_epochs = self.__build_epochs(test_raw, test_events)
+        # Get the testing epochs from the next recording
+        test_epochs = self.__get_epochs(test_data_path[tst_trial], test_event_path[tst_trial])
+        if pipeline == 4:
+            clf_trained[-1].set_params(sfreq=test_epochs.info['sfreq'])
 
         # Apply this now on the train classifier
-        predicted = clf_trained.predict(test_epochs.get_data())
+        predicted_proba = None
+        include_proba = simulate_online == True and hasattr(clf_trained, 'predict_proba')
+        with self.timer.stage('predict_batch'):
+            if smoother is None and not include_proba:
+                predicted = clf_trained.predict(test_epochs.get_data())
+            else:
+                # A single pass of the pipeline gives both the probabilities and the predictions
+                predicted_proba = class_probabilities(clf_trained, test_epochs.get_data())
+                predicted = clf_trained.classes_[np.argmax(predicted_proba, axis=1)]
+
+        # The commands sent for each epoch, NO_OP sends nothing
+        commands = predicted
+        if smoother is not None:
+            smoother.reset(clf_trained.classes_)
+            with self.timer.stage('smooth_batch'):
+                commands = smoother.smooth(predicted_proba)
+            print('...' + smoother.report(hop=return_speed) + '...')
+            print('...Command count against lag for other smoother settings...')
+            print(format_tradeoff(tradeoff(predicted_proba, clf_trained.classes_, dwell=smoother.dwell,
+                                           rest_class=smoother.rest_class, labels=test_epochs.events[:, -1],
+                                           hop=return_speed)))
 
         # If true, then we will 'simulate' running online function, by steadily
         # returning values slowly.
         if simulate_online == True:
-            outlet = self.__setup_output_stream('Sim_Prediction', 'Marker')
-            for pred in predicted:
-                # Use the LSL streaming function above
-                output_pred = str(pred)
-                # print('..The type of marker is-')
-                # print(type(output_pred))
-                self.__stream_class_output(output_pred, outlet, stream_name, stream_type)
+            outlet = self.__setup_prediction_stream(clf_trained, 'Sim_Prediction')
+            replay_times = np.empty(len(predicted))
+            for indx, pred in enumerate(predicted):
+                replay_times[indx] = local_clock()
                 print("Predicted Value: " + str(pred))
 
-                direction_convert = {1: 'nn', 2: 'ww', 3: 'ss', 4: 'ee'}
-                print('Sending data: ' + direction_convert[pred])
-                self.__send_data(serial_stream, direction_convert[pred])
+                if commands[indx] != NO_OP:
+                    print('Sending data: ' + self.DIRECTION_CONVERT[commands[indx]])
+                    self.__send_data(serial_stream, self.DIRECTION_CONVERT[commands[indx]])
 
                 time.sleep(return_speed)
 
+            # Every prediction (and its class probabilities) is sent over LSL with a single
+            # push_chunk, stamped with the time it was replayed
+            with self.timer.stage('lsl_push'):
+                outlet.push_batch(predicted, timestamps=replay_times,
+                                  proba=predicted_proba if outlet.include_proba else None)
+
+            self.close_serial_writer()
+
             # Delete the outlet
             # print('...Deleting the outlet...')
             # outlet.__del__()
@@ -1004,7 +1701,13 @@ class ReadEEG:
         accuracy = np.mean(predicted == test_epochs.events[:, -1])
         print("...The overall predicted accuracy is " + str(accuracy))
 
-        return dict({'Predicted': predicted, 'True_Vals': true_val})
+        self.export_timing(self.timing_path)
+
+        result = dict({'Predicted': predicted, 'True_Vals': true_val})
+        if smoother is not None:
+            result['Smoothed'] = commands
+            result['Smoothing'] = smoother.stats(hop=return_speed)
+        return result
 
 
 if __name__ == '__main__':
@@ -0,0 +1,152 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+On-disk cache of preprocessed epochs for ReadEEG.
+
+Loading a .fif recording, notch filtering, band pass filtering and epoching
+takes most of the time in `ReadEEG.simulate_SSVEP_pipeline`. The result only
+depends on the source files and the preprocessing settings, so it is stored
+here as .npy files that are memory mapped on the next run. Entries are written,
+read and evicted by disk_store.DiskLRUStore.
+
+Every cache entry is a directory named after its key:
+    <cache_dir>/<key>/data.npy    - epoch array (n_epochs, n_channels, n_times)
+    <cache_dir>/<key>/events.npy  - MNE event array (n_epochs, 3)
+    <cache_dir>/<key>/meta.json   - sfreq, channel names, tmin, event_id, ...
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from disk_store import DiskLRUStore
+
+
+class CachedEpochs:
+    """
+    Light-weight stand in for an mne.Epochs object served from the cache.
+    Only the parts used by the classification pipelines are provided, i.e.
+    `get_data()`, `events`, `event_id`, `tmin` and `info['sfreq']`/`info['ch_names']`.
+    """
+
+    def __init__(self, data, events, event_id, sfreq, ch_names, tmin):
+        self._data = data
+        self.events = events
+        self.event_id = dict(event_id)
+        self.tmin = tmin
+        self.info = dict(sfreq=sfreq, ch_names=list(ch_names), nchan=len(ch_names))
+
+    def get_data(self):
+        """
+        Returns the epoch array (n_epochs, n_channels, n_times). When loaded from
+        the cache this is a read only memory map.
+        """
+        return self._data
+
+    def __len__(self):
+        return len(self.events)
+
+
+class EpochCache(DiskLRUStore):
+    """
+    Persistent, size bounded cache of preprocessed epochs.
+
+    Attributes:
+    --------------------
+    cache_dir: str \n
+    max_bytes: int
+
+    Methods:
+    --------------------
+    make_key(raw_data_path, event_data_path, **params)
+        Builds the cache key for a recording and its preprocessing settings
+    load(key)
+        Returns CachedEpochs for a key, or None on a cache miss
+    store(key, epochs)
+        Saves an epoch object and evicts old entries if the cache is full
+    invalidate(key=None)
+        Removes one entry, or the whole cache if no key is given
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3, hash_files=False):
+        """
+        :param cache_dir: Directory to hold the cache entries, created if missing
+        :param max_bytes: Upper bound on the total size of the cache in bytes
+        :param hash_files: Identify source files by a hash of their content instead
+                           of their size and modification time
+        """
+        super().__init__(cache_dir, max_bytes=max_bytes, label='cached epochs')
+        self.cache_dir = cache_dir
+        self.hash_files = hash_files
+
+    def __file_identity(self, path):
+        """
+        Identity of a source file, changes whenever the file is replaced or edited
+
+        :param path: Path to the source file
+        :return: dict of path, size and either mtime or a content hash
+        """
+        stat = os.stat(path)
+        identity = dict(path=os.path.abspath(path), size=stat.st_size)
+        if self.hash_files:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            identity['sha1'] = sha.hexdigest()
+        else:
+            identity['mtime_ns'] = stat.st_mtime_ns
+        return identity
+
+    def make_key(self, raw_data_path, event_data_path, **params):
+        """
+        Builds the key for a recording and its preprocessing settings. All keyword
+        arguments (montage, filter settings, tmin/tmax, event_id, picks...) become
+        part of the key.
+
+        :param raw_data_path: Path to the raw data file
+        :param event_data_path: Path to the event file
+        :return: str, hex digest used as the entry name
+        """
+        description = dict(raw=self.__file_identity(raw_data_path),
+                           events=self.__file_identity(event_data_path),
+                           params=params)
+        encoded = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        """
+        Load a cache entry as memory mapped arrays
+
+        :param key: Key from make_key
+        :return: CachedEpochs, or None if the entry does not exist
+        """
+        def read_files(entry, meta):
+            data = np.load(os.path.join(entry, 'data.npy'), mmap_mode='r')
+            events = np.load(os.path.join(entry, 'events.npy'))
+            return CachedEpochs(data, events, meta['event_id'], meta['sfreq'],
+                                meta['ch_names'], meta['tmin'])
+
+        return self.read_entry(key, read_files)
+
+    def store(self, key, epochs):
+        """
+        Save an epoch object to the cache, then evict the least recently used
+        entries until the cache fits in max_bytes.
+
+        :param key: Key from make_key
+        :param epochs: mne.Epochs (or CachedEpochs) to store
+        :return: None
+        """
+        def write_files(entry):
+            np.save(os.path.join(entry, 'data.npy'), np.ascontiguousarray(epochs.get_data()))
+            np.save(os.path.join(entry, 'events.npy'), np.asarray(epochs.events))
+
+        meta = dict(sfreq=float(epochs.info['sfreq']), ch_names=list(epochs.info['ch_names']),
+                    tmin=float(epochs.tmin), event_id=dict(epochs.event_id),
+                    created=time.time())
+        self.write_entry(key, write_files, meta)
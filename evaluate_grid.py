@@ -0,0 +1,190 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Cross-subject / cross-session evaluation of a pipeline.
+
+A pipeline is trained on every recording (subject/trial) of the dataset and
+tested on every other recording, giving a train x test accuracy matrix and a
+matrix of the per-epoch predict latency. Each training recording is one job on
+a process pool: the pipeline is fitted once and then applied to all test
+recordings. All recordings are preprocessed once up front into the epoch cache,
+the workers memory map them from there instead of reloading the .fif files.
+
+Example:
+    python3 evaluate_grid.py --data-dir ~/dataset-ssvep-exoskeleton --pipeline 3 --low-memory
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from eeg_input import ReadEEG, build_rg_pipeline
+from benchmark_common import json_safe_matrix, preprocess_recordings, time_predictions
+
+# Per worker process: ReadEEG instance and the epochs it has memory mapped
+_worker_reader = None
+_worker_epochs = {}
+
+
+def _init_worker(data_dir, epoch_cache_dir, low_memory):
+    """
+    Pool initializer, opens the dataset once per worker process.
+    """
+    global _worker_reader
+    _worker_reader = ReadEEG(data_dir, epoch_cache_dir=epoch_cache_dir, model_store_dir=None,
+                             low_memory=low_memory)
+
+
+def _load_epochs(recording):
+    """
+    :param recording: tuple (subject, trial)
+    :return: CachedEpochs, memory mapped from the epoch cache and kept for later jobs
+    """
+    if recording not in _worker_epochs:
+        _worker_epochs[recording] = _worker_reader.get_epochs(*recording)
+    return _worker_epochs[recording]
+
+
+def run_training_job(train_recording, test_recordings, pipeline, estimator):
+    """
+    Fit the pipeline on one recording and test it on all the others. Runs in a
+    worker process set up by _init_worker.
+
+    :param train_recording: tuple (subject, trial) to train on
+    :param test_recordings: list of (subject, trial) to test on
+    :param pipeline: Pre-defined pipeline number, see build_rg_pipeline
+    :param estimator: Covariance estimator
+    :return: dict with fit_time_s, accuracy and latency_ms (one entry per test recording,
+             nan for the training recording itself) and error
+    """
+    n_tests = len(test_recordings)
+    result = dict(fit_time_s=np.nan, accuracy=[np.nan] * n_tests, latency_ms=[np.nan] * n_tests, error='')
+    try:
+        train_epochs = _load_epochs(train_recording)
+        clf = build_rg_pipeline(pipeline, estimator, sfreq=train_epochs.info['sfreq'])
+
+        tstart = time.perf_counter()
+        clf.fit(train_epochs.get_data(), train_epochs.events[:, -1])
+        result['fit_time_s'] = time.perf_counter() - tstart
+
+        for indx, test_recording in enumerate(test_recordings):
+            if test_recording == train_recording:
+                continue
+            test_epochs = _load_epochs(test_recording)
+            X_data = test_epochs.get_data()
+            labels = test_epochs.events[:, -1]
+
+            preds, latencies = time_predictions(clf, X_data)
+            result['accuracy'][indx] = float(np.mean(preds == labels))
+            result['latency_ms'][indx] = float(np.median(latencies) * 1000)
+    except Exception as err:
+        result['error'] = type(err).__name__ + ': ' + str(err)
+
+    return result
+
+
+def format_report(recordings, accuracy):
+    """
+    :param recordings: list of (subject, trial), order of the matrix rows/columns
+    :param accuracy: (n_recordings, n_recordings) train x test accuracy matrix
+    :return: str, human readable summary of within and cross subject accuracy
+    """
+    subjects = np.array([subj for subj, _ in recordings])
+    same_subject = subjects[:, np.newaxis] == subjects[np.newaxis, :]
+    off_diagonal = ~np.eye(len(recordings), dtype=bool)
+
+    lines = ['Train x test accuracy (rows: training recording, columns: test recording)']
+    labels = ['s' + str(subj) + 't' + str(trial) for subj, trial in recordings]
+    lines.append(' ' * 7 + ' '.join(f'{label:>6}' for label in labels))
+    for label, row in zip(labels, accuracy):
+        lines.append(f'{label:>6} ' + ' '.join('     -' if np.isnan(value) else f'{value:6.3f}' for value in row))
+
+    cross_session = accuracy[same_subject & off_diagonal]
+    cross_subject = accuracy[~same_subject]
+    if np.any(~np.isnan(cross_session)):
+        lines.append('Mean cross-session accuracy (same subject): ' + f'{np.nanmean(cross_session):.3f}')
+    if np.any(~np.isnan(cross_subject)):
+        lines.append('Mean cross-subject accuracy: ' + f'{np.nanmean(cross_subject):.3f}')
+    return '\n'.join(lines)
+
+
+def run_grid(data_dir, pipeline=3, estimator='lwf', subjects=None, max_workers=None,
+             out_dir='grid_results', low_memory=False,
+             epoch_cache_dir=os.path.join(os.path.expanduser('~'), '.bci_stimulus', 'epoch_cache')):
+    """
+    Build the train x test matrix over all recordings and write accuracy.csv,
+    latency_ms.csv, results.json and summary.txt.
+
+    :param data_dir: Directory of the SSVEP exoskeleton dataset
+    :param pipeline: Pre-defined pipeline number, see build_rg_pipeline
+    :param estimator: Covariance estimator
+    :param subjects: Subject numbers to include, None for all of ReadEEG.subj_list
+    :param max_workers: Size of the process pool, None for the number of cores
+    :param out_dir: Directory for the output files
+    :param low_memory: Build the epochs from event windows only instead of loading whole recordings
+    :param epoch_cache_dir: Epoch cache shared by all workers
+    :return: tuple (recordings, accuracy, latency_ms), the matrices are (n_recordings, n_recordings)
+             arrays with nan on the diagonal
+    """
+    reader = ReadEEG(data_dir, epoch_cache_dir=epoch_cache_dir, model_store_dir=None, low_memory=low_memory)
+    recordings = preprocess_recordings(reader, subjects)
+    print('...Training on ' + str(len(recordings)) + ' recordings, testing each on ' +
+          str(len(recordings) - 1) + ' others...')
+
+    tstart = time.time()
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(data_dir, epoch_cache_dir, low_memory)) as pool:
+        futures = [pool.submit(run_training_job, recording, recordings, pipeline, estimator)
+                   for recording in recordings]
+        results = [future.result() for future in futures]
+    print('...Grid finished in ' + f'{time.time() - tstart:.1f}' + ' s...')
+
+    accuracy = np.array([result['accuracy'] for result in results])
+    latency_ms = np.array([result['latency_ms'] for result in results])
+    for recording, result in zip(recordings, results):
+        if result['error']:
+            print('...Training on subject ' + str(recording[0]) + ' trial ' + str(recording[1]) +
+                  ' failed: ' + result['error'] + '...')
+
+    report = format_report(recordings, accuracy)
+
+    os.makedirs(out_dir, exist_ok=True)
+    header = ['train \\ test'] + [reader.subj_list[subj] + '/' + str(trial) for subj, trial in recordings]
+    for name, matrix in (('accuracy.csv', accuracy), ('latency_ms.csv', latency_ms)):
+        with open(os.path.join(out_dir, name), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for label, row in zip(header[1:], matrix):
+                writer.writerow([label] + ['' if np.isnan(value) else value for value in row])
+    with open(os.path.join(out_dir, 'results.json'), 'w') as f:
+        json.dump(dict(pipeline=pipeline, estimator=estimator, recordings=recordings,
+                       accuracy=json_safe_matrix(accuracy), latency_ms=json_safe_matrix(latency_ms),
+                       fit_time_s=json_safe_matrix([result['fit_time_s'] for result in results]),
+                       errors=[result['error'] for result in results]), f, indent=2, allow_nan=False)
+    with open(os.path.join(out_dir, 'summary.txt'), 'w') as f:
+        f.write(report + '\n')
+
+    print(report)
+    return recordings, accuracy, latency_ms
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train x test evaluation over all subjects and trials')
+    parser.add_argument('--data-dir', required=True, help='Directory of the SSVEP exoskeleton dataset')
+    parser.add_argument('--pipeline', type=int, default=3, help='Pre-defined pipeline number')
+    parser.add_argument('--estimator', default='lwf', help='Covariance estimator')
+    parser.add_argument('--subjects', type=int, nargs='+', default=None, help='Subject numbers, default all')
+    parser.add_argument('--workers', type=int, default=None, help='Process pool size, default all cores')
+    parser.add_argument('--out-dir', default='grid_results')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='Read only the event windows of each recording instead of loading it')
+    args = parser.parse_args()
+
+    run_grid(args.data_dir, args.pipeline, args.estimator, args.subjects, args.workers, args.out_dir,
+             args.low_memory)
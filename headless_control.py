@@ -0,0 +1,356 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Keyboard drive control without a display.
+
+RemoteControl needs pygame, a window and the arrow images only to turn key
+presses into drive commands. HeadlessControl reads the keys directly and
+sends the same commands (drive_state.STATE_TABLE, the same dedup of repeated
+directions and the non-blocking serial writer), and sleeps in select() while
+no key changes, so it uses next to no CPU or memory.
+
+Backends:
+    terminal    stdin in raw mode (works over ssh). Terminals do not report
+                key releases, so a key counts as held while it auto-repeats
+                and is released release_delay after a single press, or
+                REPEAT_TIMEOUT after its last repeat. release_delay must be
+                longer than the auto repeat delay of the keyboard (660 ms by
+                default on X11), otherwise a held key stops the chair before it
+                repeats. Only one key repeats at a time, so diagonals need
+                evdev. Space stops, q, Esc or Ctrl+C quits.
+    evdev       Linux input events (python-evdev, read access to /dev/input),
+                real press and release events, so diagonals work. Esc quits.
+
+The motors are stopped ('00') when control ends.
+
+Example:
+    python3 headless_control.py --backend evdev --port /dev/ttyACM0
+"""
+
+import argparse
+import os
+import resource
+import select
+import sys
+import termios
+import time
+import tty
+
+from drive_state import STATE_TABLE, DriveState, key_bit
+from serial_daemon import open_port
+from serial_protocol import PROTOCOLS, serial_port
+from serial_writer import SerialCommandWriter
+from stage_timer import StageTimer
+
+# Terminal backend: a single press is held this long (longer than the X11 default auto repeat delay of 660 ms)
+RELEASE_DELAY = 0.75
+# Terminal backend: a held key is released this long after its last auto repeat
+REPEAT_TIMEOUT = 0.12
+# Terminal backend: an escape sequence split across reads is completed within this time, else it is Esc
+ESCAPE_TIMEOUT = 0.05
+
+# Terminal escape sequences of the arrow keys
+_ARROW_SEQUENCES = {b'\x1b[A': 'up', b'\x1b[B': 'down', b'\x1b[C': 'right', b'\x1b[D': 'left',
+                    b'\x1bOA': 'up', b'\x1bOB': 'down', b'\x1bOC': 'right', b'\x1bOD': 'left'}
+
+# Events besides (key name, pressed)
+QUIT = 'quit'
+
+
+class TerminalKeys:
+    """
+    Key events from a terminal in raw mode, with releases inferred from the auto repeat.
+    """
+
+    def __init__(self, fd=None, release_delay=RELEASE_DELAY):
+        """
+        :param fd: File descriptor to read, default stdin
+        :param release_delay: Seconds a single press is held, must be longer than the
+                              auto repeat delay of the keyboard
+        """
+        self.fd = sys.stdin.fileno() if fd is None else fd
+        self.release_delay = release_delay
+        # Held key name -> perf_counter time it is released unless it repeats
+        self._held = {}
+        # Start of an escape sequence whose rest was not read yet, and when it counts as Esc
+        self._partial = b''
+        self._partial_deadline = None
+        self._saved_mode = None
+
+    def __enter__(self):
+        if os.isatty(self.fd):
+            self._saved_mode = termios.tcgetattr(self.fd)
+            tty.setraw(self.fd)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._saved_mode is not None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self._saved_mode)
+        return False
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """
+        :return: list of (key name, pressed) events and QUIT
+        """
+        data = os.read(self.fd, 64)
+        if not data:
+            return [QUIT]
+        return self.__parse(self._partial + data, time.perf_counter())
+
+    def __parse(self, data, now, complete=False):
+        """
+        :param data: bytes read from the terminal
+        :param now: perf_counter time
+        :param complete: No more bytes follow, an unfinished escape sequence is read as keys
+        :return: list of (key name, pressed) events and QUIT
+        """
+        self._partial = b''
+        events = []
+        indx = 0
+        while indx < len(data):
+            sequence = data[indx:indx + 3]
+            if sequence in _ARROW_SEQUENCES:
+                name = _ARROW_SEQUENCES[sequence]
+                indx += 3
+            elif (not complete and len(sequence) < 3 and
+                  any(arrow.startswith(sequence) for arrow in _ARROW_SEQUENCES)):
+                # Arrow key split across reads (e.g. over ssh), wait for the rest before quitting on Esc
+                self._partial = sequence
+                self._partial_deadline = now + ESCAPE_TIMEOUT
+                break
+            else:
+                name = chr(data[indx]).lower()
+                indx += 1
+
+            if name in ('q', '\x1b', '\x03', '\x04'):
+                events.append(QUIT)
+            elif name == ' ':
+                # Stop: release every held key
+                events.extend((held, False) for held in self._held)
+                self._held.clear()
+            elif key_bit(name) is not None:
+                if name in self._held:
+                    self._held[name] = now + REPEAT_TIMEOUT
+                else:
+                    self._held[name] = now + self.release_delay
+                    events.append((name, True))
+        return events
+
+    def timeout(self, now):
+        """
+        :param now: perf_counter time
+        :return: Seconds until the next inferred release or Esc, None if nothing is due
+        """
+        deadlines = list(self._held.values())
+        if self._partial:
+            deadlines.append(self._partial_deadline)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - now)
+
+    def expired(self, now):
+        """
+        :param now: perf_counter time
+        :return: list of (key name, False) for the keys that stopped repeating, and QUIT
+                 for an Esc that did not start an arrow key
+        """
+        events = []
+        if self._partial and self._partial_deadline <= now:
+            events = self.__parse(self._partial, now, complete=True)
+        released = [name for name, deadline in self._held.items() if deadline <= now]
+        for name in released:
+            del self._held[name]
+        return events + [(name, False) for name in released]
+
+
+class EvdevKeys:
+    """
+    Key events from a Linux input device.
+    """
+
+    def __init__(self, device=None):
+        """
+        :param device: Input device path, default the first device with a W key
+        """
+        try:
+            import evdev
+        except ImportError:
+            raise ImportError('The evdev backend needs the evdev package (pip install evdev)')
+        self._ecodes = evdev.ecodes
+
+        if device is None:
+            for path in evdev.list_devices():
+                keys = evdev.InputDevice(path).capabilities().get(evdev.ecodes.EV_KEY, [])
+                if evdev.ecodes.KEY_W in keys:
+                    device = path
+                    break
+            else:
+                raise OSError('No keyboard found in /dev/input (missing read permission?)')
+        self.device = evdev.InputDevice(device)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.device.close()
+        return False
+
+    def fileno(self):
+        return self.device.fd
+
+    def read(self):
+        """
+        :return: list of (key name, pressed) events and QUIT
+        """
+        events = []
+        for event in self.device.read():
+            # value 1 is a press, 0 a release and 2 an auto repeat
+            if event.type != self._ecodes.EV_KEY or event.value == 2:
+                continue
+            names = self._ecodes.KEY.get(event.code, '')
+            name = (names[0] if isinstance(names, list) else names)[len('KEY_'):].lower()
+            if name == 'esc':
+                events.append(QUIT)
+            else:
+                events.append((name, event.value == 1))
+        return events
+
+    def timeout(self, now):
+        return None
+
+    def expired(self, now):
+        return []
+
+
+class HeadlessControl:
+    """
+    Drive control from key events, without a window.
+
+    Attributes:
+    --------------------
+    stats: dict
+        CPU use, peak memory and commands of the last run
+
+    Methods:
+    --------------------
+    run(keys, duration=None)
+        Sends the commands of the key events until quit (or duration seconds)
+    """
+
+    def __init__(self, ser, timing=True, protocol='text'):
+        """
+        :param ser: Serial object connected to a specific serial port
+        :param timing: Time the serial writes and the key to wire latency
+        :param protocol: 'text' or 'binary' command protocol, must match the firmware
+        """
+        self.timer = StageTimer(enabled=timing)
+        self.stats = None
+        self._drive_state = DriveState()
+        self._last_direction = "00"
+        self._writer = SerialCommandWriter(ser, timer=self.timer, protocol=protocol)
+
+    def __send_data(self, direction, key_time=None):
+        """
+        Sends a direction unless it is the last one sent, same as RemoteControl.
+
+        :param direction: Direction/data to be sent over serial data stream
+        :param key_time: perf_counter time of the key event, the time until the command is
+                         written is recorded as 'key_to_wire'
+        :return: None
+        """
+        if self._last_direction != direction:
+            on_written = None
+            if key_time is not None:
+                def on_written():
+                    self.timer.record('key_to_wire', time.perf_counter() - key_time)
+            self._writer.send_direction(direction, on_written)
+
+        self._last_direction = direction
+
+    def __on_key(self, name, pressed, key_time):
+        bit = key_bit(name)
+        if bit is None:
+            return
+        changed, state = self._drive_state.update(bit, pressed)
+        if changed:
+            command, _ = STATE_TABLE[state]
+            if command is not None:
+                self.__send_data(command, key_time)
+
+    def run(self, keys, duration=None):
+        """
+        :param keys: TerminalKeys or EvdevKeys, already entered
+        :param duration: Optional number of seconds to run for
+        :return: dict, see stats
+        """
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        end = None if duration is None else wall_start + duration
+        running = True
+
+        while running:
+            now = time.perf_counter()
+            timeout = keys.timeout(now)
+            if end is not None:
+                if now >= end:
+                    break
+                timeout = end - now if timeout is None else min(timeout, end - now)
+
+            # Sleeps until a key event (or an inferred release) is due
+            readable, _, _ = select.select([keys], [], [], timeout)
+            key_time = time.perf_counter()
+            events = keys.read() if readable else []
+            events += keys.expired(key_time)
+            for event in events:
+                if event == QUIT:
+                    running = False
+                    break
+                self.__on_key(event[0], event[1], key_time)
+
+        # program to stop motor!
+        self.__send_data('00')
+        self._writer.close()
+
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.stats = dict(wall_s=wall_time, cpu_s=cpu_time, cpu_percent=100 * cpu_time / max(wall_time, 1e-9),
+                          peak_rss_mb=peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024,
+                          writer=self._writer.stats(), timing=self.timer.summary())
+        return self.stats
+
+    def report(self):
+        """
+        :return: str, CPU, memory and timing of the last run
+        """
+        lines = ['...Headless control: ' + f'{self.stats["cpu_percent"]:.2f}' + '% CPU over ' +
+                 f'{self.stats["wall_s"]:.1f}' + ' s, peak RSS ' + f'{self.stats["peak_rss_mb"]:.1f}' + ' MB...']
+        if self.timer.enabled:
+            lines.append(self.timer.report())
+        lines.append(self._writer.report())
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive with the keyboard without a display')
+    parser.add_argument('--backend', choices=['terminal', 'evdev'], default='terminal')
+    parser.add_argument('--device', default=None, help='evdev input device, default the first keyboard')
+    parser.add_argument('--port', default=None, help='Serial port, default BCI_SERIAL_PORT or /dev/ttyACM0')
+    parser.add_argument('--protocol', choices=sorted(PROTOCOLS), default='text',
+                        help='Serial command protocol, binary needs firmware built with BINARY_PROTOCOL')
+    parser.add_argument('--release-delay', type=float, default=RELEASE_DELAY,
+                        help='Terminal backend: seconds a single press is held, longer than the auto repeat delay')
+    args = parser.parse_args()
+
+    ser = open_port(args.port or serial_port('/dev/ttyACM0'), 9600, timeout=1)
+    controller = HeadlessControl(ser, protocol=args.protocol)
+    keys = TerminalKeys(release_delay=args.release_delay) if args.backend == 'terminal' else EvdevKeys(args.device)
+    print('...Drive with WASD or the arrow keys' +
+          (', space stops, q quits...' if args.backend == 'terminal' else ', Esc quits...'))
+    with keys:
+        controller.run(keys)
+    print(controller.report())
@@ -0,0 +1,247 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+End-to-end latency of the online decisions, from brain signal to motor command.
+
+Every decision starts at the LSL timestamp of the last EEG sample in its window.
+RingBufferInlet already applies time_correction to these timestamps (proc_clocksync),
+so they are on the local LSL clock. The tracker then marks, on the same clock,
+when the window was classified, when the command was written to the serial
+port, when the prediction was pushed on the LSL outlet and, if the device
+echoes commands ("data is: d/xx", printed by b1_loop.ino), when the
+echo came back. The latency of a stage is its mark minus the sample time.
+
+The per-decision latencies can be exported, summarized (count, mean, p50/p95/p99,
+max) and checked against a budget with assert_within for regression tests.
+"""
+
+import json
+import threading
+from collections import deque
+
+import numpy as np
+from pylsl import local_clock
+
+from serial_protocol import ECHO_PREFIX
+
+# Stages marked for every decision, in pipeline order
+STAGES = ('classified', 'serial_written', 'lsl_pushed', 'device_echo')
+
+
+class DecisionLatencyTracker:
+    """
+    Per-decision latency from the last EEG sample to each pipeline stage.
+
+    Attributes:
+    --------------------
+    sample_times: list
+        LSL timestamp of the last sample of each decision window
+    marks: dict
+        Stage name -> list of local clock times, nan where the stage did not happen
+        (e.g. no serial write when the direction did not change)
+
+    Methods:
+    --------------------
+    start(sample_time)
+        Starts a decision, returns its index
+    mark(decision, stage, timestamp=None)
+        Marks the time a decision reached a stage
+    expect_echo(decision, command)
+        Marks device_echo once the device echoes the command
+    listen_for_echo(ser, reader=None) / stop()
+        Reads the device echo on a background thread
+    latencies(stage)
+        Per-decision latency of a stage in seconds
+    summary()
+        Latency statistics of every stage in milliseconds
+    assert_within(budget_ms, percentile=95)
+        Raises AssertionError if a stage is over its budget
+    """
+
+    def __init__(self):
+        self.sample_times = []
+        self.marks = {stage: [] for stage in STAGES}
+        self._pending_echo = deque()
+        self._lock = threading.Lock()
+        self._echo_thread = None
+        self._stop_event = threading.Event()
+
+    def start(self, sample_time):
+        """
+        :param sample_time: LSL timestamp (local clock) of the last sample in the decision window
+        :return: int, index of the decision
+        """
+        with self._lock:
+            self.sample_times.append(sample_time)
+            for stage in STAGES:
+                self.marks[stage].append(np.nan)
+            return len(self.sample_times) - 1
+
+    def mark(self, decision, stage, timestamp=None):
+        """
+        :param decision: Index from start
+        :param stage: One of STAGES
+        :param timestamp: Local clock time, default now
+        :return: None
+        """
+        if timestamp is None:
+            timestamp = local_clock()
+        with self._lock:
+            self.marks[stage][decision] = timestamp
+
+    def expect_echo(self, decision, command):
+        """
+        Registers a command written to the device, device_echo is marked when the
+        device echoes it back.
+
+        :param decision: Index from start
+        :param command: Command as written, without the newline (e.g. 'd/ww')
+        :return: None
+        """
+        with self._lock:
+            self._pending_echo.append((decision, command))
+
+    def handle_line(self, line, timestamp=None):
+        """
+        Matches a line read from the device with the pending commands. Commands
+        written before the echoed one that were never echoed are dropped.
+
+        :param line: Line read from the device, decoded and stripped
+        :param timestamp: Local clock time the line was read, default now
+        :return: bool, True if the line closed a decision
+        """
+        if timestamp is None:
+            timestamp = local_clock()
+        if not line.startswith(ECHO_PREFIX):
+            return False
+        command = line[len(ECHO_PREFIX):].strip()
+        with self._lock:
+            # Other echoed lines (e.g. the 'd/00' written before every command) are ignored
+            if all(expected != command for _, expected in self._pending_echo):
+                return False
+            while self._pending_echo:
+                decision, expected = self._pending_echo.popleft()
+                if expected == command:
+                    self.marks['device_echo'][decision] = timestamp
+                    return True
+        return False
+
+    def listen_for_echo(self, ser, reader=None):
+        """
+        Starts reading lines from the serial port on a daemon thread. The port must
+        have a read timeout so the thread can be stopped.
+
+        :param ser: Serial object the commands are written to
+        :param reader: Optional decoder of the device output (protocol.reader(), e.g. for
+                       binary frames), by default text lines are read
+        :return: None
+        """
+        self._stop_event.clear()
+        self._echo_thread = threading.Thread(target=self.__read_echo, args=(ser, reader),
+                                             name='device echo', daemon=True)
+        self._echo_thread.start()
+
+    def __read_echo(self, ser, reader):
+        while not self._stop_event.is_set():
+            try:
+                if reader is None:
+                    raw_line = ser.readline()
+                    lines = [raw_line.decode('utf-8', errors='replace').strip()] if raw_line else []
+                else:
+                    lines = reader.feed(ser.read(max(1, ser.in_waiting)))
+            except Exception:
+                # Port closed or not readable
+                return
+            timestamp = local_clock()
+            for line in lines:
+                self.handle_line(line, timestamp)
+
+    def stop(self, timeout=1.0):
+        """
+        Stops the echo thread, waiting up to timeout seconds for the last echo
+        :param timeout: Seconds to wait
+        :return: None
+        """
+        if self._echo_thread is not None:
+            self._stop_event.set()
+            self._echo_thread.join(timeout)
+            self._echo_thread = None
+
+    def latencies(self, stage):
+        """
+        :param stage: One of STAGES
+        :return: np.ndarray, latency of each decision in seconds (nan if the stage was not reached)
+        """
+        with self._lock:
+            return np.array(self.marks[stage], dtype=float) - np.array(self.sample_times, dtype=float)
+
+    def summary(self):
+        """
+        :return: dict of stage -> dict with count, mean_ms, p50_ms, p95_ms, p99_ms and max_ms
+        """
+        summary = {}
+        for stage in STAGES:
+            latency_ms = self.latencies(stage) * 1000
+            latency_ms = latency_ms[~np.isnan(latency_ms)]
+            if len(latency_ms) == 0:
+                summary[stage] = dict(count=0)
+                continue
+            summary[stage] = dict(count=len(latency_ms), mean_ms=float(np.mean(latency_ms)),
+                                  p50_ms=float(np.percentile(latency_ms, 50)),
+                                  p95_ms=float(np.percentile(latency_ms, 95)),
+                                  p99_ms=float(np.percentile(latency_ms, 99)),
+                                  max_ms=float(np.max(latency_ms)))
+        return summary
+
+    def report(self):
+        """
+        :return: str, one line per stage
+        """
+        lines = [f'{"sample to":>15} {"count":>6} {"mean ms":>9} {"p50 ms":>9} {"p95 ms":>9} '
+                 f'{"p99 ms":>9} {"max ms":>9}']
+        for stage, stats in self.summary().items():
+            if stats['count'] == 0:
+                lines.append(f'{stage:>15} {0:>6}')
+                continue
+            lines.append(f'{stage:>15} {stats["count"]:>6} {stats["mean_ms"]:9.2f} {stats["p50_ms"]:9.2f} '
+                         f'{stats["p95_ms"]:9.2f} {stats["p99_ms"]:9.2f} {stats["max_ms"]:9.2f}')
+        return '\n'.join(lines)
+
+    def to_json(self, path=None):
+        """
+        :param path: Optional file to write the JSON to
+        :return: str, JSON with the summary and the per-decision latencies in ms
+        """
+        decisions = {stage: [None if np.isnan(value) else value * 1000 for value in self.latencies(stage)]
+                     for stage in STAGES}
+        encoded = json.dumps(dict(summary=self.summary(), latency_ms=decisions), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(encoded + '\n')
+        return encoded
+
+    def assert_within(self, budget_ms, percentile=95, min_count=1):
+        """
+        Regression check of the latency distribution.
+
+        :param budget_ms: dict of stage -> budget in milliseconds for the given percentile
+        :param percentile: Percentile compared with the budget
+        :param min_count: Minimum number of decisions that must have reached each stage
+        :return: None
+        :raises AssertionError: if a stage is over budget or has too few decisions
+        """
+        failures = []
+        for stage, budget in budget_ms.items():
+            latency_ms = self.latencies(stage) * 1000
+            latency_ms = latency_ms[~np.isnan(latency_ms)]
+            if len(latency_ms) < min_count:
+                failures.append(stage + ': ' + str(len(latency_ms)) + ' decisions, expected at least ' +
+                                str(min_count))
+                continue
+            value = np.percentile(latency_ms, percentile)
+            if value > budget:
+                failures.append(stage + ': p' + str(percentile) + ' ' + f'{value:.2f}' + ' ms > ' +
+                                str(budget) + ' ms budget')
+        if failures:
+            raise AssertionError('End-to-end latency regression: ' + '; '.join(failures))
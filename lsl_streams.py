@@ -0,0 +1,384 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Lab Streaming Layer helpers for the online EEG path.
+
+RingBufferInlet pulls chunks from a LSL inlet on a background thread into a
+preallocated NumPy ring buffer, so acquisition never waits on the consumer and
+memory use does not grow with session length.
+
+PredictionOutlet sends classifier decisions as numeric samples, batched with
+push_chunk.
+"""
+
+import threading
+
+import numpy as np
+from pylsl import (StreamInfo, StreamInlet, StreamOutlet, local_clock, cf_double64, cf_float32, cf_int8, cf_int16, cf_int32, cf_int64,
+                   cf_string, proc_clocksync, proc_dejitter)
+
+# NumPy dtype matching each LSL channel format, used for the pull buffer
+LSL_DTYPES = {cf_float32: np.float32, cf_double64: np.float64, cf_int8: np.int8,
+              cf_int16: np.int16, cf_int32: np.int32, cf_int64: np.int64}
+
+
+class RingBufferInlet:
+    """
+    Background reader of a LSL stream into a preallocated ring buffer.
+
+    The buffer is stored twice back to back (a 'mirrored' ring buffer), so the
+    latest N samples are always contiguous in memory and can be returned as a
+    view without copying, even when they wrap around the end of the ring.
+
+    Timestamps are corrected to the local clock (and dejittered) by liblsl.
+
+    Attributes:
+    --------------------
+    sfreq: float \n
+    n_channels: int \n
+    capacity: int \n
+    n_overflow: int
+        Samples overwritten before they were read with read_new() \n
+    n_dropped: int
+        Samples missing from the stream, estimated from gaps in the timestamps
+
+    Methods:
+    --------------------
+    start() / stop()
+        Start or stop the acquisition thread
+    latest(n_samples)
+        View of the latest samples and timestamps
+    latest_seconds(seconds)
+        Same as latest, but in seconds
+    read_new(max_samples=None)
+        View of the samples not yet read, advances the read position
+    wait_for_samples(n_samples, timeout)
+        Block until n_samples unread samples are available
+    """
+
+    def __init__(self, stream_info, buffer_time=30.0, chunk_time=0.05, max_buflen=360):
+        """
+        :param stream_info: pylsl StreamInfo from resolve_byprop/resolve_streams
+        :param buffer_time: Length of the ring buffer in seconds
+        :param chunk_time: Maximum time in seconds the acquisition thread waits for the first
+                           sample of a chunk, available samples are returned without waiting
+        :param max_buflen: Seconds of data liblsl may queue before dropping samples
+        """
+        self._inlet = StreamInlet(stream_info, max_buflen=max_buflen,
+                                  processing_flags=proc_clocksync | proc_dejitter)
+        info = self._inlet.info()
+        self.name = info.name()
+        self.sfreq = info.nominal_srate()
+        self.n_channels = info.channel_count()
+        self._channel_format = info.channel_format()
+
+        # Irregular streams (e.g. markers) have no sampling rate, assume one sample per 10 ms
+        rate = self.sfreq if self.sfreq > 0 else 100.0
+        self.capacity = max(1, int(round(buffer_time * rate)))
+        self._chunk_time = chunk_time
+        self._max_chunk = max(1, int(round(chunk_time * rate * 4)))
+
+        if self._channel_format == cf_string:
+            dtype = object
+            self._pull_buffer = None
+        else:
+            dtype = LSL_DTYPES[self._channel_format]
+            self._pull_buffer = np.zeros((self._max_chunk, self.n_channels), dtype=dtype)
+
+        self._data = np.zeros((2 * self.capacity, self.n_channels), dtype=dtype)
+        self._times = np.zeros(2 * self.capacity)
+
+        # Total number of samples written and read since start
+        self._n_written = 0
+        self._n_read = 0
+        self._last_timestamp = None
+
+        self.n_overflow = 0
+        self.n_dropped = 0
+
+        self._new_data = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """
+        Opens the stream and starts the acquisition thread
+        :return: None
+        """
+        if self._running:
+            return
+        self._inlet.open_stream()
+        # Establish the clock offset now, otherwise the first pull blocks on it
+        self._inlet.time_correction()
+        self._running = True
+        self._thread = threading.Thread(target=self.__acquire, name='RingBufferInlet', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the acquisition thread and closes the stream
+        :return: None
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._inlet.close_stream()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def __acquire(self):
+        """
+        Acquisition thread, pulls chunks until stop() is called
+        :return: None
+        """
+        while self._running:
+            # min_samples=1 returns as soon as samples arrive instead of waiting for a full chunk
+            if self._pull_buffer is not None:
+                _, timestamps = self._inlet.pull_chunk(timeout=self._chunk_time, max_samples=self._max_chunk,
+                                                       dest_obj=self._pull_buffer, min_samples=1)
+                chunk = self._pull_buffer[:len(timestamps)]
+            else:
+                samples, timestamps = self._inlet.pull_chunk(timeout=self._chunk_time,
+                                                             max_samples=self._max_chunk, min_samples=1)
+                chunk = np.array(samples, dtype=object).reshape(len(timestamps), self.n_channels)
+
+            if len(timestamps):
+                self.__append(chunk, np.asarray(timestamps, dtype=float))
+
+    def __count_dropped(self, timestamps):
+        """
+        Estimates the number of samples lost before and inside a chunk from gaps
+        larger than 1.5 sample periods.
+
+        :param timestamps: np.ndarray of chunk timestamps
+        :return: int
+        """
+        if self.sfreq <= 0:
+            return 0
+        if self._last_timestamp is not None:
+            timestamps = np.concatenate(([self._last_timestamp], timestamps))
+        gaps = np.diff(timestamps) * self.sfreq
+        gaps = gaps[gaps > 1.5]
+        return int(np.sum(np.round(gaps) - 1))
+
+    def __append(self, chunk, timestamps):
+        """
+        Copies a chunk into both halves of the mirrored ring buffer
+
+        :param chunk: (n_samples, n_channels) array
+        :param timestamps: (n_samples,) array
+        :return: None
+        """
+        dropped = self.__count_dropped(timestamps)
+        self._last_timestamp = timestamps[-1]
+
+        # Only the last `capacity` samples of a very large chunk can be kept
+        if chunk.shape[0] > self.capacity:
+            skipped = chunk.shape[0] - self.capacity
+            chunk, timestamps = chunk[skipped:], timestamps[skipped:]
+        else:
+            skipped = 0
+
+        n = chunk.shape[0]
+        start = (self._n_written + skipped) % self.capacity
+        first = min(n, self.capacity - start)
+        for offset in (0, self.capacity):
+            self._data[offset + start:offset + start + first] = chunk[:first]
+            self._times[offset + start:offset + start + first] = timestamps[:first]
+            if first < n:
+                self._data[offset:offset + n - first] = chunk[first:]
+                self._times[offset:offset + n - first] = timestamps[first:]
+
+        with self._new_data:
+            self._n_written += n + skipped
+            self.n_dropped += dropped
+            unread = self._n_written - self._n_read
+            if unread > self.capacity:
+                self.n_overflow += unread - self.capacity
+                self._n_read = self._n_written - self.capacity
+            self._new_data.notify_all()
+
+    def __view(self, end, n_samples):
+        """
+        Contiguous view of n_samples ending at total sample index end
+        """
+        stop = end % self.capacity + self.capacity
+        return self._data[stop - n_samples:stop], self._times[stop - n_samples:stop]
+
+    def latest(self, n_samples):
+        """
+        Zero-copy view of the latest samples. The view is only valid until
+        another `capacity - n_samples` samples have been acquired; copy it if it
+        has to be kept for longer.
+
+        :param n_samples: Number of samples, at most capacity
+        :return: tuple (samples (n, n_channels), timestamps (n,)); fewer samples
+                 are returned if the stream has not delivered n_samples yet
+        """
+        with self._new_data:
+            end = self._n_written
+        n_samples = min(n_samples, end, self.capacity)
+        return self.__view(end, n_samples)
+
+    def latest_seconds(self, seconds):
+        """
+        Zero-copy view of the latest seconds of data, see latest()
+
+        :param seconds: Length of the window in seconds
+        :return: tuple (samples, timestamps)
+        """
+        return self.latest(int(round(seconds * self.sfreq)))
+
+    def read_new(self, max_samples=None):
+        """
+        Zero-copy view of the samples acquired since the previous call, the
+        read position is advanced past them.
+
+        :param max_samples: Maximum number of samples to return, oldest first
+        :return: tuple (samples (n, n_channels), timestamps (n,))
+        """
+        with self._new_data:
+            n_samples = self._n_written - self._n_read
+            if max_samples is not None:
+                n_samples = min(n_samples, max_samples)
+            self._n_read += n_samples
+            end = self._n_read
+        return self.__view(end, n_samples)
+
+    def wait_for_samples(self, n_samples=1, timeout=None):
+        """
+        Blocks until at least n_samples unread samples are available
+
+        :param n_samples: Number of unread samples to wait for
+        :param timeout: Maximum time to wait in seconds, None waits forever
+        :return: bool, True if the samples are available
+        """
+        with self._new_data:
+            return self._new_data.wait_for(lambda: self._n_written - self._n_read >= n_samples, timeout)
+
+    def stats(self):
+        """
+        :return: dict of total acquired samples, unread samples, overflow and dropped counters
+        """
+        with self._new_data:
+            return dict(samples=self._n_written, unread=self._n_written - self._n_read,
+                        overflow=self.n_overflow, dropped=self.n_dropped)
+
+
+class PredictionOutlet:
+    """
+    Numeric LSL outlet for classifier decisions.
+
+    Each sample holds the predicted class in channel 0 and, optionally, the
+    probability of every class in the following channels. Decisions are kept
+    in a preallocated pending buffer and sent together with a single push_chunk
+    when flush() is called (or when the buffer is full).
+
+    Attributes:
+    --------------------
+    class_labels: list \n
+    include_proba: bool \n
+    n_pushed: int
+
+    Methods:
+    --------------------
+    push(prediction, timestamp=None, proba=None)
+        Adds a decision to the pending buffer
+    push_batch(predictions, timestamps=None, proba=None)
+        Sends several decisions at once
+    flush()
+        Sends all pending decisions
+    """
+
+    def __init__(self, stream_name='PythonOut', stream_type='Prediction', class_labels=(1, 2, 3, 4),
+                 include_proba=False, source_id=None, max_pending=64):
+        """
+        :param stream_name: Name of the LSL outlet
+        :param stream_type: Type of the LSL outlet
+        :param class_labels: Labels of the classes, in the order of the probability channels
+        :param include_proba: Add one probability channel per class
+        :param source_id: Unique id of the source, lets consumers reconnect after a restart.
+                          Defaults to the stream name and type.
+        :param max_pending: Decisions held before flush() is called automatically
+        """
+        self.class_labels = list(class_labels)
+        self.include_proba = include_proba
+        n_channels = 1 + (len(self.class_labels) if include_proba else 0)
+
+        if source_id is None:
+            source_id = stream_name + '_' + stream_type
+        info = StreamInfo(stream_name, stream_type, channel_count=n_channels, nominal_srate=0,
+                          channel_format='float32', source_id=source_id)
+        channels = info.desc().append_child('channels')
+        channels.append_child('channel').append_child_value('label', 'class')
+        if include_proba:
+            for label in self.class_labels:
+                channels.append_child('channel').append_child_value('label', 'p_' + str(label))
+        self._outlet = StreamOutlet(info)
+
+        self._pending = np.zeros((max_pending, n_channels), dtype=np.float32)
+        self._pending_times = np.zeros(max_pending)
+        self._n_pending = 0
+        self.n_pushed = 0
+
+    def push(self, prediction, timestamp=None, proba=None):
+        """
+        Adds a decision to the pending buffer. It is sent on the next flush().
+
+        :param prediction: Predicted class label
+        :param timestamp: LSL timestamp of the decision, defaults to now
+        :param proba: Class probabilities, only used if include_proba is True
+        :return: None
+        """
+        if self._n_pending == self._pending.shape[0]:
+            self.flush()
+
+        row = self._pending[self._n_pending]
+        row[0] = prediction
+        if self.include_proba:
+            row[1:] = proba if proba is not None else np.nan
+        self._pending_times[self._n_pending] = local_clock() if timestamp is None else timestamp
+        self._n_pending += 1
+
+    def push_batch(self, predictions, timestamps=None, proba=None):
+        """
+        Sends several decisions with a single push_chunk, pending decisions are sent first.
+
+        :param predictions: array like (n_decisions,) of class labels
+        :param timestamps: array like (n_decisions,) of LSL timestamps, defaults to now
+        :param proba: array like (n_decisions, n_classes), only used if include_proba is True
+        :return: None
+        """
+        self.flush()
+
+        predictions = np.asarray(predictions)
+        if predictions.size == 0:
+            return
+        chunk = np.empty((predictions.shape[0], self._pending.shape[1]), dtype=np.float32)
+        chunk[:, 0] = predictions
+        if self.include_proba:
+            chunk[:, 1:] = proba if proba is not None else np.nan
+        if timestamps is None:
+            timestamps = np.full(predictions.shape[0], local_clock())
+
+        self._outlet.push_chunk(chunk, np.asarray(timestamps, dtype=float).tolist())
+        self.n_pushed += predictions.shape[0]
+
+    def flush(self):
+        """
+        Sends all pending decisions with a single push_chunk
+        :return: None
+        """
+        if self._n_pending == 0:
+            return
+        self._outlet.push_chunk(self._pending[:self._n_pending],
+                                self._pending_times[:self._n_pending].tolist())
+        self.n_pushed += self._n_pending
+        self._n_pending = 0
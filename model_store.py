@@ -0,0 +1,152 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Persistent store of trained classification pipelines for ReadEEG.
+
+Fitting a pipeline (e.g. XdawnCovariances + saga LogisticRegression) takes much
+longer than loading it. A fitted pipeline only depends on the training epochs
+and the pipeline parameters, so it is saved under a key derived from both and
+loaded on the next start instead of being trained again.
+
+The key covers:
+    - a fingerprint of the training epochs and labels (any change in the source
+      recording or in the preprocessing changes the epochs and thus the key)
+    - the preprocessing metadata (sfreq, channels, tmin, event_id, ...)
+    - every parameter of the unfitted pipeline (sklearn get_params)
+
+Every store entry is a directory named after its key:
+    <store_dir>/<key>/model.joblib  - fitted pipeline
+    <store_dir>/<key>/meta.json     - library versions, parameters, creation time
+
+An entry written with different library versions (or store format) is stale:
+unpickling it could fail or silently behave differently, so it is refused and
+removed. Entries are written, read and evicted by disk_store.DiskLRUStore.
+"""
+
+import hashlib
+import json
+import os
+import platform
+import time
+
+import joblib
+import numpy as np
+
+from disk_store import DiskLRUStore
+
+# Bump when the layout of the store entries changes
+STORE_FORMAT = 1
+
+# Libraries whose version must match for an artifact to be loaded
+TRACKED_LIBRARIES = ['numpy', 'scipy', 'sklearn', 'pyriemann', 'mne', 'joblib']
+
+
+def library_versions():
+    """
+    :return: dict of library name -> version string for TRACKED_LIBRARIES and python
+    """
+    versions = dict(python=platform.python_version())
+    for name in TRACKED_LIBRARIES:
+        try:
+            versions[name] = __import__(name).__version__
+        except ImportError:
+            versions[name] = None
+    return versions
+
+
+class ModelStore(DiskLRUStore):
+    """
+    Content addressed store of fitted pipelines.
+
+    Attributes:
+    --------------------
+    store_dir: str \n
+    max_entries: int
+        Number of entries kept, least recently used ones are removed first
+
+    Methods:
+    --------------------
+    make_key(X_data, labels, clf, **params)
+        Builds the key for a training set and an unfitted pipeline
+    load(key)
+        Returns the fitted pipeline for a key, or None if missing or stale
+    store(key, clf, **info)
+        Saves a fitted pipeline
+    invalidate(key=None)
+        Removes one entry, or the whole store if no key is given
+    """
+
+    def __init__(self, store_dir, max_entries=50):
+        """
+        :param store_dir: Directory to hold the store entries, created if missing
+        :param max_entries: Number of entries kept
+        """
+        super().__init__(store_dir, max_entries=max_entries, label='model')
+        self.store_dir = store_dir
+
+    @staticmethod
+    def fingerprint(X_data, labels):
+        """
+        :param X_data: (n_epochs, n_channels, n_times) training data
+        :param labels: (n_epochs,) training labels
+        :return: str, hex digest of the content, shape and dtype of both arrays
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        for array in (X_data, labels):
+            array = np.ascontiguousarray(array)
+            digest.update(str((array.shape, array.dtype.str)).encode('utf-8'))
+            digest.update(array)
+        return digest.hexdigest()
+
+    def make_key(self, X_data, labels, clf, **params):
+        """
+        Builds the key for a training set and an unfitted pipeline. All keyword
+        arguments (preprocessing metadata, pipeline number, ...) become part of the key.
+
+        :param X_data: (n_epochs, n_channels, n_times) training data
+        :param labels: (n_epochs,) training labels
+        :param clf: Unfitted sklearn estimator or pipeline, its parameters are part of the key
+        :return: str, hex digest used as the entry name
+        """
+        description = dict(data=self.fingerprint(X_data, labels), params=params,
+                           clf=type(clf).__name__, clf_params=clf.get_params(deep=True),
+                           format=STORE_FORMAT)
+        encoded = json.dumps(description, sort_keys=True, default=repr)
+        return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        """
+        Load a fitted pipeline. Entries saved with other library versions are
+        removed instead of loaded.
+
+        :param key: Key from make_key
+        :return: Fitted pipeline, or None if the entry does not exist or is stale
+        """
+        def read_files(entry, meta):
+            current = library_versions()
+            if meta.get('format') != STORE_FORMAT or meta.get('versions') != current:
+                changed = [name for name in current if meta.get('versions', {}).get(name) != current[name]]
+                print('...Refusing stale model ' + key[:12] + ', saved with other versions of: ' +
+                      (', '.join(changed) or 'store format') + '...')
+                return None
+            return joblib.load(os.path.join(entry, 'model.joblib'))
+
+        # Unpickling can fail with any exception
+        return self.read_entry(key, read_files, errors=(Exception,))
+
+    def store(self, key, clf, **info):
+        """
+        Save a fitted pipeline, then remove the least recently used entries above
+        max_entries.
+
+        :param key: Key from make_key
+        :param clf: Fitted pipeline
+        :param info: Extra JSON serializable information saved in meta.json
+        :return: None
+        """
+        def write_files(entry):
+            joblib.dump(clf, os.path.join(entry, 'model.joblib'))
+
+        meta = dict(format=STORE_FORMAT, versions=library_versions(), created=time.time(), info=info)
+        self.write_entry(key, write_files, meta)
@@ -0,0 +1,157 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Replays a recorded session from the SSVEP exoskeleton dataset as a live LSL
+EEG outlet, so the online pipeline can be run and benchmarked without a headset.
+
+The EEG channels of the recording are published on a stream of type 'EEG' and
+the events of the matching -eve.fif file on a companion stream of type 'Markers'.
+Samples are stamped with the time they become available at the chosen speed,
+so latency measured by the consumer is meaningful. When replaying as fast as
+possible every chunk is stamped with the local clock at the time it is pushed.
+
+Example (replay subject 5, trial 1 at twice real time):
+    python3 replay_eeg.py --data-dir ~/dataset-ssvep-exoskeleton --subject 5 --trial 1 --speed 2
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import mne
+from pylsl import StreamInfo, StreamOutlet, local_clock
+
+
+class EEGReplay:
+    """
+    Publishes a recorded .fif session on a LSL EEG outlet and a marker outlet.
+
+    Attributes:
+    --------------------
+    sfreq: float \n
+    ch_names: list \n
+    speed: float
+        Replay speed, 1 is real time, 0 (or inf) is as fast as possible
+
+    Methods:
+    --------------------
+    run(loop=False, duration=None)
+        Streams the recording, returns the number of samples pushed
+    """
+
+    def __init__(self, raw_data_path, event_data_path, speed=1.0, chunk_time=0.02,
+                 stream_name='ReplayEEG', marker_name='ReplayMarkers'):
+        """
+        :param raw_data_path: Path to the _raw.fif recording
+        :param event_data_path: Path to the matching -eve.fif event file
+        :param speed: Replay speed factor. 1 is real time, 0 or inf is as fast as possible
+        :param chunk_time: Length of each pushed chunk in (recording) seconds
+        :param stream_name: Name of the EEG outlet
+        :param marker_name: Name of the marker outlet
+        """
+        print('...Loading ' + os.path.basename(raw_data_path) + ' for replay...')
+        raw = mne.io.read_raw_fif(raw_data_path, preload=True)
+        picks = mne.pick_types(raw.info, meg=False, eeg=True, stim=False, eog=False)
+
+        self.sfreq = raw.info['sfreq']
+        self.ch_names = [raw.ch_names[pick] for pick in picks]
+        # LSL expects (n_samples, n_channels)
+        self._data = np.ascontiguousarray(raw.get_data(picks=picks).T, dtype=np.float32)
+
+        # Event sample numbers include the recording's first sample offset
+        events = mne.read_events(event_data_path)
+        self._event_samples = events[:, 0] - raw.first_samp
+        self._event_codes = events[:, 2]
+
+        self.speed = speed if speed and np.isfinite(speed) else 0
+        self._chunk_samples = max(1, int(round(chunk_time * self.sfreq)))
+
+        source = os.path.splitext(os.path.basename(raw_data_path))[0]
+        info = StreamInfo(stream_name, 'EEG', channel_count=len(self.ch_names),
+                          nominal_srate=self.sfreq, channel_format='float32',
+                          source_id='replay_' + source)
+        channels = info.desc().append_child('channels')
+        for name in self.ch_names:
+            channel = channels.append_child('channel')
+            channel.append_child_value('label', name)
+            channel.append_child_value('unit', 'volts')
+            channel.append_child_value('type', 'EEG')
+        self._outlet = StreamOutlet(info, chunk_size=self._chunk_samples)
+
+        marker_info = StreamInfo(marker_name, 'Markers', channel_count=1, nominal_srate=0,
+                                 channel_format='string', source_id='replay_markers_' + source)
+        self._marker_outlet = StreamOutlet(marker_info)
+
+    def run(self, loop=False, duration=None):
+        """
+        Streams the recording. Blocks until the recording is finished, or until
+        duration seconds have passed when looping.
+
+        :param loop: Start over at the end of the recording
+        :param duration: Maximum time to stream in seconds, None for no limit
+        :return: int, number of samples pushed
+        """
+        n_samples = self._data.shape[0]
+        # Replay timeline: sample i becomes available 1 / (sfreq * speed) seconds after sample i - 1
+        rate = self.sfreq * self.speed
+        n_pushed = 0
+
+        print('...Replaying ' + str(len(self.ch_names)) + ' channels at ' + str(self.sfreq) + ' Hz, speed ' +
+              (str(self.speed) + 'x' if self.speed else 'as fast as possible') + '...')
+        t0 = local_clock()
+        tstart = time.time()
+        while True:
+            for start in range(0, n_samples, self._chunk_samples):
+                stop = min(start + self._chunk_samples, n_samples)
+                if self.speed:
+                    sample_index = np.arange(n_pushed, n_pushed + stop - start)
+                    timestamps = t0 + sample_index / rate
+
+                    # Wait until the last sample of the chunk would have been recorded
+                    delay = timestamps[-1] - local_clock()
+                    if delay > 0:
+                        time.sleep(delay)
+                else:
+                    # The timeline would run ahead of the clock, the chunk is available now
+                    timestamps = np.full(stop - start, local_clock())
+
+                self._outlet.push_chunk(self._data[start:stop], timestamps.tolist())
+
+                # Events starting inside this chunk
+                in_chunk = np.flatnonzero((self._event_samples >= start) & (self._event_samples < stop))
+                for event in in_chunk:
+                    event_time = timestamps[self._event_samples[event] - start]
+                    self._marker_outlet.push_sample([str(self._event_codes[event])], event_time)
+
+                n_pushed += stop - start
+                if duration is not None and time.time() - tstart >= duration:
+                    return n_pushed
+
+            if not loop:
+                break
+
+        elapsed = time.time() - tstart
+        print('...Replay finished: ' + str(n_pushed) + ' samples in ' + f'{elapsed:.2f}' + ' s (' +
+              f'{n_pushed / self.sfreq / max(elapsed, 1e-9):.1f}' + 'x real time)...')
+        return n_pushed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded SSVEP session as a LSL EEG outlet')
+    parser.add_argument('--data-dir', required=True, help='Directory of the SSVEP exoskeleton dataset')
+    parser.add_argument('--subject', type=int, default=0, help='Subject number (index into ReadEEG.subj_list)')
+    parser.add_argument('--trial', type=int, default=0, help='Trial number of the subject')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed, 1 is real time, 0 is as fast as possible')
+    parser.add_argument('--loop', action='store_true', help='Start over at the end of the recording')
+    parser.add_argument('--duration', type=float, default=None, help='Stop after this many seconds')
+    args = parser.parse_args()
+
+    # import EEG Data Class, only needed to find the recording
+    from eeg_input import ReadEEG
+
+    raw_path, event_path = ReadEEG(args.data_dir, epoch_cache_dir=None).get_trial_paths(args.subject, args.trial)
+    replay = EEGReplay(raw_path, event_path, speed=args.speed)
+    replay.run(loop=args.loop, duration=args.duration)
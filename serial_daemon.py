@@ -0,0 +1,370 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Serial transport service, so several tools can share one Arduino connection.
+
+Opening the serial port resets the Arduino and only one program can hold it,
+so set_frequencies.py cannot change the LED frequencies while
+control_methods.py is driving. SerialDaemon opens the port once and accepts
+clients on a Unix socket:
+
+    - clients write exactly what they would write to the port (text or binary
+      protocol, the same one the daemon was started with)
+    - drive commands of all clients go through one latest-wins slot of a
+      SerialCommandWriter and are written before stimulus configs and other
+      commands, so a stimulus message never delays driving
+    - everything the device sends is forwarded to every connected client
+
+SerialClient behaves like serial.Serial (write, flush, read, readline,
+in_waiting, close), so the scripts only have to open it instead of the port.
+open_port does that for ports given as 'unix:<socket path>':
+
+    python3 serial_daemon.py --port /dev/ttyACM0
+    BCI_SERIAL_PORT=unix:/tmp/bci_serial.sock python3 control_methods.py
+    BCI_SERIAL_PORT=unix:/tmp/bci_serial.sock python3 set_frequencies.py
+"""
+
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import serial
+
+from serial_protocol import DIRECTIONS, OP_DRIVE, FrameDecoder, encode_frame, get_protocol
+from serial_writer import SerialCommandWriter
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'bci_serial.sock')
+
+# Prefix of ports that are a daemon socket instead of a serial device
+UNIX_PREFIX = 'unix:'
+
+# Bytes of device output a client keeps unread, like the input buffer of a serial driver
+CLIENT_BUFFER_SIZE = 4096
+
+
+def open_port(port, baud=9600, timeout=1):
+    """
+    :param port: Serial port, or 'unix:<socket path>' for a SerialDaemon
+    :param baud: Baud rate, only used for serial ports
+    :param timeout: Read timeout in seconds
+    :return: serial.Serial or SerialClient
+    """
+    if port.startswith(UNIX_PREFIX):
+        return SerialClient(port[len(UNIX_PREFIX):], timeout=timeout)
+    return serial.Serial(port, baud, timeout=timeout)
+
+
+class _ClientParser:
+    """
+    Splits the byte stream of one client into commands, drive commands are
+    recognized so they can take priority.
+    """
+
+    def __init__(self, protocol):
+        self.binary = protocol.name == 'binary'
+        self._buffer = b''
+        self._decoder = FrameDecoder()
+
+    def feed(self, data):
+        """
+        :param data: bytes received from the client
+        :return: list of (direction, None) for drive commands and (None, bytes) for other commands
+        """
+        commands = []
+        if self.binary:
+            for opcode, payload in self._decoder.feed_frames(data):
+                if opcode == OP_DRIVE and len(payload) == 1 and payload[0] < len(DIRECTIONS):
+                    commands.append((DIRECTIONS[payload[0]], None))
+                else:
+                    commands.append((None, encode_frame(opcode, payload)))
+            return commands
+
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        directions = [self.__direction(line) for line in lines]
+        for indx, (line, direction) in enumerate(zip(lines, directions)):
+            if direction is None:
+                commands.append((None, line + b'\n'))
+            elif not (direction == '00' and indx + 1 < len(lines) and directions[indx + 1] is not None):
+                # The 'd/00' sent before a direction is skipped, the writer sends it again
+                commands.append((direction, None))
+        return commands
+
+    @staticmethod
+    def __direction(line):
+        """
+        :param line: Text command without the newline
+        :return: str, direction of a 'd/xx' drive command, None for other commands
+        """
+        direction = line[2:4].decode('utf-8', errors='replace')
+        if line.startswith(b'd/') and len(line) == 4 and direction in DIRECTIONS:
+            return direction
+        return None
+
+
+class SerialDaemon:
+    """
+    Owner of the serial connection, serving clients on a Unix socket.
+
+    Attributes:
+    --------------------
+    socket_path: str \n
+    writer: SerialCommandWriter
+        Writes the commands of all clients, drive commands first
+    clients: int
+        Number of connected clients
+
+    Methods:
+    --------------------
+    start() / stop()
+        Starts / stops serving
+    """
+
+    def __init__(self, port, baud=9600, socket_path=DEFAULT_SOCKET, protocol='text', ser=None):
+        """
+        :param port: Serial port of the Arduino
+        :param baud: Baud rate
+        :param socket_path: Unix socket the clients connect to
+        :param protocol: 'text' or 'binary', must match the firmware and the clients
+        :param ser: Already open serial object, instead of opening port
+        """
+        self.socket_path = socket_path
+        self.protocol = get_protocol(protocol)
+        self.ser = ser if ser is not None else serial.Serial(port, baud, timeout=0.1)
+        self.writer = SerialCommandWriter(self.ser, protocol=self.protocol)
+
+        self._server = None
+        self._connections = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    @property
+    def clients(self):
+        with self._lock:
+            return len(self._connections)
+
+    def start(self):
+        """
+        Listens on the socket and starts forwarding the device output.
+        :return: None
+        """
+        if os.path.exists(self.socket_path):
+            # Left over from a daemon that was not stopped cleanly
+            os.remove(self.socket_path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        self._server.listen()
+        self._server.settimeout(0.2)
+        self._stop_event.clear()
+        for target, name in ((self.__accept, 'serial daemon accept'), (self.__read_device, 'serial daemon device')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print('...Serial daemon serving ' + str(self.ser.port) + ' on ' + self.socket_path + '...')
+
+    def stop(self):
+        """
+        Disconnects the clients, writes the pending commands and closes the port.
+        :return: None
+        """
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(1.0)
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._server.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.writer.close()
+        self.ser.close()
+
+    def __accept(self):
+        while not self._stop_event.is_set():
+            try:
+                connection, _ = self._server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            with self._lock:
+                self._connections.append(connection)
+            threading.Thread(target=self.__serve_client, args=(connection,), name='serial daemon client',
+                             daemon=True).start()
+
+    def __serve_client(self, connection):
+        """
+        Hands the commands of one client to the writer until it disconnects
+        """
+        parser = _ClientParser(self.protocol)
+        while not self._stop_event.is_set():
+            try:
+                data = connection.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            for direction, message in parser.feed(data):
+                if direction is not None:
+                    self.writer.send_direction(direction)
+                elif not self.writer.send(message):
+                    print('...Serial daemon queue full, dropped a command...')
+        self.__disconnect(connection)
+
+    def __disconnect(self, connection):
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+        connection.close()
+
+    def __read_device(self):
+        """
+        Forwards everything the device sends to every client
+        """
+        while not self._stop_event.is_set():
+            try:
+                data = self.ser.read(max(1, self.ser.in_waiting))
+            except Exception as err:
+                print('...Serial daemon lost the device (' + str(err) + ')...')
+                return
+            if not data:
+                continue
+            with self._lock:
+                connections = list(self._connections)
+            for connection in connections:
+                try:
+                    connection.sendall(data)
+                except OSError:
+                    self.__disconnect(connection)
+
+
+class SerialClient:
+    """
+    Connection to a SerialDaemon with the interface of serial.Serial used by
+    the scripts. Like a serial port, only the latest buffer_size bytes of device
+    output are kept until they are read, older ones are dropped and counted in
+    n_dropped.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=1, buffer_size=CLIENT_BUFFER_SIZE):
+        """
+        :param socket_path: Unix socket of the daemon
+        :param timeout: Read timeout in seconds, None to wait forever
+        :param buffer_size: Unread bytes of device output kept, the oldest are dropped first
+        """
+        self.port = UNIX_PREFIX + socket_path
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.n_dropped = 0
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+
+        self._buffer = bytearray()
+        self._received = threading.Condition()
+        self._closed = False
+        threading.Thread(target=self.__receive, name='serial client', daemon=True).start()
+
+    def __receive(self):
+        while True:
+            try:
+                data = self._socket.recv(4096)
+            except OSError:
+                data = b''
+            with self._received:
+                if not data:
+                    self._closed = True
+                    self._received.notify_all()
+                    return
+                self._buffer += data
+                overflow = len(self._buffer) - self.buffer_size
+                if overflow > 0:
+                    # Tools that never read (e.g. the drive controls) would keep every echo
+                    del self._buffer[:overflow]
+                    self.n_dropped += overflow
+                self._received.notify_all()
+
+    @property
+    def in_waiting(self):
+        with self._received:
+            return len(self._buffer)
+
+    def write(self, data):
+        """
+        :param data: bytes as they would be written to the port
+        :return: int, number of bytes written
+        """
+        self._socket.sendall(data)
+        return len(data)
+
+    def flush(self):
+        """
+        The daemon writes the commands, nothing to wait for here
+        :return: None
+        """
+
+    def __wait_for(self, ready):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._received:
+            while not ready() and not self._closed:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._received.wait(remaining)
+
+    def read(self, size=1):
+        """
+        :param size: Number of bytes to read
+        :return: bytes, fewer than size if the timeout passed
+        """
+        self.__wait_for(lambda: len(self._buffer) >= size)
+        with self._received:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    def readline(self):
+        """
+        :return: bytes up to and including the newline, or what arrived before the timeout
+        """
+        self.__wait_for(lambda: b'\n' in self._buffer)
+        with self._received:
+            end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+            data = bytes(self._buffer[:end])
+            del self._buffer[:end]
+        return data
+
+    def close(self):
+        """
+        :return: None
+        """
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Share one serial connection to the Arduino between the tools')
+    parser.add_argument('--port', default='/dev/ttyACM0', help='Serial port of the Arduino')
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix socket the tools connect to')
+    parser.add_argument('--protocol', choices=['text', 'binary'], default='text',
+                        help='Serial command protocol, must match the firmware')
+    args = parser.parse_args()
+
+    daemon = SerialDaemon(args.port, args.baud, args.socket, args.protocol)
+    daemon.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    daemon.stop()
+    print(daemon.writer.report())
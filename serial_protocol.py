@@ -0,0 +1,305 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Command protocols between the computer and the Arduino.
+
+The text protocol is what the firmware understands by default:
+    drive       'd/00\\n' + 'd/nn\\n'                 (10 bytes per direction change)
+    stimulus    's/23,13,000;25,17,090;\\n'          (10 bytes per LED + 3)
+    device      'data is: ...' echo lines, ultrasonic distances as text
+
+The binary protocol (firmware compiled with BINARY_PROTOCOL, see
+a4_binary_protocol.ino) frames every message as
+
+    [0xA5 sync] [header: opcode << 6 | payload length] [payload] [CRC-8]
+
+with the CRC-8 (polynomial 0x07, initial value 0) computed over the header and
+the payload. A payload holds at most 63 bytes.
+
+    DRIVE      opcode 0, payload: direction code, see DIRECTIONS   (4 bytes per direction change)
+    STIMULUS   opcode 1, payload: pin, frequency (Hz), phase / 2 (degrees) for every LED
+    TELEMETRY  opcode 2, device to computer, payload: kind, data
+        ECHO       kind 0, data: header and payload of the received frame
+        DISTANCE   kind 1, data: 5 ultrasonic distances in mm, uint16 little endian
+
+The firmware stops the motors before every new binary direction, so no clear
+message is needed. Decoders resynchronize on the next sync byte after a CRC
+error, so a corrupted or partial frame is dropped instead of being misread.
+
+Both protocols have the same interface (drive, stimulus, reader), so the
+scripts only pick one with get_protocol.
+"""
+
+import os
+import struct
+
+# Frame layout
+SYNC = 0xA5
+MAX_PAYLOAD = 63
+
+# Opcodes
+OP_DRIVE = 0
+OP_STIMULUS = 1
+OP_TELEMETRY = 2
+
+# Telemetry kinds
+TELEMETRY_ECHO = 0
+TELEMETRY_DISTANCE = 1
+
+# Direction code -> text direction, same order as DRIVE_DIRECTIONS in a4_binary_protocol.ino
+DIRECTIONS = ('00', 'nn', 'ww', 'ss', 'ee', 'nw', 'ne', 'sw', 'se')
+DIRECTION_CODES = {direction: code for code, direction in enumerate(DIRECTIONS)}
+
+# Written before every new text direction to clear the last one
+CLEAR_MESSAGE = 'd/00\n'
+
+# Prefix of the lines the firmware prints for every received command
+ECHO_PREFIX = 'data is: '
+
+# Environment variable overriding the serial port of the scripts, e.g. the pty of arduino_sim.py
+SERIAL_PORT_ENV = 'BCI_SERIAL_PORT'
+
+
+def _make_crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+
+_CRC8_TABLE = _make_crc8_table()
+
+
+def crc8(data, crc=0):
+    """
+    :param data: bytes to check
+    :param crc: CRC of the preceding bytes
+    :return: int, CRC-8 (polynomial 0x07) of data
+    """
+    for byte in data:
+        crc = _CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def encode_frame(opcode, payload=b''):
+    """
+    :param opcode: OP_DRIVE, OP_STIMULUS or OP_TELEMETRY
+    :param payload: bytes, at most MAX_PAYLOAD
+    :return: bytes, the framed message
+    """
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError('Payload of ' + str(len(payload)) + ' bytes, at most ' + str(MAX_PAYLOAD) + ' fit in a frame')
+    header = bytes((opcode << 6 | len(payload),)) + bytes(payload)
+    return bytes((SYNC,)) + header + bytes((crc8(header),))
+
+
+def _check_stimulus(pins, freqs, phases):
+    if not len(pins) == len(freqs) == len(phases):
+        raise ValueError('pins, freqs and phases must have the same length')
+    for pin, freq, phase in zip(pins, freqs, phases):
+        if not (0 <= int(pin) <= 99 and 0 < int(freq) <= 100 and 0 <= int(phase) < 360):
+            raise ValueError('Stimulus out of range: pin ' + str(pin) + ', ' + str(freq) + ' Hz, ' +
+                             str(phase) + ' degrees')
+
+
+class TextProtocol:
+    """
+    Newline terminated ASCII commands, the default of the firmware.
+    """
+
+    name = 'text'
+
+    @staticmethod
+    def drive(direction):
+        """
+        :param direction: Drive direction, e.g. 'nn' or '00'
+        :return: bytes, clear message followed by the new direction
+        """
+        if direction not in DIRECTION_CODES:
+            raise ValueError('Unknown direction ' + repr(direction))
+        return (CLEAR_MESSAGE + 'd/' + direction + '\n').encode('utf-8')
+
+    @staticmethod
+    def stimulus(pins, freqs, phases):
+        """
+        :param pins: LED pin numbers
+        :param freqs: Flashing frequencies in Hz, 1 to 100
+        :param phases: Phase angles in degrees, 0 to 359
+        :return: bytes, 's/pp,ff,ppp;...' message
+        """
+        _check_stimulus(pins, freqs, phases)
+        message = 's/'
+        for pin, freq, phase in zip(pins, freqs, phases):
+            message = message + f'{int(pin):02}' + ',' + f'{int(freq):02}' + ',' + f'{int(phase):03}' + ';'
+        return (message + '\n').encode('utf-8')
+
+    @staticmethod
+    def reader():
+        """
+        :return: LineReader splitting the device output into lines
+        """
+        return LineReader()
+
+
+class BinaryProtocol:
+    """
+    Framed binary commands, firmware compiled with BINARY_PROTOCOL.
+    """
+
+    name = 'binary'
+
+    @staticmethod
+    def drive(direction):
+        """
+        :param direction: Drive direction, e.g. 'nn' or '00'
+        :return: bytes, 4 byte DRIVE frame
+        """
+        if direction not in DIRECTION_CODES:
+            raise ValueError('Unknown direction ' + repr(direction))
+        return encode_frame(OP_DRIVE, bytes((DIRECTION_CODES[direction],)))
+
+    @staticmethod
+    def stimulus(pins, freqs, phases):
+        """
+        :param pins: LED pin numbers
+        :param freqs: Flashing frequencies in Hz, 1 to 100
+        :param phases: Phase angles in degrees, 0 to 359, sent with a resolution of 2 degrees
+        :return: bytes, STIMULUS frame (3 bytes per LED + 3)
+        """
+        _check_stimulus(pins, freqs, phases)
+        payload = bytearray()
+        for pin, freq, phase in zip(pins, freqs, phases):
+            payload += bytes((int(pin), int(freq), int(phase) // 2))
+        return encode_frame(OP_STIMULUS, payload)
+
+    @staticmethod
+    def reader():
+        """
+        :return: FrameDecoder turning the device frames into the equivalent text lines
+        """
+        return FrameDecoder()
+
+
+PROTOCOLS = {TextProtocol.name: TextProtocol, BinaryProtocol.name: BinaryProtocol}
+
+
+def get_protocol(name='text'):
+    """
+    :param name: 'text' or 'binary', a protocol class is returned as is
+    :return: Protocol class
+    """
+    if not isinstance(name, str):
+        return name
+    try:
+        return PROTOCOLS[name]
+    except KeyError:
+        raise ValueError('Unknown serial protocol ' + repr(name) + ', choose one of ' + ', '.join(PROTOCOLS))
+
+
+def serial_port(default):
+    """
+    :param default: Port of the script, e.g. '/dev/ttyACM0' or 'COM8'
+    :return: str, the BCI_SERIAL_PORT environment variable if set, else default
+    """
+    return os.environ.get(SERIAL_PORT_ENV) or default
+
+
+def describe_frame(opcode, payload):
+    """
+    Text form of a frame, as the text firmware would have printed it.
+
+    :param opcode: Frame opcode
+    :param payload: Frame payload
+    :return: str, e.g. 'data is: d/nn' for the echo of a DRIVE frame
+    """
+    if opcode == OP_DRIVE and len(payload) == 1 and payload[0] < len(DIRECTIONS):
+        return 'd/' + DIRECTIONS[payload[0]]
+    if opcode == OP_STIMULUS and len(payload) % 3 == 0:
+        leds = [payload[indx:indx + 3] for indx in range(0, len(payload), 3)]
+        return 's/' + ''.join(f'{pin:02},{freq:02},{phase * 2:03};' for pin, freq, phase in leds)
+    if opcode == OP_TELEMETRY and payload:
+        kind, data = payload[0], payload[1:]
+        if kind == TELEMETRY_ECHO and data:
+            return ECHO_PREFIX + describe_frame(data[0] >> 6, data[1:])
+        if kind == TELEMETRY_DISTANCE and len(data) % 2 == 0:
+            distances = struct.unpack('<' + str(len(data) // 2) + 'H', data)
+            return 'distances (cm): ' + ', '.join(f'{distance / 10:.1f}' for distance in distances)
+    return 'frame ' + str(opcode) + ': ' + bytes(payload).hex()
+
+
+class LineReader:
+    """
+    Splits the text output of the device into lines.
+    """
+
+    def __init__(self):
+        self._buffer = b''
+
+    def feed(self, data):
+        """
+        :param data: bytes read from the device
+        :return: list of complete lines, decoded and stripped
+        """
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        return [line.decode('utf-8', errors='replace').strip() for line in lines]
+
+
+class FrameDecoder:
+    """
+    Incremental decoder of binary frames.
+
+    Attributes:
+    --------------------
+    crc_errors: int
+        Frames dropped because of a CRC mismatch
+    skipped: int
+        Bytes skipped while looking for a sync byte
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.crc_errors = 0
+        self.skipped = 0
+
+    def feed_frames(self, data):
+        """
+        :param data: bytes read from the port
+        :return: list of (opcode, payload) of the complete, valid frames
+        """
+        self._buffer += data
+        frames = []
+        while True:
+            start = self._buffer.find(SYNC)
+            if start < 0:
+                self.skipped += len(self._buffer)
+                self._buffer.clear()
+                return frames
+            if start:
+                self.skipped += start
+                del self._buffer[:start]
+            if len(self._buffer) < 2:
+                return frames
+            length = self._buffer[1] & MAX_PAYLOAD
+            if len(self._buffer) < length + 3:
+                return frames
+
+            header = bytes(self._buffer[1:length + 2])
+            if crc8(header) != self._buffer[length + 2]:
+                # Not a frame (or a corrupted one), look for the next sync byte
+                self.crc_errors += 1
+                del self._buffer[:1]
+                continue
+            frames.append((header[0] >> 6, header[1:]))
+            del self._buffer[:length + 3]
+
+    def feed(self, data):
+        """
+        :param data: bytes read from the port
+        :return: list of str, text form of the decoded frames (see describe_frame)
+        """
+        return [describe_frame(opcode, payload) for opcode, payload in self.feed_frames(data)]
@@ -0,0 +1,207 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Non-blocking writes of commands to the Arduino.
+
+At 9600 baud every byte takes about 1 ms on the wire, so writing a direction
+change (10 bytes with the text protocol) from the pygame loop or the
+classification loop blocks it for about 10 ms. SerialCommandWriter hands the
+commands to a writer thread instead:
+
+    - drive directions go into a single latest-wins slot. A direction that was
+      not written yet when the next one arrives is replaced (and counted as a
+      dropped update), so the device always gets the newest command and a slow
+      port never builds up a backlog of outdated directions
+    - other commands (e.g. 's/...' frequency settings) go into a bounded FIFO
+      queue, when it is full the command is refused and counted as dropped
+
+Drive directions are written before queued commands. Queue depth, write latency
+(from the call to the bytes being sent) and the dropped update counters are
+available from stats().
+"""
+
+import queue
+import threading
+import time
+
+from serial_protocol import get_protocol
+from stage_timer import StageHistogram
+
+
+class SerialCommandWriter:
+    """
+    Writer thread owning the writes to one serial port.
+
+    Attributes:
+    --------------------
+    ser: Serial object the commands are written to \n
+    protocol: Encoder of the drive directions, see serial_protocol \n
+    written: int
+        Number of writes done
+    dropped_updates: int
+        Directions replaced by a newer one before they were written
+    dropped_commands: int
+        Commands refused because the queue was full
+    write_errors: int
+        Writes that raised an exception (e.g. port disconnected)
+
+    Methods:
+    --------------------
+    send_direction(direction, on_written=None)
+        Replaces the pending drive direction, never blocks
+    send(message)
+        Queues any other (already encoded) command, never blocks
+    stats()
+        Queue depth, write latency and dropped update counters
+    close(timeout=1.0)
+        Writes what is pending and stops the thread
+    """
+
+    def __init__(self, ser, max_queue=32, timer=None, protocol='text'):
+        """
+        :param ser: Serial object connected to a specific serial port
+        :param max_queue: Number of non-drive commands that can wait to be written
+        :param timer: Optional StageTimer, the time spent in each write is recorded as 'serial_write'
+        :param protocol: 'text' or 'binary' command protocol, see serial_protocol
+        """
+        self.ser = ser
+        self.timer = timer
+        self.protocol = get_protocol(protocol)
+
+        self.written = 0
+        self.dropped_updates = 0
+        self.dropped_commands = 0
+        self.write_errors = 0
+        self.max_queue_depth = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        # Latest-wins drive slot: (direction, enqueue time, callback) or None
+        self._pending_direction = None
+        self._wakeup = threading.Condition()
+        self._latency = StageHistogram()
+        self._closing = False
+
+        self._thread = threading.Thread(target=self.__run, name='serial writer', daemon=True)
+        self._thread.start()
+
+    def send_direction(self, direction, on_written=None):
+        """
+        :param direction: Drive direction, e.g. 'nn' or '00'
+        :param on_written: Optional function called without arguments on the writer
+                           thread once the direction was written (not called if it was replaced)
+        :return: None
+        """
+        with self._wakeup:
+            if self._pending_direction is not None:
+                self.dropped_updates += 1
+            self._pending_direction = (direction, time.perf_counter(), on_written)
+            self._wakeup.notify()
+
+    def send(self, message):
+        """
+        :param message: bytes (or str) as written, e.g. from protocol.stimulus
+        :return: bool, False if the queue was full and the command was dropped
+        """
+        try:
+            self._queue.put_nowait((message, time.perf_counter()))
+        except queue.Full:
+            with self._wakeup:
+                self.dropped_commands += 1
+            return False
+        with self._wakeup:
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+            self._wakeup.notify()
+        return True
+
+    def queue_depth(self):
+        """
+        :return: int, commands waiting to be written (including a pending direction)
+        """
+        with self._wakeup:
+            return self._queue.qsize() + (self._pending_direction is not None)
+
+    def __next_write(self):
+        """
+        Waits for the next thing to write, drive directions first.
+
+        :return: tuple (message, enqueue time, callback), or None once closed and drained
+        """
+        with self._wakeup:
+            while True:
+                if self._pending_direction is not None:
+                    direction, enqueued, on_written = self._pending_direction
+                    self._pending_direction = None
+                    return self.protocol.drive(direction), enqueued, on_written
+                try:
+                    message, enqueued = self._queue.get_nowait()
+                    return message, enqueued, None
+                except queue.Empty:
+                    pass
+                if self._closing:
+                    return None
+                self._wakeup.wait()
+
+    def __run(self):
+        while True:
+            item = self.__next_write()
+            if item is None:
+                return
+            message, enqueued, on_written = item
+
+            tstart = time.perf_counter()
+            try:
+                self.ser.write(message.encode('utf-8') if isinstance(message, str) else message)
+                self.ser.flush()  # wait until the bytes are sent
+            except Exception as err:
+                with self._wakeup:
+                    self.write_errors += 1
+                print('...Serial write failed (' + str(err) + ')...')
+                continue
+            tend = time.perf_counter()
+
+            if self.timer is not None:
+                self.timer.record('serial_write', tend - tstart)
+            with self._wakeup:
+                self.written += 1
+                self._latency.add(tend - enqueued)
+            if on_written is not None:
+                on_written()
+
+    def stats(self):
+        """
+        :return: dict with queue_depth, max_queue_depth, written, dropped_updates,
+                 dropped_commands, write_errors and the write latency statistics
+                 (see StageHistogram.summary) under latency
+        """
+        depth = self.queue_depth()
+        with self._wakeup:
+            return dict(queue_depth=depth, max_queue_depth=self.max_queue_depth, written=self.written,
+                        dropped_updates=self.dropped_updates, dropped_commands=self.dropped_commands,
+                        write_errors=self.write_errors, latency=self._latency.summary())
+
+    def report(self):
+        """
+        :return: str, one line summary of stats()
+        """
+        stats = self.stats()
+        line = ('Serial writer: ' + str(stats['written']) + ' writes, ' + str(stats['dropped_updates']) +
+                ' directions replaced, ' + str(stats['dropped_commands']) + ' commands dropped, ' +
+                str(stats['write_errors']) + ' errors, max queue depth ' + str(stats['max_queue_depth']))
+        if stats['latency']['count']:
+            line += (', write latency (ms) mean ' + f'{stats["latency"]["mean_ms"]:.2f}' +
+                     ', p95 ' + f'{stats["latency"]["p95_ms"]:.2f}' +
+                     ', max ' + f'{stats["latency"]["max_ms"]:.2f}')
+        return line
+
+    def close(self, timeout=1.0):
+        """
+        Writes the pending commands and stops the writer thread.
+
+        :param timeout: Seconds to wait for the pending writes
+        :return: None
+        """
+        with self._wakeup:
+            self._closing = True
+            self._wakeup.notify()
+        self._thread.join(timeout)
@@ -1,20 +1,25 @@
 # Author: James Chen
 # University of Calgary
 
-import serial
+import argparse
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
 from tkinter import Checkbutton
 from tkinter import Spinbox
 
+from serial_protocol import PROTOCOLS, get_protocol, serial_port
+from serial_daemon import open_port
+
 
 # TODO: Manual pin selection interface
 
 
 class StimulusConfig(ttk.Frame):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, protocol='text'):
         super().__init__(parent, padding=5)
+        # Encoder of the stimulus message, must match the firmware
+        self.protocol = get_protocol(protocol)
         self.grid(sticky=tk.N + tk.S + tk.W + tk.E)
         self.__makewidgets()
 
@@ -101,21 +106,22 @@ class StimulusConfig(ttk.Frame):
                 # get pin number
                 self.pins.append(i * 2 + 23)
 
-        message = 's/'
-        for i in range(len(self.pins)):
-            message = message + \
-                      f'{int(self.pins[i]):02}' + ',' + f'{self.freqs[i]:02}' + \
-                      ',' + f'{int(self.phase_vals[i]):03}' + ';'
-        message = message + '\n'
+        message = self.protocol.stimulus(self.pins, self.freqs, [int(phase) for phase in self.phase_vals])
         ser.flush()
-        ser.write(message.encode('utf-8'))
+        ser.write(message)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Set the SSVEP stimulus frequencies')
+    parser.add_argument('--protocol', choices=sorted(PROTOCOLS), default='text',
+                        help='Serial command protocol, binary needs firmware built with BINARY_PROTOCOL')
+    args = parser.parse_args()
+
     # setting up serial communication object, currently using COM8, bluetooth for my PC
-    ser = serial.Serial('COM8', 9600)
+    # (BCI_SERIAL_PORT overrides it, e.g. for arduino_sim.py or unix:<socket> for serial_daemon.py)
+    ser = open_port(serial_port('COM8'), 9600, timeout=None)
     ser.flush()
 
     root = tk.Tk()
-    StimulusConfig(root)
+    StimulusConfig(root, protocol=args.protocol)
     root.mainloop()
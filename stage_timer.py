@@ -0,0 +1,202 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Low overhead per-stage timing for the control and EEG processing scripts.
+
+Stages are timed with
+
+    with timer.stage('bandpass'):
+        ...
+
+and every duration goes into a histogram with logarithmic buckets (about 9%
+wide, from 1 us to over an hour), so memory use is fixed however long the
+program runs. The count, mean, max and approximate 50th/95th/99th percentiles
+of each stage can be printed or exported as JSON.
+
+A disabled timer returns one shared no-op context manager and records nothing,
+so the instrumentation can stay in place in production.
+
+Only the standard library is used, so the light keyboard control path can use
+it too.
+"""
+
+import json
+import math
+import threading
+import time
+from contextlib import nullcontext
+
+# Histogram buckets: bucket i holds durations in [MIN_TIME * RATIO ** i, MIN_TIME * RATIO ** (i + 1))
+MIN_TIME = 1e-6
+RATIO = 2 ** (1 / 8)
+N_BUCKETS = 256
+
+_LOG_RATIO = math.log(RATIO)
+_NO_OP = nullcontext()
+
+
+class StageHistogram:
+    """
+    Log bucket histogram of the durations of one stage.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * N_BUCKETS
+
+    def add(self, seconds):
+        """
+        :param seconds: Duration of one run of the stage
+        :return: None
+        """
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if seconds <= MIN_TIME:
+            indx = 0
+        else:
+            indx = min(int(math.log(seconds / MIN_TIME) / _LOG_RATIO), N_BUCKETS - 1)
+        self.buckets[indx] += 1
+
+    def percentile(self, q):
+        """
+        :param q: Percentile, 0 to 100
+        :return: Approximate duration in seconds (geometric middle of the bucket, at most max)
+        """
+        if self.count == 0:
+            return float('nan')
+        rank = q / 100 * self.count
+        seen = 0
+        for indx, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(MIN_TIME * RATIO ** (indx + 0.5), self.max)
+        return self.max
+
+    def summary(self):
+        """
+        :return: dict with count, mean_ms, p50_ms, p95_ms, p99_ms, max_ms and total_s
+        """
+        if self.count == 0:
+            return dict(count=0)
+        return dict(count=self.count, mean_ms=self.total / self.count * 1000,
+                    p50_ms=self.percentile(50) * 1000, p95_ms=self.percentile(95) * 1000,
+                    p99_ms=self.percentile(99) * 1000, max_ms=self.max * 1000, total_s=self.total)
+
+
+class _StageContext:
+    """
+    Context manager timing one run of a stage.
+    """
+
+    __slots__ = ('_timer', '_name', '_start')
+
+    def __init__(self, timer, name):
+        self._timer = timer
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._timer.record(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class StageTimer:
+    """
+    Collection of stage histograms.
+
+    Attributes:
+    --------------------
+    enabled: bool
+        Disabled timers do not record anything
+
+    Methods:
+    --------------------
+    stage(name)
+        Context manager timing one run of a stage
+    record(name, seconds)
+        Adds a duration measured elsewhere
+    summary()
+        Statistics of every stage
+    report()
+        Human readable table of the statistics
+    to_json(path=None)
+        Statistics as JSON, optionally written to a file
+    reset()
+        Removes all recorded durations
+    """
+
+    def __init__(self, enabled=True):
+        """
+        :param enabled: Record durations, a disabled timer costs one method call per stage
+        """
+        self.enabled = enabled
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """
+        :param name: Stage name
+        :return: Context manager timing the block it wraps
+        """
+        if not self.enabled:
+            return _NO_OP
+        return _StageContext(self, name)
+
+    def record(self, name, seconds):
+        """
+        :param name: Stage name
+        :param seconds: Duration of one run of the stage
+        :return: None
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._stages.get(name)
+            if histogram is None:
+                histogram = self._stages[name] = StageHistogram()
+            histogram.add(seconds)
+
+    def summary(self):
+        """
+        :return: dict of stage name -> statistics, see StageHistogram.summary
+        """
+        with self._lock:
+            return {name: histogram.summary() for name, histogram in self._stages.items()}
+
+    def report(self):
+        """
+        :return: str, one line per stage in the order they first ran
+        """
+        lines = [f'{"stage":>18} {"count":>7} {"mean ms":>9} {"p50 ms":>9} {"p95 ms":>9} '
+                 f'{"p99 ms":>9} {"max ms":>9}']
+        for name, stats in self.summary().items():
+            lines.append(f'{name:>18} {stats["count"]:>7} {stats["mean_ms"]:9.3f} {stats["p50_ms"]:9.3f} '
+                         f'{stats["p95_ms"]:9.3f} {stats["p99_ms"]:9.3f} {stats["max_ms"]:9.3f}')
+        return '\n'.join(lines)
+
+    def to_json(self, path=None):
+        """
+        :param path: Optional file to write the JSON to
+        :return: str, JSON of summary()
+        """
+        encoded = json.dumps(self.summary(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(encoded + '\n')
+        return encoded
+
+    def reset(self):
+        """
+        Removes all recorded durations
+        :return: None
+        """
+        with self._lock:
+            self._stages.clear()
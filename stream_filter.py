@@ -0,0 +1,168 @@
+# Author: James Chen
+# University of Calgary
+
+"""
+Causal, stateful filter bank for streaming EEG.
+
+`ReadEEG.__build_epochs` filters whole recordings with a zero phase notch and a
+zero phase (forward-backward) IIR band pass. That needs the future of the signal,
+so it cannot be used on live data. `StreamingFilterBank` runs the same filters
+causally on chunks of any size, keeping the filter state between chunks.
+
+The band pass is MNE's default IIR design (4th order Butterworth, second order
+sections). MNE applies it forwards and backwards, so its magnitude response is
+|H|^2; here the sections are applied twice in a row, giving the same magnitude
+response with a causal (non-zero) phase. The notch is a second order IIR notch
+approximating MNE's FIR notch.
+"""
+
+import time
+
+import numpy as np
+from scipy import signal
+
+
+class StreamingFilterBank:
+    """
+    Cascaded SOS notch + band pass filter that keeps its state between chunks.
+
+    Chunks are (n_samples, n_channels) arrays, the layout returned by
+    pylsl.StreamInlet.pull_chunk, and all channels are filtered in a single
+    vectorized call.
+
+    Attributes:
+    --------------------
+    sfreq: float \n
+    n_channels: int \n
+    sos: np.ndarray (n_sections, 6)
+
+    Methods:
+    --------------------
+    process(chunk)
+        Filters a chunk and returns the filtered samples
+    reset(initial=None)
+        Clears the filter state
+    frequency_response(freqs)
+        Magnitude response of the whole cascade
+    latency_stats()
+        Per-chunk processing time
+    """
+
+    def __init__(self, sfreq, n_channels, notch_filt=True, notch_freqs=(60,), notch_width=1.0,
+                 bp_low=6, bp_high=25, order=4, match_offline=True):
+        """
+        :param sfreq: Sampling frequency of the stream in Hz
+        :param n_channels: Number of channels in each chunk
+        :param notch_filt: Include the notch filters, same as notch_filt in ReadEEG
+        :param notch_freqs: Frequencies to notch out in Hz. The default is 60 Hz.
+        :param notch_width: -3 dB width of each notch in Hz
+        :param bp_low: Lower bound for band pass filtering in Hz
+        :param bp_high: Upper bound for band pass filtering in Hz
+        :param order: Butterworth order, MNE's default IIR order is 4
+        :param match_offline: Apply the band pass twice so the magnitude response
+                              matches the forward-backward offline filter
+        """
+        self.sfreq = float(sfreq)
+        self.n_channels = int(n_channels)
+
+        sections = []
+        if notch_filt:
+            for freq in notch_freqs:
+                if freq >= self.sfreq / 2:
+                    continue
+                b, a = signal.iirnotch(freq, freq / notch_width, fs=self.sfreq)
+                sections.append(signal.tf2sos(b, a))
+
+        bandpass = signal.butter(order, [bp_low, bp_high], btype='bandpass',
+                                 fs=self.sfreq, output='sos')
+        sections.append(bandpass)
+        if match_offline:
+            sections.append(bandpass)
+
+        self.sos = np.concatenate(sections, axis=0)
+        self._zi = np.zeros((self.sos.shape[0], 2, self.n_channels))
+
+        # Processing time bookkeeping, in seconds
+        self._n_chunks = 0
+        self._n_samples = 0
+        self._total_time = 0.0
+        self._max_time = 0.0
+        self._last_time = 0.0
+
+    def reset(self, initial=None):
+        """
+        Clears the filter state.
+
+        :param initial: Optional (n_channels,) sample. If given, the state is set to
+                        the steady state for a constant input of this value, which
+                        avoids the start-up transient of a DC offset.
+        :return: None
+        """
+        if initial is None:
+            self._zi = np.zeros((self.sos.shape[0], 2, self.n_channels))
+        else:
+            zi = signal.sosfilt_zi(self.sos)
+            self._zi = zi[:, :, np.newaxis] * np.asarray(initial, dtype=float)[np.newaxis, np.newaxis, :]
+
+    def process(self, chunk):
+        """
+        Filters a chunk of samples, continuing from the state left by the previous chunk.
+
+        :param chunk: array like (n_samples, n_channels)
+        :return: np.ndarray (n_samples, n_channels) of filtered samples
+        """
+        tstart = time.perf_counter()
+
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.shape[0] == 0:
+            return chunk.reshape(0, self.n_channels)
+
+        filtered, self._zi = signal.sosfilt(self.sos, chunk, axis=0, zi=self._zi)
+
+        elapsed = time.perf_counter() - tstart
+        self._n_chunks += 1
+        self._n_samples += chunk.shape[0]
+        self._total_time += elapsed
+        self._last_time = elapsed
+        if elapsed > self._max_time:
+            self._max_time = elapsed
+
+        return filtered
+
+    def frequency_response(self, freqs):
+        """
+        Magnitude response of the whole cascade. With match_offline=True this
+        equals the magnitude response of the offline band pass in build_epochs.
+
+        :param freqs: Frequencies in Hz to evaluate
+        :return: np.ndarray of magnitudes (linear, not dB)
+        """
+        _, h = signal.sosfreqz(self.sos, worN=np.asarray(freqs, dtype=float), fs=self.sfreq)
+        return np.abs(h)
+
+    def group_delay(self, freqs):
+        """
+        Group delay of the causal cascade, i.e. how late the filtered signal is
+        compared to the offline zero phase filter.
+
+        :param freqs: Frequencies in Hz to evaluate
+        :return: np.ndarray of delays in seconds
+        """
+        freqs = np.asarray(freqs, dtype=float)
+        step = 1e-3
+        _, h_low = signal.sosfreqz(self.sos, worN=freqs - step, fs=self.sfreq)
+        _, h_high = signal.sosfreqz(self.sos, worN=freqs + step, fs=self.sfreq)
+        phase_diff = np.angle(h_high / h_low)
+        return -phase_diff / (2 * np.pi * 2 * step)
+
+    def latency_stats(self):
+        """
+        Processing time of the chunks filtered so far.
+
+        :return: dict with number of chunks/samples and the last, mean and max
+                 time per chunk in milliseconds
+        """
+        mean_time = self._total_time / self._n_chunks if self._n_chunks else 0.0
+        return dict(chunks=self._n_chunks, samples=self._n_samples,
+                    last_ms=self._last_time * 1000, mean_ms=mean_time * 1000,
+                    max_ms=self._max_time * 1000)